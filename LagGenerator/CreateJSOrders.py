@@ -102,7 +102,7 @@ def load_and_decode_order(repeat_list,lure_list,foil_list,
     
     fnames=[]
 #    dirname='Set {0}{1}'.format(stim_set, os.sep)  # Get us to the directory
-    dirname='Set {0}_rs/'.format(stim_set)  # Get us to the directory
+    dirname='Set {0}_rs/'.format(stim_set)  # Resized copies from: python mst_stimuli.py --build-cache N
     for i in range(len(type_code)):
         stimfile='UNKNOWN'
         if type_code[i]==0 or type_code[i]==1:
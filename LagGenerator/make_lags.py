@@ -14,11 +14,13 @@ Licensed under the MIT license.
 
 from __future__ import print_function, unicode_literals
 
+import csv
+import io
 import sys
 import random
 from itertools import count
 
-import pandas as pd
+import numpy as np
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -50,109 +52,118 @@ TOTAL_PAIR_TRIALS = sum(PAIR_COUNTS) * len(PAIR_TYPES) * 2  # two trials/pair
 
 TOTAL_TRIALS = FOIL_TRIALS + TOTAL_PAIR_TRIALS
 
+# The trial list is an integer array with a row per trial and these columns;
+# trial_type and repetition are indexes into TRIAL_TYPES / REPETITIONS, and
+# an empty slot has stim_number EMPTY (lag is -1 for foils)
+COLUMNS = ['stim_number', 'trial_type', 'repetition', 'lag']
+STIM_NUMBER, TRIAL_TYPE, REPETITION, LAG = range(len(COLUMNS))
+TRIAL_TYPES = PAIR_TYPES + ['foil']
+REPETITIONS = ['a', 'b', 'x']
+EMPTY = 0
+
 
 def main(task_filename, debug_filename=None):
     trial_list = make_trial_list()
     for_task = format_trial_list_for_task(trial_list)
-    for_task.to_csv(task_filename, index=False, header=False)
+    write_csv(task_filename, zip(*for_task))
     logger.info('Saved task data to {}'.format(task_filename))
     if debug_filename:
-        trial_list.to_csv(debug_filename, index=False)
+        write_csv(debug_filename, debug_rows(trial_list), header=COLUMNS)
         logger.debug('Saved debug data to {}'.format(debug_filename))
 
 
 def make_trial_list():
+    """ Returns the trial list (TOTAL_TRIALS x COLUMNS integer array) """
     logger.info('Generating {} total trials'.format(TOTAL_TRIALS))
-    pd.set_option('display.max_rows', TOTAL_TRIALS)
-    trial_list = pd.DataFrame(
-        index=range(TOTAL_TRIALS),
-        columns=['stim_number', 'trial_type', 'repetition', 'lag'])
+    trial_list = np.full((TOTAL_TRIALS, len(COLUMNS)), -1, dtype=np.int64)
+    trial_list[:, STIM_NUMBER] = EMPTY
+    blanks = np.ones(TOTAL_TRIALS, dtype=bool)
     pair_type_counters = {pair_type: count(1) for pair_type in PAIR_TYPES}
     for c, lag_range in LAG_COUNTS:
-        populate_lags(trial_list, c, lag_range, pair_type_counters)
+        populate_lags(trial_list, blanks, c, lag_range, pair_type_counters)
     fill_foils(trial_list)
     return trial_list
 
 
-def populate_lags(trial_list, lag_count, lag_range, pair_type_counters):
+def populate_lags(trial_list, blanks, lag_count, lag_range, pair_type_counters):
     """
     Adds lag_count * pair_types * 2 elements to trial_list.
-    WARNING: Actively modifies trial_list.
+    WARNING: Actively modifies trial_list (and blanks, which slots of it
+    are still empty).
     raises a RuntimeError if it can't place a lag in the specified range.
     """
     possible_lags = list(lag_range)
+    pair_types = [(pair_type, TRIAL_TYPES.index(pair_type), counter)
+                  for pair_type, counter in pair_type_counters.items()]
+    debug = logger.isEnabledFor(logging.DEBUG)
     for i in range(lag_count):
-        for pair_type, counter in pair_type_counters.items():
+        for pair_type, pair_type_index, counter in pair_types:
             stim_number = next(counter)
-            logger.debug('Trying to place {} #{}'.format(
-                pair_type, stim_number))
+            if debug:
+                logger.debug('Trying to place %s #%s', pair_type, stim_number)
             place_lagged_trials(
-                trial_list, possible_lags, pair_type, stim_number)
+                trial_list, blanks, possible_lags, pair_type_index, stim_number)
 
 
 def fill_foils(trial_list):
     foil_stim_numbers = list(range(1, FOIL_TRIALS + 1))
     random.shuffle(foil_stim_numbers)
-    ix = trial_list[trial_list.stim_number.isnull()].index
-    trial_list.loc[ix, 'stim_number'] = foil_stim_numbers
-    trial_list.loc[ix, 'trial_type'] = 'foil'
-    trial_list.loc[ix, 'repetition'] = 'x'
+    ix = np.flatnonzero(trial_list[:, STIM_NUMBER] == EMPTY)
+    trial_list[ix, STIM_NUMBER] = foil_stim_numbers
+    trial_list[ix, TRIAL_TYPE] = TRIAL_TYPES.index('foil')
+    trial_list[ix, REPETITION] = REPETITIONS.index('x')
 
 
-def place_lagged_trials(trial_list, possible_lags, pair_type, stim_number):
+def place_lagged_trials(trial_list, blanks, possible_lags, pair_type_index,
+                        stim_number):
     """
-    Puts both parts of a pair of trials into trial_list. Raises a RuntimeError
-    if no possible_lags can fit in trial_list.
+    Puts both parts of a pair of trials (pair_type_index: index into
+    TRIAL_TYPES) into trial_list, and clears their slots in blanks. Raises a
+    RuntimeError if no possible_lags can fit in trial_list.
     """
+    # random.choice() takes the same single draw as the random.sample(x, 1)[0]
+    # this used to use, so a given seed still gives the same list
+    debug = logger.isEnabledFor(logging.DEBUG)
     while len(possible_lags) > 0:
-        lag = random.sample(possible_lags, 1)[0]
-        starts = potential_start_indexes(trial_list, lag)
+        lag = random.choice(possible_lags)
+        starts = potential_start_indexes(blanks, lag)
         if len(starts) == 0:
-            logger.debug('No room for pair with lag {}'.format(lag))
+            if debug:
+                logger.debug('No room for pair with lag %s', lag)
             possible_lags.remove(lag)
             continue
-        start_index = random.sample(starts, 1)[0]
+        start_index = int(starts[random.randrange(len(starts))])
         end_index = start_index + lag + 1
-        logger.debug('Placed at {} and {}, lag {}'.format(
-            start_index, end_index, lag))
-        trial_list.loc[start_index].stim_number = stim_number
-        trial_list.loc[start_index].trial_type = pair_type
-        trial_list.loc[start_index].repetition = 'a'
-        trial_list.loc[start_index].lag = lag
-        trial_list.loc[end_index].stim_number = stim_number
-        trial_list.loc[end_index].trial_type = pair_type
-        trial_list.loc[end_index].repetition = 'b'
-        trial_list.loc[end_index].lag = lag
+        if debug:
+            logger.debug('Placed at %s and %s, lag %s', start_index, end_index, lag)
+        # One row each, in COLUMNS order (repetition 0 = 'a', 1 = 'b')
+        trial_list[start_index] = (stim_number, pair_type_index, 0, lag)
+        trial_list[end_index] = (stim_number, pair_type_index, 1, lag)
+        blanks[start_index] = False
+        blanks[end_index] = False
 
         return
 
     else:
-        logger.error(trial_list)
-        free_count = trial_list.stim_number.isnull().sum()
+        logger.error('\n'.join(','.join(row) for row in debug_rows(trial_list)))
+        free_count = np.count_nonzero(trial_list[:, STIM_NUMBER] == EMPTY)
         raise RuntimeError(
             'Out of possible lags: {} slots remain'.format(free_count))
 
 
-def potential_start_indexes(trial_list, lag):
+def potential_start_indexes(blanks, lag):
     """
-    Find all the indexes (i) of trial_list where trial_list[i] and
-    trial_list[i+lag+1] are blank. Returns an empty index if there are no
+    Find all the indexes (i) of the trial list where trial_list[i] and
+    trial_list[i+lag+1] are blank. Returns an empty array if there are no
     candidate indexes.
-    We can find this out by looking at the blank spaces in trial_list and
-    a copy of the trial list shifted up by lag+1 slots, and seeing where
-    both lists are blank.
+    We can find this out by looking at the blank spaces in the trial list
+    and the same blanks shifted up by lag+1 slots, and seeing where both
+    are blank. blanks is kept up to date as trials are placed (one slot
+    each), so this is a single AND of two views of it, with nothing
+    rebuilt from the trial list on each attempt.
     """
-    start_blanks = trial_list.stim_number.isnull()
-    end_blanks = start_blanks.shift(-1 * (lag + 1))
-    matches = start_blanks & end_blanks
-    return list(trial_list.index[matches])
-
-
-def format_trial_list_for_task(trial_list):
-    output = pd.DataFrame(index=trial_list.index, columns=['stype', 'lag'])
-    output.stype = trial_list.apply(output_stim_type, axis=1)
-    output.lag = trial_list.apply(output_lag, axis=1)
-    return output
+    shift = lag + 1
+    return (blanks[:-shift] & blanks[shift:]).nonzero()[0]
 
 
 STYPE_CODE_MAP = {
@@ -163,17 +174,36 @@ STYPE_CODE_MAP = {
     ('foil', 'x'): 400
 }
 
+# STYPE_CODE_MAP as a trial_type x repetition lookup table
+STYPE_CODES = np.array([[STYPE_CODE_MAP.get((trial_type, repetition), 9000)
+                         for repetition in REPETITIONS] for trial_type in TRIAL_TYPES])
+
+
+def format_trial_list_for_task(trial_list):
+    """ Returns the (stype, lag) columns of the task's order file """
+    stype = (STYPE_CODES[trial_list[:, TRIAL_TYPE], trial_list[:, REPETITION]] +
+             trial_list[:, STIM_NUMBER])
+    lag = np.where(trial_list[:, REPETITION] == REPETITIONS.index('b'),
+                   500 + trial_list[:, LAG], -1)
+    return stype, lag
+
 
-def output_stim_type(row):
-    stype_code_addend = STYPE_CODE_MAP.get(
-        (row.trial_type, row.repetition), 9000)
-    return stype_code_addend + row.stim_number
+def debug_rows(trial_list):
+    """ The trial list as rows of text (the lag is blank for foils) """
+    for stim_number, trial_type, repetition, lag in trial_list.tolist():
+        yield ['' if stim_number == EMPTY else str(stim_number),
+               TRIAL_TYPES[trial_type] if trial_type >= 0 else '',
+               REPETITIONS[repetition] if repetition >= 0 else '',
+               str(lag) if lag >= 0 else '']
 
 
-def output_lag(trial_row):
-    if trial_row.repetition == 'b':
-        return 500 + trial_row.lag
-    return -1
+def write_csv(filename, rows, header=None):
+    with io.open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        if header:
+            writer.writerow(header)
+        for row in rows:
+            writer.writerow([str(value) for value in row])
 
 
 if __name__ == '__main__':
@@ -182,4 +212,4 @@ if __name__ == '__main__':
     if len(sys.argv) > 2:
         debug_filename = sys.argv[2]
         logger.setLevel(logging.DEBUG)
-    main(out_filename, debug_filename)
\ No newline at end of file
+    main(out_filename, debug_filename)
@@ -45,20 +45,133 @@ up and going.
 6/19/23 (CELS): Fixed to allow 100 lures rather than 99.
   - Fixed Corr/RT header bug
 6/26/23 (CELS): Set to split into 4 blocks
-"""
+10/16/26: Images are decoded and uploaded before the start screen (with a
+  loading counter) instead of inside the trial loop.  See mst_stimuli.py
+10/16/26: Optional 'prefetch' image loading (IMAGE_LOADING) that decodes only
+  PREFETCH_DEPTH trials ahead on a worker thread; per-trial hits are logged
+  after the summary
+10/16/26: Images are read from the pre-resized cache in "Set N_rs" when one
+  has been built for this display (python mst_stimuli.py --build-cache N)
+10/16/26: A packed "Set N.atlas" file (python mst_stimuli.py --pack-atlas N)
+  is memory-mapped and used ahead of the image files when present
+10/16/26: In 'prefetch' mode textures come from a fixed-budget LRU pool
+  (TEXTURE_BUDGET_MB) that recycles evicted stimuli; hit/miss/eviction counts
+  are logged at the end
+10/16/26: BANNER_MODE option: the instruction banner can be rendered once to a
+  texture ('texture') or baked into each preloaded stimulus ('composite')
+  instead of drawing text every trial
+10/16/26: Trials are frame-locked (mst_timing.FrameScheduler): Duration and
+  ISI are rounded to whole refreshes at the measured frame rate, each flip
+  goes out on a precomputed deadline so late frames don't drift the run, and
+  intended vs actual flip times are logged after the summary.
+10/16/26: ISI, response-window and flip waits use mst_timing.HybridWait, which
+  sleeps until WAIT_SPIN_MARGIN before the deadline and polls the keyboard at
+  INPUT_POLL_HZ instead of spinning a core all session.  WAIT_STATS logs its
+  CPU use and wake-up lateness.
+10/16/26: Responses come through mst_input.KeyboardInput: RT is the key-down
+  timestamp from psychopy.hardware.keyboard (psychopy.event if that's
+  unavailable) minus the actual onset flip, and key-down vs poll times are
+  logged after the summary.
+10/16/26: Responses can come from a keyboard, serial button box or touch
+  screen (RESPONSE_DEVICES, see mst_input.py); each device is read on its own
+  thread where possible and its input-to-queue latency is logged.  Touch box
+  responses are no longer TBD.
+10/16/26: SCANNER_TR: for fMRI, trial onsets are scheduled against counted
+  scanner triggers (missed / extra pulses detected, TR refit to correct drift)
+  and every trigger is logged after the summary.
+10/16/26: Trial rows have instrumentation columns (LoadT, DrawT, FlipT,
+  OnsetErr, Dropped, LogT; NA rows are padded to line up) and a station timing
+  report with percentiles and an onset-error histogram follows the summary.
+10/16/26: The main routine is now main() so mst_headless.py can run the task
+  with a null window, a virtual clock and a simulated participant (no display
+  or PsychoPy needed).
+10/16/26: Log file is written by a background thread (mst_log.AsyncLog) in
+  batches, at most LOG_MAX_DELAY s behind, and fsynced on close.  File
+  contents unchanged.
+10/16/26: Each run also writes its trials as a typed table (CSV plus Parquet,
+  or .npz without pyarrow) and a JSON params sidecar next to the log; see
+  mst_trials.py.
+10/16/26: Each run keeps an append-only journal (mst_journal.py) of its
+  params, seed, trial lists and completed trials; --resume <journal> carries a
+  crashed or escaped session on from the next trial.
+10/16/26: Scoring (response matrices, lure bins, percent correct, REC, LDI,
+  d') moved to the shared, vectorized mst_scoring.py; the summary is scored
+  from the session's trial table.  Same log text.
+10/17/26: Optional live telemetry (TELEMETRY_ADDRESS): each trial and a
+  running summary go out as a non-blocking UDP datagram, dropped rather than
+  waited on; python mst_telemetry.py is the monitor.  See mst_telemetry.py.
+10/17/26: The log's trial section starts with 'Trials: <n>', the run's trial
+  count (what the raw percent correct is out of), so mst_aggregate.py scores
+  an escaped run as the script would have.
+10/17/26: STIM_SIZE option; the images are loaded (from the resized cache or
+  atlas built for it) at the window's and STIM_SIZE's geometry.
+10/17/26: check_files() takes a complete "Set N.atlas" as the stimulus
+  directory check, and the atlas no longer stats every source file.
 
-"""
-TBD:
-- Touch box responses
 """
 
 import numpy as np
+import argparse
 import csv
 import os
-from psychopy import visual, core, data, tools, event
-from psychopy import gui
+try:
+    from psychopy import visual, core, data, tools, event
+    from psychopy import gui
+except ImportError:  # Only for headless runs (mst_headless.py), which supply their own
+    visual = core = data = tools = event = gui = None
 from datetime import datetime
-from scipy.stats import norm
+from mst_stimuli import load_images, display_geometry, atlas_complete
+from mst_timing import FrameScheduler, TrialTiming
+from mst_input import ResponseInput, open_devices
+from mst_log import AsyncLog
+from mst_trials import TrialTable
+from mst_journal import Journal, read as read_journal
+from mst_scoring import score, summary_text, correct as score_correct
+from mst_telemetry import Telemetry
+
+# Image loading: 'preload' decodes and uploads every image before the start
+# screen, 'prefetch' keeps only the next PREFETCH_DEPTH images decoded on a
+# worker thread and at most TEXTURE_BUDGET_MB of textures (for low-RAM machines)
+IMAGE_LOADING = 'preload'
+PREFETCH_DEPTH = 8
+TEXTURE_BUDGET_MB = 64
+# Instruction banner during trials: 'text' draws the TextStim every trial,
+# 'texture' renders it to an image once, 'composite' bakes it into each
+# stimulus (preload only) so a trial is a single textured quad
+BANNER_MODE = 'text'
+# Stimulus size: None draws each image at its own pixel size; (w, h) in the
+# window's units fits them into that box.  Build the resized cache / atlas for
+# the same size (python mst_stimuli.py --build-cache N --size w h) to use it
+STIM_SIZE = None
+# Waiting (ISI, response window, flips): sleep until WAIT_SPIN_MARGIN s before
+# each deadline and then spin, checking the keyboard INPUT_POLL_HZ times a
+# second.  WAIT_STATS logs CPU use and wake-up lateness so these can be tuned
+# per machine (or run python mst_timing.py)
+WAIT_SPIN_MARGIN = 0.003
+INPUT_POLL_HZ = 500
+WAIT_STATS = False
+# Response devices: any of 'keyboard', 'serial' (button box on SERIAL_PORT,
+# e.g. '/dev/ttyUSB0' or 'COM3') and 'touch' (screen split into one column
+# per response).  TRIGGER_KEYS are keyboard keys that are scanner triggers
+# rather than responses.  See mst_input.py
+RESPONSE_DEVICES = ['keyboard']
+SERIAL_PORT = None
+TRIGGER_KEYS = ['5']
+# fMRI: with SCANNER_TR set (in s), trial onsets are locked to counted scanner
+# triggers instead of the computer's clock (missed / extra triggers and clock
+# drift are handled, and every trigger is logged).  After the start screen
+# the task waits for the scanner and starts SCANNER_DUMMY_TRS pulses later
+SCANNER_TR = None
+SCANNER_DUMMY_TRS = 1
+# The log is written by a background thread in batches; a line is on its way
+# to the disk at most LOG_MAX_DELAY s after it's logged (the most a crash
+# could lose), and the file is fsynced when it's closed
+LOG_MAX_DELAY = 0.5
+# Live telemetry: with TELEMETRY_ADDRESS set to (host, port) -- e.g. the
+# proctor's machine running python mst_telemetry.py -- each completed trial
+# and a running summary go out as a UDP datagram (dropped, never waited on,
+# if it can't be sent).  None = off
+TELEMETRY_ADDRESS = None
 
 def get_parameters(skip_gui=False):
     # Setup my global parameters
@@ -147,7 +260,10 @@ def check_files(SetName):
     if len(bins) != 192:
         raise ValueError('Did not read correct number of bins in binfile')
     
-    # Check the stimulus directory
+    # Check the stimulus directory (a complete "Set N.atlas" stands in for it,
+    # saving 384 file lookups on a network share)
+    if atlas_complete("Set " + str(SetName)):
+        return bins
     img_list=glob.glob("Set " +str(SetName) + os.sep + '*.jpg')
     if len(img_list) < 384:
         raise ValueError('Not enough files in stimulus directory {0}'.format("Set " +str(SetName) + os.sep + '*.jpg'))
@@ -311,7 +427,9 @@ def setup_list_permuted(set_bins):
 
 
 def decode_response(params,response):
-    if params['Resp1Keys'].lower().find(response.lower()) >= 0:
+    if response in ['resp1','resp2','resp3']:  # Button box / touch (see mst_input.py)
+        respcode = int(response[-1])
+    elif params['Resp1Keys'].lower().find(response.lower()) >= 0:
         respcode = 1
     elif params['Resp2Keys'].lower().find(response.lower()) >= 0:
         respcode = 2
@@ -336,7 +454,7 @@ def show_task(params,fnames,type_code,lag,set_bins,nblocks=4):
 
     """
     
-    global log, win
+    global log, win, trials
     total_trials=len(fnames)
     trials_per_block=total_trials // nblocks 
     start_index=trials_per_block * (int(params['Block']) - 1)
@@ -351,236 +469,226 @@ def show_task(params,fnames,type_code,lag,set_bins,nblocks=4):
     instructions2=visual.TextStim(win,text="Press the spacebar to begin",pos=(0,-0.25),
         color=(-0.5,-0.5,-0.5),wrapWidth=1.75,anchorHoriz='center',anchorVert='center')
     
-    instructions1.draw()
-    instructions2.draw()
-    win.flip()
-    key = event.waitKeys(keyList=['space','5','esc','escape'])
-    if key and key[0] in ['escape','esc']:
-        print('Escape  hit - bailing')
-        return -1
-    TLF_trials = np.zeros(3)  # Number of trials of each type we have a response to
-    TLF_response_matrix = np.zeros((3,3))  # Rows = O,(S),N  Cols = T,L,R
-    lure_bin_matrix = np.zeros((4,5)) # Rows: O,S,N,NR  Cols=Lure bins
-    
-    log.write('Task started at {0}\n'.format(str(datetime.now())))
-    log.write('Trial,Stim,Cond,Lag,LBin,StartT,Resp,Corr,RT\n')
-    local_timer = core.MonotonicClock()
-    duration = params['Duration']
-    isi = params['ISI']
-    ncorrect = 0
-    log.flush()
-    valid_keys = list(params['Resp1Keys'].lower()) + list(params['Resp2Keys'].lower()) + list(params['Resp3Keys'].lower()) + ['esc','escape']
+    # Measure the refresh rate and lock Duration / ISI to whole frames
+    sched = FrameScheduler(win, params['Duration'], params['ISI'],
+                           spin_margin=WAIT_SPIN_MARGIN, poll_hz=INPUT_POLL_HZ,
+                           measure=WAIT_STATS, scanner_tr=SCANNER_TR,
+                           dummy_trs=SCANNER_DUMMY_TRS)
+    
+    # Get this block's images loading now so the trial loop just swaps them in
+    images = load_images(win, fnames[start_index:start_index+trials_per_block],
+                         IMAGE_LOADING, PREFETCH_DEPTH, TEXTURE_BUDGET_MB,
+                         BANNER_MODE, instructions1,
+                         geometry=display_geometry(win.size, win.units, STIM_SIZE),
+                         start=trials.n)  # Past the trials already done when resuming
+    responses = None  # The loader and the input are closed however we leave (escape, error)
+    try:
+        banner = images.banner
+    
+        valid_keys = list(params['Resp1Keys'].lower()) + list(params['Resp2Keys'].lower()) + list(params['Resp3Keys'].lower()) + ['esc','escape']
+        devices = open_devices(RESPONSE_DEVICES, win, 2 if params['TwoChoice'] else 3,
+                               SERIAL_PORT, TRIGGER_KEYS)
+        responses = ResponseInput(devices, valid_keys, sched.clock,
+                                  sched.timeline)  # Timestamps inputs for the RTs, counts triggers
     
-    for trial in range(trials_per_block):
-        stim_index=trial+start_index
-        print(trial,stim_index,fnames[stim_index])
-        if params['SelfPaced']:
-            t1=local_timer.getTime()
-        else:
-            t1 = trial * (duration + isi)  # Time when this trial should have started
-        stim_path = fnames[stim_index]
-        stim_number = int(stim_path[-8:-5])
-        log.write('{0},{1},{2},{3},{4},{5:.3f},'.format(stim_index+1,fnames[stim_index],
-                  type_code[stim_index],lag[stim_index],set_bins[stim_number-1],local_timer.getTime()))
-        log.flush()
-        image = visual.ImageStim(win, image=fnames[stim_index])
-        image.draw()
         instructions1.draw()
+        instructions2.draw()
         win.flip()
-        response = 0
-        correct = 0
-        RT=0
-        key = event.waitKeys(duration,keyList=valid_keys)  # Wait our normal duration
+        key = event.waitKeys(keyList=['space','5','esc','escape'])
         if key and key[0] in ['escape','esc']:
-                print('Escape hit - bailing')
-                log.write('\nEscape key aborted experiment\n')
-                return -1
-        elif key:
-            RT=local_timer.getTime() - t1
-            core.wait(t1 + duration - local_timer.getTime()) # Wait the remainder of the trial
-        win.flip() # Clear the screen for the ISI
-        if params['SelfPaced'] and (RT < 0.05):  # Continue waiting until we get something
-            key = event.waitKeys(keyList=valid_keys)
-            RT=local_timer.getTime() - t1
-        if params['SelfPaced']:
-            core.wait(isi)
-        else:  # Do the ISI locking to the clock cleaning and allow a response in it if we don't have one
-            while local_timer.getTime() < (t1 + duration + isi):
+            print('Escape  hit - bailing')
+            return -1
+    
+        log.write('Task started at {0}\n'.format(str(datetime.now())))
+        log.write('Trials: {0}\n'.format(len(fnames)))  # All blocks -- what the raw percent correct is out of
+        log.write('Trial,Stim,Cond,Lag,LBin,StartT,Resp,Corr,RT,{0}\n'.format(TrialTiming.COLUMNS))
+        local_timer = sched.start(responses.poll_escape)  # Waits for the scanner here if SCANNER_TR is set
+        if local_timer is None:
+            print('Escape hit - bailing')
+            log.write('\nEscape key aborted experiment\n')
+            return -1
+        timing = TrialTiming(sched)  # Load / draw / flip / log-write columns
+        duration = sched.duration  # Frame-locked versions of params['Duration'] / ['ISI']
+        isi = sched.isi
+        log.flush()
+    
+        first = trials.n  # Trials already done (when resuming)
+        telemetry.start(trials_per_block, first)
+        for trial in range(first, trials_per_block):
+            stim_index=trial+start_index
+            print(trial,stim_index,fnames[stim_index])
+            if params['SelfPaced']:
+                t1 = sched.next_frame()
+            else:
+                t1 = sched.onset(trial - first)  # Time (on a refresh) when this trial should start
+            stim_path = fnames[stim_index]
+            stim_number = int(stim_path[-8:-5])
+            timing.start()
+            log.write('{0},{1},{2},{3},{4},{5:.3f},'.format(stim_index+1,fnames[stim_index],
+                      type_code[stim_index],lag[stim_index],set_bins[stim_number-1],local_timer.getTime()))
+            log.flush()
+            timing.lap('log')
+            image = images.get(trial)
+            timing.lap('load')
+            image.draw()
+            if banner is not None:
+                banner.draw()
+            timing.lap('draw')
+            responses.clear()
+            onset = sched.flip_at(t1, stim_index)  # When the image actually went up
+            response = 0
+            correct = 0
+            RT=0
+            key = sched.waiter.until(sched.flip_due(t1 + duration), responses.poll, 'response')  # Wait our normal duration
+            if key and key[0] in ['escape','esc']:
+                    print('Escape hit - bailing')
+                    log.write('\nEscape key aborted experiment\n')
+                    return -1
+            elif key:
+                RT=responses.rt(stim_index, onset)
+            sched.flip_at(t1 + duration, stim_index) # Wait the remainder of the trial and clear the screen for the ISI
+            if params['SelfPaced'] and (RT < 0.05):  # Continue waiting until we get something
+                key = sched.waiter.until(float('inf'), responses.poll, 'response')
+                RT=responses.rt(stim_index, onset)
+            if params['SelfPaced']:
+                sched.waiter.until(local_timer.getTime() + isi, label='isi')
+            else:  # Do the ISI locking to the clock cleaning and allow a response in it if we don't have one
+                isi_end = t1 + duration + isi - sched.frame_period  # Leave a frame to get the next image up
                 if (RT < 0.05):
-                    key = event.getKeys(keyList=valid_keys)
+                    key = sched.waiter.until(isi_end, responses.poll, 'isi')
                     if key:
-                        RT=local_timer.getTime() - t1
-        if RT > 0.05: # We have a response
-            response = decode_response(params,key[0])
-            # Increment the appropriate trial type counter (for count of # they responded to)
-            if type_code[stim_index]==1:    # Repeatitions -- 2nd of real repeat
-                TLF_trials[0] += 1
-                trial_type = 1
-            elif type_code[stim_index]==3:  # Lure 2nd presentations
-                TLF_trials[1] += 1
-                trial_type = 2
-            else:  # All others -- 1st of 2 and extra foils are firsts
-                TLF_trials[2] += 1
-                trial_type = 3
-            TLF_response_matrix[response-1,trial_type-1] += 1  # Increment the response x type  matrix as needed
-            if params['TwoChoice']==True:  # Old/new variant
-                if trial_type == 1 and response == 1:  # Hit
-                    correct=1
-                elif trial_type == 2 and response == 2:  #Lure-CR
-                    correct=1
-                elif trial_type == 3 and response == 2:  #CR
-                    correct=1
-            else:  #Old/similar/new variant
-                if trial_type == 1 and response == 1:  # Hit
-                    correct=1
-                elif trial_type == 2 and response == 2:  #Lure-Similar
-                    correct=1
-                elif trial_type == 3 and response == 3:  #CR
-                    correct=1
-            log.write('{0},{1},{2:.3f}\n'.format(response,correct,RT))
-        else:
-            log.write('NA\n')
-        if type_code[stim_index] == 3:  # A 2nd of lure pair - Take care of the lure-bin details
-            bin_index = set_bins[stim_number-1] - 1  # Make it 0-indexed
-            resp_index = response - 1  # Make this 0-indexed
-            if resp_index == -1:
-                resp_index = 3  # Loop the no-responses into the 4th entry here
-            lure_bin_matrix[resp_index,bin_index] += 1
-        win.flip() # Clear the screen for the ISI
-        while local_timer.getTime() < (t1 + duration + isi):
-            key = event.getKeys()
-            #print(key)
-            if key and key[0] in ['escape','esc']:
+                        RT=responses.rt(stim_index, onset)
+                sched.waiter.until(isi_end, label='isi')
+            if RT > 0.05: # We have a response
+                response = decode_response(params,key[0])
+                correct = int(score_correct(type_code[stim_index], response, params['TwoChoice']))
+                log.write('{0},{1},{2:.3f},{3}\n'.format(response,correct,RT,timing.row(stim_index)))
+            else:
+                log.write('NA,NA,NA,{0}\n'.format(timing.row(stim_index)))
+            trials.add(stim_index+1, fnames[stim_index], params['Set'], type_code[stim_index], set_bins[stim_number-1],
+                       onset, response, RT if response else None, correct, lag[stim_index])
+            telemetry.trial(stim_index+1, response, correct, RT if response else None, onset - t1)
+            key = sched.waiter.until(t1 + duration + isi - sched.frame_period, responses.poll_escape, 'isi')
+            if key:
                 print('Escape hit - bailing')
                 log.write('\nEscape key aborted experiment\n')
                 return -1
-        ncorrect += correct
-    # Print some summary stats to the log file
-    log.write('\nValid responses:\nTargets, {0:.0f}\nlures, {1:.0f}\nfoils, {2:.0f}'.format(TLF_trials[0],TLF_trials[1],TLF_trials[2]))
-    log.write('\nCorrected rates\n')
-    log.write('\nRateMatrix,Targ,Lure,Foil\n')
-    # Fix up any no-response cell here so we don't divide by zero
-    TLF_trials[TLF_trials==0.0]=0.00001
-    log.write('Old,{0:.2f},{1:.2f},{2:.2f}\n'.format(
-        TLF_response_matrix[0,0] / TLF_trials[0], 
-        TLF_response_matrix[0,1] / TLF_trials[1],
-        TLF_response_matrix[0,2] /  TLF_trials[2]))
-    log.write('Similar,{0:.2f},{1:.2f},{2:.2f}\n'.format(
-        TLF_response_matrix[1,0] / TLF_trials[0], 
-        TLF_response_matrix[1,1] / TLF_trials[1],
-        TLF_response_matrix[1,2] /  TLF_trials[2]))
-    log.write('New,{0:.2f},{1:.2f},{2:.2f}\n'.format(
-        TLF_response_matrix[2,0] / TLF_trials[0], 
-        TLF_response_matrix[2,1] / TLF_trials[1],
-        TLF_response_matrix[2,2] /  TLF_trials[2]))
-
-    log.write('\nRaw counts')
-    log.write('\nRawRespMatrix,Targ,Lure,Foil\n')
-    log.write('Old,{0:.0f},{1:.0f},{2:.0f}\n'.format(TLF_response_matrix[0,0], TLF_response_matrix[0,1],TLF_response_matrix[0,2]))
-    log.write('Similar,{0:.0f},{1:.0f},{2:.0f}\n'.format(TLF_response_matrix[1,0], TLF_response_matrix[1,1],TLF_response_matrix[1,2]))
-    log.write('New,{0:.0f},{1:.0f},{2:.0f}\n'.format(TLF_response_matrix[2,0], TLF_response_matrix[2,1],TLF_response_matrix[2,2]))
-    
-    log.write('\n\nLureRawRespMatrix,Bin1,Bin2,Bin3,Bin4,Bin5\n')
-    log.write('Old,{0:.0f},{1:.0f},{2:.0f},{3:.0f},{4:.0f}\n'.format(
-        lure_bin_matrix[0,0], lure_bin_matrix[0,1],lure_bin_matrix[0,2],lure_bin_matrix[0,3],lure_bin_matrix[0,4]))
-    log.write('Similar,{0:.0f},{1:.0f},{2:.0f},{3:.0f},{4:.0f}\n'.format(
-        lure_bin_matrix[1,0], lure_bin_matrix[1,1],lure_bin_matrix[1,2],lure_bin_matrix[1,3],lure_bin_matrix[1,4]))
-    log.write('New,{0:.0f},{1:.0f},{2:.0f},{3:.0f},{4:.0f}\n'.format(
-        lure_bin_matrix[2,0], lure_bin_matrix[2,1],lure_bin_matrix[2,2],lure_bin_matrix[2,3],lure_bin_matrix[2,4]))
-    log.write('NR,{0:.0f},{1:.0f},{2:.0f},{3:.0f},{4:.0f}\n'.format(
-        lure_bin_matrix[3,0], lure_bin_matrix[3,1],lure_bin_matrix[3,2],lure_bin_matrix[3,3],lure_bin_matrix[3,4]))
-
-    log.write('\nPercent-correct (corrected),{0:.2}\n'.format(ncorrect / TLF_trials.sum()))
-    log.write('Percent-correct (raw),{0:.2}\n'.format(ncorrect / len(fnames)))
-
-    hit_rate = TLF_response_matrix[0,0] / TLF_trials[0]
-    false_rate = TLF_response_matrix[0,2] / TLF_trials[2]
-    log.write('\nCorrected recognition (REC) (p(Old|Target)-p(Old|Foil)), {0:.2f}'.format(hit_rate - false_rate))
-
-    if params['TwoChoice']==True:
-        log.write('\nTwo-choice test metrics\n')
-        lure_rate = TLF_response_matrix[0,1] / TLF_trials[1]
-        if hit_rate == 0.0:
-            hit_rate = 0.5 / TLF_trials[0]
-        if false_rate == 0.0:
-            false_rate = 0.5 / TLF_trials[2]
-        if lure_rate == 0.0:
-            lure_rate = 0.5 / TLF_trials[1]
-            
-        log.write('Endorsement rates')
-        log.write('Targets: {0:.2f}'.format(hit_rate))
-        log.write('Lures: {0:.2f}'.format(lure_rate))
-        log.write('Foils and Firsts: {0:.2f}'.format(false_rate))
-        
-        
-        dpTF = norm.ppf(hit_rate) - norm.ppf(false_rate)
-        dpTL = norm.ppf(hit_rate) - norm.ppf(lure_rate)
-        dpLF = norm.ppf(lure_rate) - norm.ppf(false_rate)
-        
-        log.write("d' Target:Foil, {0:.2f}".format(dpTF))
-        log.write("d' Target:Lure, {0:.2f}".format(dpTL))
-        log.write("d' Lure:Foil, {0:.2f}".format(dpLF))
-    else:
-        log.write('\nThree-choice test metrics\n')
-        sim_lure_rate = TLF_response_matrix[1,1] / TLF_trials[1]
-        sim_foil_rate = TLF_response_matrix[1,2] / TLF_trials[2]
-        log.write('LDI,{0:.2f}'.format(sim_lure_rate - sim_foil_rate))
-    log.flush()
-    return 0
+        # Score the whole session (including any trials from before a resume)
+        columns = dict(trials.arrays())
+        scores = score(columns['type_code'], columns['response'], columns['lure_bin'],
+                       params['TwoChoice'], n_trials=len(fnames))
+        log.write(summary_text(scores, params['TwoChoice']))
+        log.write(timing.summary())
+        log.write(images.summary())
+        log.write(sched.summary())
+        log.write(responses.summary())
+        log.flush()
+        return 0
+    finally:
+        images.close()
+        if responses is not None:
+            responses.close()
  
     
     
     
 # ------------------------------------------------------------------------    
 # Main routine
-params = get_parameters()
-print(params)
-# Set our random seed
-if params['Randomization'] == -1:
-    seed = params['ID']
-elif params['Randomization']==0:
-    seed = None
-else:
-    seed = params['Randomization']
-np.random.seed(seed)
-
-# Get my log file going in append mode
-log = open('MST_{0}.txt'.format(params['ID']),"a+")
-log.write('MST Task\nStarted at {0}\n'.format(str(datetime.now())))
-log.write('ID: {0}\n'.format(params['ID']))
-log.write('Duration: {0}\n'.format(params['Duration']))
-log.write('ISI: {0}\n'.format(params['ISI']))
-log.write('Set: {0}\n'.format(params['Set']))
-log.write('Lag set: {0}\n'.format(params['LagSet']))
-log.write('Order: {0}\n'.format(params['Order']))
-log.write('Respkeys: {0} {1} {2}\n'.format(params['Resp1Keys'],params['Resp1Keys'],params['Resp1Keys']))
-log.write('Self-paced: {0}\n'.format(params['SelfPaced']))
-log.write('Two-choice: {0}\n'.format(params['TwoChoice']))
-log.write('Rnd-mode: {0} with seed {1}\n'.format(params['Randomization'],seed))
-log.write('Raw params: {0}'.format(params))
-log.write('\n\n')
-log.flush()
-
-
-# Load up the bin file and check the stimulus directory.  Note, the set_bins
-# is such that 001a/b.jpg will be first, 002a/b.jpg will be second, etc. 
-# So, row = stimulus filename number      
-set_bins = np.array(check_files(params['Set']))
-
-# Figure out which stimuli will be shown in which conditions and order them
-(repeat_list, lure_list, foil_list) = setup_list_permuted(set_bins)
-
-# Load up the order file and decode it, creating all the needed vectors
-(type_code,ideal_resp,lag,fnames)=load_and_decode_order(repeat_list,
-        lure_list,foil_list,lag_set=params['LagSet'],
-        order=params['Order'], stim_set=params['Set'])
-
-
-
-win = visual.Window([800, 800], monitor='testMonitor',color='white')
-
-show_task(params,fnames,type_code,lag,set_bins)
-    
-win.close()  
-log.close()
-core.quit()
+def main(params=None, window=None, log_file=None, resume=None):
+    """
+    Runs the task.  Normally the parameters come from the dialog, the log
+    is MST_<ID>.txt and it runs in a PsychoPy window; mst_headless.py passes
+    its own of each to run a simulated participant without a display.
+    resume: a session's .journal -- carries on after its last completed
+    trial with its params and lists (see mst_journal.py)
+    """
+    global log, win, trials, telemetry
+    if resume:
+        (session, done_rows, finished) = read_journal(resume)
+        if finished:
+            print('{0}: that session already ran to the end'.format(resume))
+            return -1
+        params = session['params']
+    elif params is None:
+        params = get_parameters()
+    print(params)
+    # Set our random seed
+    if params['Randomization'] == -1:
+        seed = params['ID']
+    elif params['Randomization']==0:
+        seed = None
+    else:
+        seed = params['Randomization']
+    np.random.seed(seed)
+
+    # Get my log file going in append mode
+    log = AsyncLog(log_file or 'MST_{0}.txt'.format(params['ID']), LOG_MAX_DELAY)
+    log.write('MST Task\nStarted at {0}\n'.format(str(datetime.now())))
+    log.write('ID: {0}\n'.format(params['ID']))
+    log.write('Duration: {0}\n'.format(params['Duration']))
+    log.write('ISI: {0}\n'.format(params['ISI']))
+    log.write('Set: {0}\n'.format(params['Set']))
+    log.write('Lag set: {0}\n'.format(params['LagSet']))
+    log.write('Order: {0}\n'.format(params['Order']))
+    log.write('Respkeys: {0} {1} {2}\n'.format(params['Resp1Keys'],params['Resp1Keys'],params['Resp1Keys']))
+    log.write('Self-paced: {0}\n'.format(params['SelfPaced']))
+    log.write('Two-choice: {0}\n'.format(params['TwoChoice']))
+    log.write('Rnd-mode: {0} with seed {1}\n'.format(params['Randomization'],seed))
+    log.write('Raw params: {0}'.format(params))
+    if resume:
+        log.write('\nResuming {0} after {1} trials'.format(resume, len(done_rows)))
+    log.write('\n\n')
+    log.flush()
+
+
+    # Load up the bin file and check the stimulus directory.  Note, the set_bins
+    # is such that 001a/b.jpg will be first, 002a/b.jpg will be second, etc. 
+    # So, row = stimulus filename number      
+    set_bins = np.array(check_files(params['Set']))
+
+    if resume:  # The lists exactly as they were shown
+        lists = session['lists']
+        (type_code,lag,fnames) = (np.array(lists['type_code']),np.array(lists['lag']),lists['fnames'])
+    else:
+        # Figure out which stimuli will be shown in which conditions and order them
+        (repeat_list, lure_list, foil_list) = setup_list_permuted(set_bins)
+
+        # Load up the order file and decode it, creating all the needed vectors
+        (type_code,ideal_resp,lag,fnames)=load_and_decode_order(repeat_list,
+                lure_list,foil_list,lag_set=params['LagSet'],
+                order=params['Order'], stim_set=params['Set'])
+
+    # Typed trial table + params next to the log, and the journal to resume from
+    trials = TrialTable(log.name, params, base=session['table'] if resume else None,
+                        seed=seed, script=os.path.basename(__file__))
+    journal = Journal(trials.base + '.journal', LOG_MAX_DELAY)
+    if resume:
+        trials.restore(done_rows)
+        journal.resumed(trials.n)
+    else:
+        journal.start(os.path.basename(__file__), params, seed, trials.base,
+                      fnames=fnames, type_code=type_code, lag=lag)
+    trials.journal = journal
+    telemetry = Telemetry(TELEMETRY_ADDRESS, os.path.basename(__file__), params, trials.base)
+
+
+
+    win = window or visual.Window([800, 800], monitor='testMonitor',color='white')
+
+    status = show_task(params,fnames,type_code,lag,set_bins)
+    if status == 0:
+        journal.done()
+    telemetry.close(status == 0)
+
+    journal.close()
+    trials.close()
+    win.close()  
+    log.close()
+    core.quit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mnemonic Similarity Task')
+    parser.add_argument('--resume', metavar='JOURNAL',
+                        help="carry on a crashed / escaped session from its .journal file")
+    main(resume=parser.parse_args().resume)
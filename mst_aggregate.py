@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+"""
+Batch log parser and cohort aggregator for the MST.
+
+Finds the text logs under the given files / directories -- MST_<ID>.txt
+from the PsychoPy versions and MSTlog_<ID>.txt from the C++ standalone --
+splits each into its sessions (both append every run to the same file),
+parses them in a process pool and writes two tables:
+
+    <out>_trials.csv   one row per trial: log, session, id plus the
+                       mst_trials.COLUMNS (type codes, responses, RTs in s)
+    <out>_sessions.csv one row per session: what was run, whether it was
+                       aborted, and the scores from mst_scoring.score() --
+                       percent correct, REC, LDI, endorsement rates, d'
+                       and the response rates for each lure bin
+(each also as .parquet, or .npz without pyarrow -- see mst_trials.write_table)
+
+Any version of the PsychoPy logs is fine: old single 'NA' and newer padded
+NA,NA,NA no-response rows, with or without the timing columns, and the
+trial row a run was escaped on (left half-written) is dropped.  A session
+picked up again with --resume is joined to the trials it was resumed from,
+and the escaped session it replaces is left out.  Study sessions get a row
+in the session table but no scores; two-choice sessions get no LDI, dpTL or
+dpLF (their response 2 is new, not similar).  pc_raw is out of the run's
+trial count, as in the scripts -- from the log's 'Trials:' line, or for
+older logs the trials logged (x4 for an 80x4 block), and nan for an older
+escaped run whose count isn't known.
+
+The parsed sessions are kept in <out>.cache (a pickle, one entry per log
+keyed by its path, size, mtime and SHA-1), so a re-run only parses the logs
+that are new or changed since the last one -- the ones with the same size
+and mtime aren't even read, and one that was touched but not changed is
+just hashed.  Logs that have gone are dropped, and if nothing changed the
+tables aren't rewritten.  --no-cache parses everything (and leaves the
+cache alone).
+
+Usage:
+    python mst_aggregate.py data/ -o cohort
+    python mst_aggregate.py data/ old_data/MSTlog_*.txt -o cohort --jobs 8
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import ast
+import fnmatch
+import hashlib
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+import numpy as np
+
+from mst_scoring import score
+from mst_trials import COLUMNS, COND_CODES, pyarrow, write_table
+
+LOG_PATTERNS = ['MST_*.txt', 'MSTlog_*.txt']
+CPP_COND_CODES = {'T': 1, 'L': 3, 'F': 4}
+RESP_FIELDS = ['Resp', 'RT', 'Corr', 'Acc']  # Response columns, in whatever order a header has them
+
+SESSION_COLUMNS = ([('log', 'str'), ('session', 'int32'), ('source', 'str'),
+                    ('id', 'str'), ('kind', 'str'), ('set', 'str'),
+                    ('two_choice', 'bool'), ('self_paced', 'bool'),
+                    ('started', 'str'), ('aborted', 'bool'), ('resumed', 'bool'),
+                    ('n_trials', 'int32'), ('n_responses', 'int32')] +
+                   [(name, 'float64') for name in ['pc_corrected', 'pc_raw', 'REC', 'LDI',
+                                                    'hit_rate', 'lure_rate', 'false_rate',
+                                                    'dpTF', 'dpTL', 'dpLF']] +
+                   [('L{0}_{1}'.format(b + 1, resp), 'float64')
+                    for b in range(5) for resp in ['old', 'similar', 'new', 'nr']])
+TRIAL_COLUMNS = [('log', 'str'), ('session', 'int32'), ('id', 'str')] + COLUMNS
+
+N_BLOCKS_80X4 = 4  # The 80x4 version scores each block out of all four blocks' trials
+TWO_CHOICE_NAN = ['LDI', 'dpTL', 'dpLF']  # Need similar responses / lures told from targets
+
+CACHE_VERSION = 2  # Bump when the parser or the session dicts change, so old caches are ignored
+
+
+def find_logs(paths):
+    """ Log files named on the command line or found under directories there, sorted """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for pattern in LOG_PATTERNS:
+                    found.update(os.path.join(root, f) for f in fnmatch.filter(files, pattern))
+        elif os.path.isfile(path):
+            found.add(path)
+    return sorted(found)
+
+
+def split_sessions(lines):
+    """ Splits a log's lines wherever a run started ('MST Task' / 'MST version ...') """
+    sessions = []
+    for line in lines:
+        if line.startswith('MST Task') or line.startswith('MST version'):
+            sessions.append([])
+        if sessions:
+            sessions[-1].append(line)
+    return sessions
+
+
+def _new_session(source):
+    return {'source': source, 'id': '', 'kind': '', 'set': '', 'two_choice': False,
+            'self_paced': False, 'started': '', 'aborted': False, 'resumed': False,
+            'resume_after': None, 'n_run': None, 'block': None, 'rows': []}
+
+
+def parse_psychopy(lines):
+    """ One session from a PsychoPy log (the lines from 'MST Task' on) """
+    session = _new_session('psychopy')
+    header = None
+    for line in lines:
+        if header is None:
+            key, sep, value = line.partition(':')
+            if line.startswith('Started at '):
+                session['started'] = line[len('Started at '):]
+            elif line.startswith('Raw params: '):
+                try:
+                    params = ast.literal_eval(line[len('Raw params: '):])
+                except (ValueError, SyntaxError):
+                    params = {}
+                session['id'] = str(params.get('ID', session['id']))
+                session['set'] = str(params.get('Set', session['set']))
+                session['two_choice'] = bool(params.get('TwoChoice', session['two_choice']))
+                session['self_paced'] = bool(params.get('SelfPaced', session['self_paced']))
+                session['block'] = params.get('Block')
+            elif line.startswith('Resuming '):
+                session['resumed'] = True
+                session['resume_after'] = int(line.split()[-2])
+            elif line.startswith('Study phase started'):
+                session['kind'] = 'study'
+            elif line.startswith('Test phase started'):
+                session['kind'] = 'test'
+            elif line.startswith('Task started'):
+                session['kind'] = 'continuous'
+            elif line.startswith('Trial,'):
+                header = line.split(',')
+            elif sep and key == 'Trials':
+                session['n_run'] = int(value)
+            elif sep and key in ('ID', 'Set'):
+                session[key.lower()] = value.strip()
+            elif sep and key in ('Two-choice', 'Self-paced'):
+                session[key.lower().replace('-', '_')] = value.strip() == 'True'
+            continue
+        if line.startswith('Escape key aborted'):
+            session['aborted'] = True
+            break
+        if not line:
+            continue
+        if not line[:1].isdigit():  # Summary / timing blocks
+            break
+        fields = line.split(',')
+        row = _psychopy_row(header, fields, session)
+        if row is not None:
+            session['rows'].append(row)
+    else:  # No summary -- crashed (older versions wrote nothing after a study phase)
+        session['aborted'] = header is not None and session['kind'] != 'study'
+    return session
+
+
+def _psychopy_row(header, fields, session):
+    """ A trial row -> a dict of COLUMNS (None for a half-written row) """
+    start = header.index('StartT') + 1
+    if len(fields) <= start or fields[start] == '':
+        return None  # Escaped before the response was written
+    values = dict(zip(header[:start], fields[:start]))
+    n_resp = sum(1 for name in header[start:start + 3] if name in RESP_FIELDS)
+    if fields[start] == 'NA':
+        response, correct, rt = 0, -1, np.nan
+    elif n_resp == 2:  # Study: Resp,RT
+        response, correct, rt = int(fields[start]), -1, float(fields[start + 1])
+    else:  # The scripts always wrote response,correct,RT (whatever the header said)
+        response, correct, rt = int(fields[start]), int(fields[start + 1]), float(fields[start + 2])
+    timing = dict(zip(header[start + n_resp:], fields[start + n_resp:]))
+    onset = timing.get('FlipT', values['StartT'])
+    cond = values['Cond']
+    fname = values['Stim']
+    return {'trial': int(values['Trial']), 'stim': int(fname[-8:-5]), 'fname': fname,
+            'set': session['set'],
+            'type_code': COND_CODES[cond] if cond in COND_CODES else int(cond),
+            'lag': int(values.get('Lag', -1)), 'lure_bin': int(values.get('LBin', -1)),
+            'onset': float(onset) if onset != 'NA' else np.nan,
+            'response': response, 'rt': rt, 'correct': correct}
+
+
+def parse_cpp(lines):
+    """ One session from a C++ standalone log (the lines from 'MST version' on) """
+    session = _new_session('cpp')
+    header = None
+    if len(lines) > 1:
+        session['started'] = lines[1]
+    for line in lines:
+        if header is None:
+            if line.startswith('ID: '):
+                session['id'] = line[4:].strip()
+            elif line.startswith('Set: '):
+                session['set'] = line[5:].strip()
+            elif line.startswith('Dur: '):
+                session['self_paced'] = 'Self-paced:1' in line
+            elif line.startswith('Study phase started'):
+                session['kind'] = 'study'
+            elif 'Test phase started' in line:
+                session['kind'] = 'test'
+                session['two_choice'] = line.startswith('O/N')
+            elif line.startswith('Trial\t'):
+                header = line.split('\t')
+            continue
+        if line.startswith('*****'):
+            session['aborted'] = True
+            break
+        if not line[:1].isdigit():
+            break
+        values = dict(zip(header, line.split('\t')))
+        response = int(values['Resp'])
+        if session['two_choice'] and response == 3:  # The C++ version takes 2 and 3 as new
+            response = 2
+        name = values['Img']
+        session['rows'].append({
+            'trial': int(values['Trial']), 'stim': int(name[:3]), 'fname': name,
+            'set': session['set'],
+            'type_code': CPP_COND_CODES.get(values.get('Cond'), 0),  # Study: all 1st presentations
+            'lag': -1, 'lure_bin': int(values.get('LBin', -1)), 'onset': np.nan,
+            'response': response,
+            'rt': int(values['RT']) / 1000.0 if response else np.nan,
+            'correct': int(values['Acc']) if response and 'Acc' in values else -1})
+    return session
+
+
+def parse_file(fname):
+    """
+    All the sessions in one log, each scored.  A resumed session gets the
+    trials it resumed from and the escaped session it replaces is dropped
+    (session numbers are each session's place in the log, so there's a gap).
+    """
+    with open(fname) as f:
+        lines = f.read().splitlines()
+    sessions = []
+    for i, session_lines in enumerate(split_sessions(lines)):
+        if session_lines[0].startswith('MST version'):
+            session = parse_cpp(session_lines)
+        else:
+            session = parse_psychopy(session_lines)
+        session['log'] = fname
+        session['session'] = i + 1
+        if session['resume_after'] is not None:
+            for earlier in reversed(sessions):
+                if earlier['aborted'] and earlier['id'] == session['id']:
+                    session['rows'] = earlier['rows'][:session['resume_after']] + session['rows']
+                    sessions.remove(earlier)
+                    break
+        sessions.append(session)
+    for session in sessions:
+        session['scores'] = None
+        if session['kind'] != 'study' and session['rows']:
+            n_run = run_trials(session)
+            scores = score([row['type_code'] for row in session['rows']],
+                           [row['response'] for row in session['rows']],
+                           [row['lure_bin'] for row in session['rows']],
+                           session['two_choice'], n_trials=n_run)
+            if n_run is None:
+                scores['pc_raw'] = np.nan
+            if session['two_choice']:
+                for name in TWO_CHOICE_NAN:
+                    scores[name] = np.nan
+            session['scores'] = scores
+    return sessions
+
+
+def run_trials(session):
+    """ What the session's raw percent correct is out of, as in the scripts (None if unknown) """
+    if session['n_run'] is not None:
+        return session['n_run']
+    if session['source'] == 'cpp' or not session['aborted']:
+        return len(session['rows']) * (N_BLOCKS_80X4 if session['block'] is not None else 1)
+    return None
+
+
+def session_row(session):
+    """ A parsed session -> its row of SESSION_COLUMNS """
+    row = dict((name, session[name]) for name, dtype in SESSION_COLUMNS[:11])
+    row['n_trials'] = len(session['rows'])
+    row['n_responses'] = sum(1 for trial in session['rows'] if trial['response'] > 0)
+    scores = session['scores']
+    for name, dtype in SESSION_COLUMNS[13:]:
+        row[name] = np.nan
+    if scores is not None:
+        for name in ['pc_corrected', 'pc_raw', 'REC', 'LDI', 'hit_rate', 'lure_rate',
+                     'false_rate', 'dpTF', 'dpTL', 'dpLF']:
+            row[name] = scores[name]
+        for b in range(5):
+            for r, resp in enumerate(['old', 'similar', 'new', 'nr']):
+                row['L{0}_{1}'.format(b + 1, resp)] = scores['lure_bin_rates'][r, b]
+    return row
+
+
+def to_arrays(rows, columns):
+    """ [dict] -> [(name, typed array)] """
+    return [(name, np.array([row[name] for row in rows], dtype=dtype)) for name, dtype in columns]
+
+
+class LogCache(object):
+    """
+    Parsed sessions of each log from the last run, keyed by the log's path
+    with its size, mtime and SHA-1 as the fingerprint.
+
+    fname: cache file (missing, unreadable or from another CACHE_VERSION =
+        start empty)
+    """
+
+    def __init__(self, fname):
+        self.name = fname
+        self.entries = {}
+        self.parsed = 0
+        self.changed = False  # Needs saving
+        self.updated = False  # Sessions added, changed or dropped (the tables need rewriting)
+        try:
+            with open(fname, 'rb') as f:
+                cache = pickle.load(f)
+            if cache.get('version') == CACHE_VERSION:
+                self.entries = cache['entries']
+        except (IOError, OSError, EOFError, ValueError, KeyError, AttributeError,
+                pickle.UnpicklingError):
+            pass
+
+    def lookup(self, fname):
+        """
+        (sessions, None) if the log's size and mtime are the same as last
+        time, else (None, SHA-1 last time or None)
+        """
+        entry = self.entries.get(fname)
+        if entry is None:
+            return None, None
+        stat = os.stat(fname)
+        if (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime):
+            return entry['sessions'], None
+        return None, entry['sha1']
+
+    def store(self, fname, fingerprint, sessions):
+        """ fingerprint: (size, mtime, sha1) when the log was read """
+        entry = self.entries.get(fname)
+        if entry is None or entry['sha1'] != fingerprint[2]:
+            self.parsed += 1
+            self.updated = True
+        self.entries[fname] = dict(zip(['size', 'mtime', 'sha1'], fingerprint), sessions=sessions)
+        self.changed = True
+
+    def prune(self, fnames):
+        """ Drops the logs that aren't in fnames any more """
+        keep = set(fnames)
+        for fname in list(self.entries):
+            if fname not in keep:
+                del self.entries[fname]
+                self.changed = self.updated = True
+
+    def save(self):
+        """ Writes the cache (to a temporary file first, so a crash can't leave half of one) """
+        temp = self.name + '.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'entries': self.entries}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        getattr(os, 'replace', os.rename)(temp, self.name)
+
+
+def fingerprint(fname):
+    """
+    (size, mtime, SHA-1) of a log.  It's stat'ed before it's read, so a log
+    that's written to while it's hashed shows up as changed next time.
+    """
+    stat = os.stat(fname)
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return stat.st_size, stat.st_mtime, sha1.hexdigest()
+
+
+def _parse_changed(job):
+    """ (log, SHA-1 last time) -> (fingerprint, sessions, or None if the contents are the same) """
+    fname, old_sha1 = job
+    stamp = fingerprint(fname)
+    if stamp[2] == old_sha1:
+        return stamp, None
+    return stamp, parse_file(fname)
+
+
+def _map(function, jobs_list, jobs):
+    if jobs == 1 or len(jobs_list) < 2:
+        return [function(job) for job in jobs_list]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunk = max(1, len(jobs_list) // (4 * (jobs or multiprocessing.cpu_count())))
+        return pool.map(function, jobs_list, chunksize=chunk)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def aggregate(fnames, jobs=None, cache=None):
+    """
+    Parses the logs (in a pool of jobs processes; 1 = in this one) -> list
+    of sessions.  With a LogCache, only the logs that are new or changed
+    are parsed, and the cache is updated to match fnames.
+    """
+    if cache is None:
+        results = _map(parse_file, fnames, jobs)
+    else:
+        results = []
+        todo = []
+        for i, fname in enumerate(fnames):
+            sessions, old_sha1 = cache.lookup(fname)
+            results.append(sessions)
+            if sessions is None:
+                todo.append((i, fname, old_sha1))
+        parsed = _map(_parse_changed, [(fname, old_sha1) for i, fname, old_sha1 in todo], jobs)
+        for (i, fname, old_sha1), (stamp, sessions) in zip(todo, parsed):
+            if sessions is None:  # Touched, not changed
+                sessions = cache.entries[fname]['sessions']
+            cache.store(fname, stamp, sessions)
+            results[i] = sessions
+        cache.prune(fnames)
+    return [session for sessions in results for session in sessions]
+
+
+def write_cohort(sessions, out):
+    """ Writes <out>_trials and <out>_sessions; returns the file names """
+    trial_rows = []
+    for session in sessions:
+        for row in session['rows']:
+            trial_rows.append(dict(row, log=session['log'], session=session['session'],
+                                   id=session['id']))
+    names = write_table(out + '_trials', to_arrays(trial_rows, TRIAL_COLUMNS))
+    names += write_table(out + '_sessions', to_arrays([session_row(s) for s in sessions],
+                                                      SESSION_COLUMNS))
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Parse MST logs (PsychoPy and C++ versions) into cohort trial and session tables')
+    parser.add_argument('paths', nargs='+', help='log files and/or directories to search')
+    parser.add_argument('-o', '--out', default='mst_cohort',
+                        help='output name (default mst_cohort -> mst_cohort_trials.csv, ...)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU; 1 = no pool)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="parse every log (don't read or update <out>.cache)")
+    args = parser.parse_args()
+
+    fnames = [os.path.normpath(fname) for fname in find_logs(args.paths)]
+    if not fnames:
+        print('No MST_*.txt / MSTlog_*.txt logs found', file=sys.stderr)
+        return 1
+    start = time.time()
+    cache = None if args.no_cache else LogCache(args.out + '.cache')
+    sessions = aggregate(fnames, args.jobs, cache)
+    parsed = time.time() - start
+    n_parsed = len(fnames) if cache is None else cache.parsed
+    outputs = [args.out + table + ext for table in ['_trials', '_sessions']
+               for ext in ['.csv', '.parquet' if pyarrow is not None else '.npz']]
+    if cache is not None and not cache.updated and all(os.path.exists(name) for name in outputs):
+        names = []  # Nothing new -- the tables from last time are up to date
+    else:
+        names = write_cohort(sessions, args.out)
+    if cache is not None and cache.changed:
+        cache.save()
+    elapsed = time.time() - start
+    n_trials = sum(len(session['rows']) for session in sessions)
+    print('{0} sessions ({1} trials) from {2} files, {3} parsed: {4:.2f} s ({5:.0f} sessions/s), '
+          '{6:.2f} s with writing{7}'.format(len(sessions), n_trials, len(fnames), n_parsed, parsed,
+                                              len(sessions) / max(parsed, 1e-9), elapsed,
+                                              '' if names else ' (tables unchanged)'),
+          file=sys.stderr)
+    for name in names:
+        print(name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Bootstrap confidence intervals for the MST scores of a whole cohort.
+
+Takes the tables mst_aggregate.py writes (<cohort>_trials / _sessions),
+scores every test session at once (mst_scoring.response_counts() and
+sdt_metrics()) and resamples each session's trials with replacement to get
+percentile CIs for REC, LDI, the endorsement rates and the three d's:
+
+    <out>_sessions.csv  one row per session: log, session, id, group,
+                        n_trials and, for each metric, the score and its
+                        CI (<metric>, <metric>_lo, <metric>_hi)
+    <out>_groups.csv    one row per group: n_sessions and, for each metric,
+                        the mean over the group's sessions and its CI
+(each also as .parquet, or .npz without pyarrow -- see mst_trials.write_table)
+
+A session's scores only depend on its response x trial-kind counts, so
+resampling its n trials is the same as drawing the 12 counts from a
+multinomial with the observed proportions (no responses lumped into one
+cell, as they don't enter the scores) -- one draw per resample, all the
+resamples of a chunk of sessions in one call, with no trial arrays built at
+all.  A group's CI is a two-level bootstrap: each resample takes the
+group's sessions with replacement, each scored from its own trial
+resample.  Chunks of sessions go out to a process pool, each chunk with
+its own random stream (spawned from --seed), so the result doesn't depend
+on the number of processes.
+
+Groups come from a CSV with 'id' and 'group' columns (--groups); without
+one every session is in group 'all'.  Two-choice sessions make up groups of
+their own ('<group> (two-choice)') with no LDI, dpTL or dpLF -- their
+response 2 is new, not similar.  Study sessions are left out, as are
+escaped sessions a resume carried on (mst_aggregate.py leaves those out of
+the tables).
+
+Usage:
+    python mst_aggregate.py data/ -o cohort
+    python mst_bootstrap.py cohort -o cohort_ci --groups groups.csv
+    python mst_bootstrap.py cohort -n 10000 --ci 90 --jobs 8 --seed 1
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import csv
+import multiprocessing
+import sys
+import time
+import numpy as np
+
+from mst_aggregate import SESSION_COLUMNS, TRIAL_COLUMNS, TWO_CHOICE_NAN
+from mst_scoring import response_counts, sdt_metrics
+from mst_trials import read_table, write_table
+
+METRICS = ['REC', 'LDI', 'hit_rate', 'lure_rate', 'false_rate', 'dpTF', 'dpTL', 'dpLF']
+CHUNK_SESSIONS = 50  # Sessions per pool job (fewer if that's more than DRAWS_PER_CHUNK)
+DRAWS_PER_CHUNK = 1000000  # Session resamples per job -- ~100 MB of counts
+
+
+def _bootstrap_chunk(job):
+    """
+    Resamples one chunk of sessions.  Returns each session's CI bounds
+    (metrics x sessions x 2) and, for each group, the sum of the chunk's
+    weighted resampled scores (metrics x groups x resamples).  A d' from
+    all-old responses to both kinds is inf - inf = nan here, as in score().
+    """
+    counts, weights, group, n_groups, percentiles, seed = job
+    rng = np.random.default_rng(seed)
+    n_boot = weights.shape[0]
+    # Old/similar/new x kind, and no responses (which don't enter the scores) as one cell
+    cells = np.concatenate([counts[:, :3, :].reshape(len(counts), 9),
+                            counts[:, 3, :].sum(axis=1)[:, np.newaxis]], axis=1)
+    n = cells.sum(axis=1)
+    draws = rng.multinomial(n[:, np.newaxis], (cells / n[:, np.newaxis])[:, np.newaxis, :],
+                            size=(len(counts), n_boot))[..., :9]
+    bounds = np.empty((len(METRICS), len(counts), 2))
+    sums = np.zeros((len(METRICS), n_groups, n_boot))
+    with np.errstate(invalid='ignore'):
+        resampled = sdt_metrics(draws.reshape(len(counts), n_boot, 3, 3))
+        for m, name in enumerate(METRICS):
+            values = resampled[name]
+            bounds[m] = np.percentile(values, percentiles, axis=1).T
+            # Sessions not taken in a resample have weight 0 (and mustn't turn an inf d' into nan)
+            weighted = np.where(weights.T > 0, weights.T * values, 0.0)
+            np.add.at(sums[m], group, weighted)
+    return bounds, sums
+
+
+def bootstrap(counts, group=None, n_boot=10000, ci=95.0, seed=None, jobs=None):
+    """
+    counts: (n_sessions, 4, 3) response x kind counts (response_counts())
+    group: each session's group index (default: all in group 0)
+    Returns (scores, session_ci, group_scores, group_ci), dicts by metric:
+        scores        (n_sessions,) each session's score
+        session_ci    (n_sessions, 2) its CI (lower, upper)
+        group_scores  (n_groups,) mean score of each group's sessions
+        group_ci      (n_groups, 2) its CI
+    """
+    counts = np.asarray(counts)
+    n_sessions = len(counts)
+    group = np.zeros(n_sessions, dtype=int) if group is None else np.asarray(group, dtype=int)
+    n_groups = group.max() + 1 if n_sessions else 0
+    sizes = np.bincount(group, minlength=n_groups)
+    percentiles = [50 - ci / 2, 50 + ci / 2]
+    seeds = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seeds.spawn(1)[0])
+
+    # Which of its group's sessions each resample takes (and how many times)
+    weights = np.zeros((n_boot, n_sessions), dtype=np.int32)
+    for g in range(n_groups):
+        members = np.flatnonzero(group == g)
+        weights[:, members] = rng.multinomial(len(members), np.full(len(members), 1.0 / len(members)),
+                                              size=n_boot)
+
+    size = max(1, min(CHUNK_SESSIONS, DRAWS_PER_CHUNK // n_boot))  # Not from jobs: same chunks, same streams
+    starts = range(0, n_sessions, size)
+    chunk_seeds = seeds.spawn(len(starts))
+    job_list = [(counts[i:i + size], weights[:, i:i + size], group[i:i + size], n_groups,
+                 percentiles, chunk_seed) for i, chunk_seed in zip(starts, chunk_seeds)]
+    if jobs == 1 or len(job_list) < 2:
+        results = [_bootstrap_chunk(job) for job in job_list]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_bootstrap_chunk, job_list)
+        finally:
+            pool.close()
+            pool.join()
+
+    with np.errstate(invalid='ignore'):
+        scores = sdt_metrics(counts)
+    session_ci = {}
+    group_scores = {}
+    group_ci = {}
+    for m, name in enumerate(METRICS):
+        session_ci[name] = np.concatenate([bounds[m] for bounds, sums in results]) if results \
+            else np.empty((0, 2))
+        group_scores[name] = np.bincount(group, scores[name], minlength=n_groups) / sizes
+        group_sums = sum(sums[m] for bounds, sums in results)
+        with np.errstate(invalid='ignore'):
+            group_ci[name] = np.percentile(group_sums / sizes[:, np.newaxis], percentiles, axis=1).T \
+                if results else np.empty((0, 2))
+    return scores, session_ci, group_scores, group_ci
+
+
+def read_groups(fname):
+    """ id -> group from a CSV with 'id' and 'group' columns """
+    with open(fname) as f:
+        return dict((row['id'], row['group']) for row in csv.DictReader(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bootstrap CIs for REC, LDI and d\' of each session and group of an MST cohort')
+    parser.add_argument('cohort', help='tables from mst_aggregate.py (its -o, e.g. mst_cohort)')
+    parser.add_argument('-o', '--out', default=None, help='output name (default <cohort>_ci)')
+    parser.add_argument('--groups', default=None, help="CSV with 'id' and 'group' columns")
+    parser.add_argument('-n', '--resamples', type=int, default=10000, help='default 10000')
+    parser.add_argument('--ci', type=float, default=95.0, help='CI width in percent (default 95)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU; 1 = no pool)')
+    args = parser.parse_args()
+    out = args.out or args.cohort + '_ci'
+
+    sessions = read_table(args.cohort + '_sessions', SESSION_COLUMNS)
+    trials = read_table(args.cohort + '_trials', TRIAL_COLUMNS)
+    keys = list(zip(sessions['log'].tolist(), sessions['session'].tolist()))
+    tested = [i for i, kind in enumerate(sessions['kind'].tolist())
+              if kind != 'study' and sessions['n_trials'][i] > 0]
+    index = dict((keys[i], n) for n, i in enumerate(tested))
+    trial_session = np.array([index.get(key, -1) for key in
+                              zip(trials['log'].tolist(), trials['session'].tolist())], dtype=int)
+    keep = trial_session >= 0
+    counts = response_counts(trial_session[keep], trials['type_code'][keep],
+                             trials['response'][keep], len(tested))
+
+    ids = [str(sessions['id'][i]) for i in tested]
+    two_choice = sessions['two_choice'][tested].astype(bool)
+    groups = read_groups(args.groups) if args.groups else {}
+    session_groups = [groups.get(i, 'all') + (' (two-choice)' if tc else '')
+                      for i, tc in zip(ids, two_choice)]
+    group_names = sorted(set(session_groups))
+    group = np.array([group_names.index(name) for name in session_groups], dtype=int)
+    two_choice_groups = np.array([name.endswith(' (two-choice)') for name in group_names], dtype=bool)
+
+    start = time.time()
+    scores, session_ci, group_scores, group_ci = bootstrap(counts, group, args.resamples, args.ci,
+                                                           args.seed, args.jobs)
+    elapsed = time.time() - start
+    for name in TWO_CHOICE_NAN:
+        scores[name][two_choice] = np.nan
+        session_ci[name][two_choice] = np.nan
+        group_scores[name][two_choice_groups] = np.nan
+        group_ci[name][two_choice_groups] = np.nan
+
+    session_arrays = [('log', sessions['log'][tested]), ('session', sessions['session'][tested]),
+                      ('id', np.array(ids)), ('group', np.array(group_names)[group]),
+                      ('n_trials', counts.sum(axis=(1, 2)))]
+    group_arrays = [('group', np.array(group_names)),
+                    ('n_sessions', np.bincount(group, minlength=len(group_names)))]
+    for name in METRICS:
+        session_arrays += [(name, scores[name]), (name + '_lo', session_ci[name][:, 0]),
+                           (name + '_hi', session_ci[name][:, 1])]
+        group_arrays += [(name, group_scores[name]), (name + '_lo', group_ci[name][:, 0]),
+                         (name + '_hi', group_ci[name][:, 1])]
+    names = write_table(out + '_sessions', session_arrays)
+    names += write_table(out + '_groups', group_arrays)
+    print('{0} sessions in {1} groups, {2} resamples: {3:.2f} s'.format(
+        len(tested), len(group_names), args.resamples, elapsed), file=sys.stderr)
+    for name in names:
+        print(name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+Runs the PsychoPy versions of the MST headless, with a simulated participant.
+
+There's no window and no real time here: a NullWindow stands in for the
+PsychoPy window, all the waiting in mst_timing runs on a VirtualClock that
+jumps straight to each deadline, and a SimulatedParticipant "sees" each
+image as it's flipped up and answers through the normal response path.  A
+whole session -- log file, summary and all the timing blocks -- takes well
+under a second, so the full pipeline can be regression-tested and
+benchmarked on a box without a display (or PsychoPy).
+
+The participant knows only what it has seen: an image it saw before is a
+target, one whose a/b partner it saw is a lure (with that pair's lure bin)
+and anything else is a foil.  For each it picks old / similar / new from
+RESPONSE_PROBS (lures by bin; what's left over is no response) and an RT
+from RT_DISTS.  In two-choice runs, similar counts as new.  Either can be
+overridden with a JSON file (--behavior) holding the same keys.
+
+Usage:
+    python mst_headless.py MST_Continuous_PsychoPy_320.py --id 9001
+    python mst_headless.py MST_PsychoPy.py --set 2 --two-choice
+    python mst_headless.py MST_Continuous_PsychoPy.py --repeat 20  (benchmark)
+    python mst_headless.py MST_Continuous_PsychoPy_320.py --resume MST_sim_9999_<date>_<time>.journal
+
+MST_PsychoPy.py runs Phase 1 and then Phase 2 with the same participant
+unless --phase is given.
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import importlib
+import json
+import os
+import re
+import sys
+import time
+import numpy as np
+
+import mst_timing
+import mst_journal
+from mst_input import ResponseDevice, DEVICE_RESPONSES
+
+HEADLESS_FRAME_RATE = 60.0
+HEADLESS_POLL_HZ = 20  # Input timestamps come from the participant, so polls can be sparse
+
+# P(old, similar, new) for each kind of trial; whatever's left is no response
+RESPONSE_PROBS = {
+    'target': [0.80, 0.12, 0.05],
+    'foil': [0.04, 0.11, 0.82],
+    'lure': [[0.45, 0.40, 0.12],  # Bin 1 (most similar)
+             [0.35, 0.46, 0.16],
+             [0.26, 0.50, 0.21],
+             [0.18, 0.52, 0.27],
+             [0.12, 0.52, 0.33]],  # Bin 5
+}
+# Log-normal RTs: [median s, sigma] per kind of trial (lures can have one per bin)
+RT_DISTS = {
+    'target': [0.85, 0.30],
+    'foil': [0.90, 0.30],
+    'lure': [1.00, 0.35],
+}
+
+
+class VirtualClock(object):
+    """ Time that only moves when something waits on it """
+
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def getTime(self):
+        return self.now
+
+    def sleep(self, secs):
+        if secs > 0:
+            # A wait shorter than the float resolution still has to move time on
+            self.now = max(self.now + secs, np.nextafter(self.now, np.inf))
+
+
+class NullStim(object):
+    """ Any visual stimulus; drawing it just notes it on the window """
+
+    def __init__(self, win, image=None, **kwargs):
+        self.win = win
+        self.image = image
+
+    def draw(self):
+        self.win.drawn.append(self)
+
+
+class NullWindow(object):
+    """
+    Stands in for visual.Window.  flip() waits (on the virtual clock) for
+    the next refresh and tells each watcher which images went up, as
+    on_flip(images, flip time).
+    """
+    units = 'norm'
+    size = (800, 800)
+
+    def __init__(self, clock, frame_rate=HEADLESS_FRAME_RATE, watchers=()):
+        self.clock = clock
+        self.frame_period = 1.0 / frame_rate
+        self.watchers = list(watchers)
+        self.drawn = []
+        self.flips = 0
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return 1.0 / self.frame_period
+
+    def flip(self, clearBuffer=True):
+        refresh = np.ceil(self.clock.getTime() / self.frame_period - 1e-6) * self.frame_period
+        self.clock.sleep(refresh - self.clock.getTime())
+        images = [stim.image for stim in self.drawn if stim.image is not None]
+        self.drawn = []
+        self.flips += 1
+        for watcher in self.watchers:
+            watcher.on_flip(images, refresh)
+        return refresh
+
+    def close(self):
+        pass
+
+
+class NullImages(object):
+    """ Stands in for mst_stimuli.load_images() (same arguments) without decoding anything """
+
+    def __init__(self, win, fnames, *args, **kwargs):
+        self.stims = [NullStim(win, image=fname) for fname in fnames]
+        self.banner = None
+
+    def get(self, index):
+        return self.stims[index]
+
+    def summary(self):
+        return ''
+
+    def close(self):
+        pass
+
+
+class NullVisual(object):
+    Window = NullWindow
+    TextStim = NullStim
+    ImageStim = NullStim
+
+
+class NullCore(object):
+    def __init__(self, clock):
+        self.getTime = clock.getTime
+        self.wait = clock.sleep
+
+    def quit(self):
+        pass
+
+
+class NullEvent(object):
+    """ The start screens' waitKeys() gets a space right away """
+
+    @staticmethod
+    def waitKeys(*args, **kwargs):
+        return ['space']
+
+    @staticmethod
+    def getKeys(*args, **kwargs):
+        return []
+
+    @staticmethod
+    def clearEvents(*args, **kwargs):
+        pass
+
+
+class SimulatedParticipant(ResponseDevice):
+    """
+    A response device that watches the window and answers each image.
+
+    set_bins: lure bin of each stimulus pair (check_files())
+    behavior: dict overriding RESPONSE_PROBS / RT_DISTS ('probs' / 'rts')
+    seed: for the participant's own random numbers
+    always_respond: never skip a trial (self-paced runs wait for an answer)
+    """
+    label = 'simulated participant'
+
+    def __init__(self, set_bins, behavior=None, seed=None, always_respond=False):
+        ResponseDevice.__init__(self, threaded=False)
+        behavior = behavior or {}
+        self.probs = dict(RESPONSE_PROBS, **behavior.get('probs', {}))
+        self.rts = dict(RT_DISTS, **behavior.get('rts', {}))
+        self.set_bins = set_bins
+        self.rng = np.random.RandomState(seed)
+        self.always_respond = always_respond
+        self.n_choices = 3
+        self.seen = set()
+        self.pending = []  # [(name, time)] of the answer to the current image
+        self.answers = {}  # kind -> counts of old, similar, new, none
+
+    def open_devices(self, names, win=None, n_choices=3, *args):
+        """ Stands in for mst_input.open_devices() """
+        self.n_choices = n_choices
+        return [self]
+
+    def classify(self, fname):
+        """ 'target', 'lure' or 'foil' and the lure bin (None if not a lure) """
+        partner = fname[:-5] + ('b' if fname[-5] == 'a' else 'a') + fname[-4:]
+        if fname in self.seen:
+            return 'target', None
+        if partner in self.seen:
+            return 'lure', self.set_bins[int(fname[-8:-5]) - 1]
+        return 'foil', None
+
+    def on_flip(self, images, t):
+        if not images:  # Blank screen (ISI)
+            return
+        kind, lure_bin = self.classify(images[0])
+        self.seen.add(images[0])
+        probs = self.probs[kind]
+        rt = self.rts[kind]
+        if lure_bin is not None:
+            probs = probs[lure_bin - 1]
+            if np.ndim(rt) == 2:
+                rt = rt[lure_bin - 1]
+        probs = np.append(probs, max(0.0, 1.0 - np.sum(probs)))
+        if self.always_respond:
+            probs[3] = 0.0
+        choice = self.rng.choice(4, p=probs / probs.sum())
+        self.answers.setdefault(kind, np.zeros(4, dtype=int))[choice] += 1
+        self.pending = []  # A new image ends any answer still to come
+        if choice < 3:
+            if self.n_choices == 2:
+                choice = min(choice, 1)  # Similar -> new
+            self.pending.append((DEVICE_RESPONSES[choice], t + rt[0] * np.exp(rt[1] * self.rng.randn())))
+
+    def read(self):
+        now = mst_timing.get_time()
+        due = [event for event in self.pending if event[1] <= now]
+        self.pending = [event for event in self.pending if event[1] > now]
+        return due
+
+    def summary(self):
+        text = ResponseDevice.summary(self)
+        for kind in sorted(self.answers):
+            text += '  {0}: old {1}, similar {2}, new {3}, none {4}\n'.format(kind, *self.answers[kind])
+        return text
+
+
+def run(script, params=None, behavior=None, seed=0, log_file=None,
+        frame_rate=HEADLESS_FRAME_RATE, participant=None, resume=None):
+    """
+    Runs one session of a task script (e.g., 'MST_Continuous_PsychoPy_320.py')
+    headless.  params override the script's defaults (as from its dialog).
+    Pass participant to carry one over from an earlier session (e.g.,
+    Phase 1 -> Phase 2) and resume to pick up a session from its journal.
+    Returns the participant.
+    """
+    name = os.path.splitext(os.path.basename(script))[0]
+    task = importlib.import_module(name)
+    task.tools = None  # get_parameters() then skips lastParams*.pickle and uses its defaults
+    run_params = task.get_parameters(skip_gui=True)
+    if isinstance(run_params.get('Block'), list):  # The 80x4 default is the dialog's choice list, ['1']
+        run_params['Block'] = run_params['Block'][0]
+    run_params.update(params or {})
+    if resume:
+        run_params.update(mst_journal.read(resume)[0]['params'])
+    if participant is None:
+        participant = SimulatedParticipant(task.check_files(run_params['Set']), behavior,
+                                           seed, run_params['SelfPaced'])
+    participant.always_respond = run_params['SelfPaced']
+    clock = VirtualClock()
+    window = NullWindow(clock, frame_rate, [participant])
+    task.visual = NullVisual
+    task.core = NullCore(clock)
+    task.event = NullEvent
+    task.load_images = NullImages
+    task.open_devices = participant.open_devices
+    task.WAIT_SPIN_MARGIN = 0.0  # Nothing to gain from spinning on a virtual clock
+    task.INPUT_POLL_HZ = HEADLESS_POLL_HZ
+    task.SCANNER_TR = None
+    mst_timing.use_clock(clock.getTime, clock.sleep)
+    try:
+        task.main(run_params, window, log_file, resume)
+    finally:
+        mst_timing.use_clock()
+    return participant
+
+
+def resumed_log(journal):
+    """
+    The log a journaled session was writing to: named in its table's sidecar
+    if the table got closed, else the table's name less the date and time
+    (see mst_trials.TrialTable), next to the table either way
+    """
+    base = mst_journal.read(journal)[0]['table']
+    try:
+        with open(base + '.params.json') as f:
+            name = json.load(f)['log']
+    except (IOError, OSError, ValueError, KeyError):
+        name = re.sub(r'_\d{8}_\d{6}(_\d+)?$', '', os.path.basename(base)) + '.txt'
+    return os.path.join(os.path.dirname(base), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run an MST task script headless with a simulated participant')
+    parser.add_argument('script', help='e.g., MST_Continuous_PsychoPy_320.py')
+    parser.add_argument('--id', type=int, default=9999, help='participant ID (default 9999)')
+    parser.add_argument('--set', help='stimulus set (1-6, C-F, ScC)')
+    parser.add_argument('--lag-set', help="continuous versions' lag set (e.g., Set_320)")
+    parser.add_argument('--order', type=int, help="continuous versions' order file")
+    parser.add_argument('--block', help='block for the 80x4 version (1-4)')
+    parser.add_argument('--phase', choices=['1', '2'], help='MST_PsychoPy phase (default both)')
+    parser.add_argument('--duration', type=float)
+    parser.add_argument('--isi', type=float)
+    parser.add_argument('--two-choice', action='store_true')
+    parser.add_argument('--self-paced', action='store_true')
+    parser.add_argument('--seed', type=int, default=0, help="participant's random seed")
+    parser.add_argument('--behavior', help='JSON file overriding RESPONSE_PROBS / RT_DISTS ({"probs": ..., "rts": ...})')
+    parser.add_argument('--log', help="log file (default MST_sim_<ID>.txt, or the journaled session's)")
+    parser.add_argument('--repeat', type=int, default=1, help='sessions to run (for benchmarking)')
+    parser.add_argument('--resume', metavar='JOURNAL', help="carry on a session from its .journal file")
+    args = parser.parse_args()
+
+    params = {'ID': args.id, 'TwoChoice': args.two_choice, 'SelfPaced': args.self_paced}
+    for key, value in [('Set', args.set), ('LagSet', args.lag_set), ('Order', args.order),
+                       ('Block', args.block), ('Duration', args.duration), ('ISI', args.isi)]:
+        if value is not None:
+            params[key] = value
+    behavior = None
+    if args.behavior:
+        with open(args.behavior) as f:
+            behavior = json.load(f)
+    if args.resume:  # The ID and the rest come from the journal (see run())
+        log_file = args.log or resumed_log(args.resume)
+    else:
+        log_file = args.log or 'MST_sim_{0}.txt'.format(args.id)
+    phases = ['Phase 1', 'Phase 2'] if args.phase is None else ['Phase ' + args.phase]
+
+    importlib.import_module(os.path.splitext(os.path.basename(args.script))[0])  # Not part of the timing
+    start = time.time()
+    for i in range(args.repeat):
+        participant = None
+        if args.resume:
+            participant = run(args.script, params, behavior, args.seed + i, log_file,
+                              resume=args.resume)
+        elif os.path.basename(args.script).startswith('MST_PsychoPy'):
+            for phase in phases:
+                params['Phase'] = phase
+                participant = run(args.script, params, behavior, args.seed + i, log_file,
+                                  participant=participant)
+        else:
+            participant = run(args.script, params, behavior, args.seed + i, log_file)
+    elapsed = time.time() - start
+    print('{0} session(s) in {1:.3f} s ({2:.1f} sessions/s), log in {3}'.format(
+        args.repeat, elapsed, args.repeat / elapsed, log_file), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+"""
+Response input for the PsychoPy versions of the MST.
+
+The scripts used to take RT as local_timer.getTime() - t1 once
+event.waitKeys() / getKeys() returned, so every RT included however long it
+took to poll and return, and was relative to when the trial was supposed to
+start rather than when the image actually went up.  Now every response
+device timestamps its input when it happens and RTs are taken from that
+relative to the actual onset flip.
+
+Devices (ResponseDevice subclasses):
+    KeyboardDevice  - psychopy.hardware.keyboard, which timestamps key-downs
+                      itself (with Psychtoolbox, off the OS event); falls
+                      back to psychopy.event
+    SerialButtonBox - button box / trigger interface on a serial port
+                      (ASCII '1'-'4' buttons and '5' trigger by default)
+    TouchDevice     - touch screen (PsychoPy sees it as the mouse); the
+                      screen is split into one column per response
+Each one runs a polling thread that pushes (name, input time, queue time)
+onto a deque -- appends and pops are atomic, so the thread and the trial
+loop don't need a lock -- and the trial loop drains it.  Anything read
+through pyglet's event loop (psychopy.event, the mouse) has to stay on the
+main thread, so those devices are read when drained instead.  Each device
+keeps its input-to-queue latencies for the summary.
+
+Responses come out as key names from the keyboard and 'resp1' / 'resp2' /
+'resp3' from the other devices (decode_response knows both).  Scanner
+triggers come out as 'trigger' and go to ResponseInput.triggers rather
+than being taken as responses.
+
+Usage in a trial loop:
+    responses = ResponseInput(open_devices(...), valid_keys, local_timer)
+    for trial in ...:
+        responses.clear()
+        onset = sched.flip_at(t1, trial)
+        key = sched.waiter.until(..., responses.poll, 'response')
+        if key:
+            RT = responses.rt(trial, onset)
+    log.write(responses.summary())
+    responses.close()
+
+python mst_input.py --test-serial runs a SerialButtonBox against a local
+pseudo-terminal and reports its latencies (no button box needed).
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import os
+import threading
+from collections import deque
+import numpy as np
+
+from mst_timing import get_time
+
+try:
+    from psychopy import event
+except ImportError:
+    event = None
+try:
+    from psychopy.hardware import keyboard as hw_keyboard
+except ImportError:
+    hw_keyboard = None
+try:
+    import serial
+except ImportError:
+    serial = None
+try:
+    import select
+    import termios
+    import tty
+except ImportError:  # Windows -- needs pyserial for the button box
+    termios = None
+
+ESCAPE_KEYS = ['escape', 'esc']
+DEVICE_RESPONSES = ['resp1', 'resp2', 'resp3']
+TRIGGER = 'trigger'
+DEFAULT_DEVICE_HZ = 1000  # How often device threads poll
+BUTTON_BOX_CODES = {'1': 'resp1', '2': 'resp2', '3': 'resp3', '5': TRIGGER}
+
+
+class ResponseDevice(object):
+    """
+    Base class.  Subclasses set .label and implement read(), which returns
+    [(name, input time)] for whatever came in since the last call, with
+    times from mst_timing.get_time() (core.getTime()).
+
+    threaded: poll read() on a background thread at poll_hz.  If False,
+        read() runs when the queue is drained (main-thread-only input).
+    """
+    label = 'device'
+    blocking = False  # read() waits for input itself (up to a poll period)
+
+    def __init__(self, poll_hz=DEFAULT_DEVICE_HZ, threaded=True):
+        self.poll_period = 1.0 / poll_hz
+        self.threaded = threaded
+        self.queue = deque()
+        self.latencies = deque()  # queue time - input time for each event
+        self._stop = threading.Event()
+        self._thread = None
+
+    def read(self):
+        raise NotImplementedError
+
+    def start(self):
+        if self.threaded and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.label)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._pump()
+            if not self.blocking:
+                self._stop.wait(self.poll_period)
+
+    def _pump(self):
+        events = self.read()
+        if events:
+            queued = get_time()
+            for name, t in events:
+                self.queue.append((name, t, queued))
+                self.latencies.append(queued - t)
+
+    def drain(self):
+        """ Everything queued so far as [(name, input time, queue time)] """
+        if not self.threaded:
+            self._pump()
+        events = []
+        while True:
+            try:
+                events.append(self.queue.popleft())
+            except IndexError:
+                return events
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def summary(self):
+        """ One line: how the device is read and its input-to-queue latency """
+        text = '{0}: {1}'.format(self.label,
+                                 'thread at {0:.0f} Hz'.format(1.0 / self.poll_period)
+                                 if self.threaded else 'read on the main thread')
+        latencies = np.array(self.latencies) * 1000
+        if len(latencies):
+            text += ', {0} events, input-to-queue latency mean {1:.3f} ms, p95 {2:.3f} ms, max {3:.3f} ms'.format(
+                len(latencies), latencies.mean(), np.percentile(latencies, 95), latencies.max())
+        return text + '\n'
+
+
+class KeyboardDevice(ResponseDevice):
+    """
+    The keyboard.  Uses psychopy.hardware.keyboard when available; only its
+    Psychtoolbox backend is safe to read off the main thread.
+
+    trigger_keys: keys that are scanner triggers rather than responses
+        (e.g., ['5'] for a trigger box that types a 5)
+    use_hardware: False = always use psychopy.event
+    """
+    label = 'keyboard'
+
+    def __init__(self, trigger_keys=(), use_hardware=True, poll_hz=DEFAULT_DEVICE_HZ):
+        self.trigger_keys = list(trigger_keys)
+        self.kb = None
+        if use_hardware and hw_keyboard is not None:
+            try:
+                self.kb = hw_keyboard.Keyboard()
+            except Exception as err:  # e.g., no Psychtoolbox / iohub on this machine
+                print('Keyboard backend not available ({0}) - using psychopy.event'.format(err))
+        backend = getattr(self.kb, '_backend', None)
+        ResponseDevice.__init__(self, poll_hz, threaded=(backend == 'ptb'))
+        if self.kb is None:
+            self.label = 'keyboard (psychopy.event)'
+        else:
+            self.label = 'keyboard (psychopy.hardware.keyboard, {0})'.format(backend or 'unknown backend')
+
+    def read(self):
+        if self.kb is not None:
+            presses = [(k.name, k.tDown) for k in self.kb.getKeys(waitRelease=False)]
+        else:
+            presses = event.getKeys(timeStamped=True)
+        return [(TRIGGER if name in self.trigger_keys else name, t) for name, t in presses]
+
+    def clear(self):
+        if self.kb is not None:
+            self.kb.clearEvents()
+        if event is not None:
+            event.clearEvents('keyboard')
+
+
+class SerialButtonBox(ResponseDevice):
+    """
+    A button box or trigger interface that sends one ASCII character per
+    press / pulse on a serial port (fORP, Cedrus in ASCII mode, most USB
+    trigger converters).  Uses pyserial when it's installed, otherwise opens
+    the port directly (POSIX only).
+
+    port: e.g., '/dev/ttyUSB0' or 'COM3'
+    codes: character -> name ('resp1'-'resp3' or 'trigger'); anything else
+        is ignored
+
+    The port doesn't timestamp its bytes, so they're stamped from when the
+    read saw them: a byte that comes in while the read is waiting gets the
+    time the read returned (late by the OS's wakeup latency, which the
+    latencies in the summary don't include), and bytes already waiting when
+    a read starts get the middle of the gap since the last read returned
+    (at most half that gap -- roughly the time to queue the last batch --
+    off; that part is in the latencies).
+    """
+    label = 'serial'
+    blocking = True
+
+    def __init__(self, port, baudrate=19200, codes=None, poll_hz=DEFAULT_DEVICE_HZ):
+        ResponseDevice.__init__(self, poll_hz, threaded=True)
+        self.port = port
+        self.codes = dict(BUTTON_BOX_CODES if codes is None else codes)
+        self.label = 'serial ({0})'.format(port)
+        self.last_read = None  # When the last read returned
+        if serial is not None:
+            self.ser = serial.Serial(port, baudrate, timeout=self.poll_period)
+            self.fd = None
+        elif termios is not None:
+            self.ser = None
+            self.fd = os.open(port, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+            tty.setraw(self.fd)
+            attrs = termios.tcgetattr(self.fd)
+            speed = getattr(termios, 'B{0}'.format(baudrate))
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        else:
+            raise RuntimeError('The serial button box needs pyserial on this system')
+
+    def read(self):
+        start = get_time()
+        if self.ser is not None:
+            waiting = self.ser.in_waiting
+            data = self.ser.read(waiting or 1)
+        else:
+            waiting = select.select([self.fd], [], [], 0)[0]
+            ready = waiting or select.select([self.fd], [], [], self.poll_period)[0]
+            data = os.read(self.fd, 64) if ready else b''
+        end = get_time()
+        if waiting and self.last_read is not None:  # Came in between reads
+            t = (self.last_read + start) / 2
+        else:  # While we waited
+            t = end
+        self.last_read = end
+        names = [self.codes.get(c) for c in data.decode('ascii', 'ignore')]
+        return [(name, t) for name in names if name is not None]
+
+    def close(self):
+        ResponseDevice.close(self)
+        if self.ser is not None:
+            self.ser.close()
+        elif self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class TouchDevice(ResponseDevice):
+    """
+    A touch screen, which PsychoPy sees as the mouse.  The screen is split
+    into n_choices equal columns, left to right 'resp1', 'resp2', ...
+    Touches are timestamped when read (so to the main thread's poll rate).
+    """
+    label = 'touch'
+
+    def __init__(self, win, n_choices=3):
+        ResponseDevice.__init__(self, threaded=False)
+        self.mouse = event.Mouse(win=win)
+        self.win = win
+        self.n_choices = n_choices
+        self.down = False
+
+    def read(self):
+        pressed = self.mouse.getPressed()[0]
+        t = get_time()
+        events = []
+        if pressed and not self.down:
+            x = self.mouse.getPos()[0]
+            width = 2.0 if self.win.units == 'norm' else self.win.size[0]
+            column = int((x / width + 0.5) * self.n_choices)
+            column = min(max(column, 0), self.n_choices - 1)
+            events.append((DEVICE_RESPONSES[column], t))
+        self.down = pressed
+        return events
+
+
+def open_devices(names, win=None, n_choices=3, serial_port=None, trigger_keys=()):
+    """
+    Makes and starts the devices listed in names ('keyboard', 'serial',
+    'touch').  Returns the list for ResponseInput.
+    """
+    devices = []
+    for name in names:
+        if name == 'keyboard':
+            devices.append(KeyboardDevice(trigger_keys))
+        elif name == 'serial':
+            devices.append(SerialButtonBox(serial_port))
+        elif name == 'touch':
+            devices.append(TouchDevice(win, n_choices))
+        else:
+            raise ValueError('Unknown response device: {0}'.format(name))
+    return [device.start() for device in devices]
+
+
+class ResponseInput(object):
+    """
+    The trial loop's view of all the response devices.
+
+    devices: started ResponseDevices (open_devices())
+    keys: the keys to respond to (valid_keys); device responses and escape
+        always count
+    clock: session clock (SessionClock) that onsets and RTs are on
+    timeline: TriggerTimeline to count scanner triggers into (sched.timeline)
+
+    poll() returns names like event.getKeys() does and remembers the
+    timestamps of the first one, which rt() then uses.
+    """
+
+    def __init__(self, devices, keys, clock, timeline=None):
+        self.devices = devices
+        self.keys = keys
+        self.clock = clock
+        self.timeline = timeline
+        self.last = None  # (name, input time, polled) of the first response from the last poll
+        self.records = []  # [trial, name, onset, input time, polled]
+        self.triggers = []  # Session time of every scanner trigger seen
+
+    def _drain(self):
+        """ [(name, input time)] from all devices in time order, on self.clock; files triggers """
+        events = []
+        for device in self.devices:
+            events.extend(device.drain())
+        events.sort(key=lambda e: e[1])
+        presses = []
+        for name, t, queued in events:
+            if name == TRIGGER:
+                self.triggers.append(self.clock.local(t))
+                if self.timeline is not None:
+                    self.timeline.add(t)
+            else:
+                presses.append((name, self.clock.local(t)))
+        return presses
+
+    def clear(self):
+        """
+        Drops anything pressed so far (call before the onset flip).
+        Triggers still get counted.
+        """
+        self._drain()
+        for device in self.devices:
+            if hasattr(device, 'clear'):
+                device.clear()
+        self._drain()
+        self.last = None
+
+    def poll(self):
+        """ Names of the valid responses since the last poll / clear """
+        presses = [(name, t) for name, t in self._drain()
+                   if name in self.keys or name in DEVICE_RESPONSES]
+        if presses:
+            self.last = (presses[0][0], presses[0][1], self.clock.getTime())
+        return [name for name, t in presses]
+
+    def poll_escape(self):
+        """ Empties the queues and returns any escape presses in them """
+        return [name for name, t in self._drain() if name in ESCAPE_KEYS]
+
+    def rt(self, trial, onset):
+        """
+        RT of the last polled response relative to onset (the actual flip
+        time, session seconds), from its input timestamp.  Logged with the
+        poll-based time for summary().
+        """
+        name, down, polled = self.last
+        self.records.append([trial, name, onset, down, polled])
+        return down - onset
+
+    def close(self):
+        for device in self.devices:
+            device.close()
+
+    def summary(self):
+        """ Text block for the log: devices plus input vs poll times of each response """
+        text = '\n\nResponse devices:\n'
+        for device in self.devices:
+            text += device.summary()
+        text += 'KeyTimes,Trial,Key,Onset,KeyDown,Polled,RT,PolledRT\n'
+        for trial, name, onset, down, polled in self.records:
+            text += 'KeyTimes,{0},{1},{2:.4f},{3:.4f},{4:.4f},{5:.4f},{6:.4f}\n'.format(
+                trial + 1, name, onset, down, polled, down - onset, polled - onset)
+        return text
+
+
+def test_serial(n=50, interval=0.02):
+    """
+    Runs a SerialButtonBox against a pseudo-terminal standing in for the
+    port and returns a report: what was read back, write-to-input and
+    input-to-queue latencies.
+    """
+    import pty
+    import time
+    master, slave = pty.openpty()
+    device = SerialButtonBox(os.ttyname(slave)).start()
+    sent = []
+    received = []
+    try:
+        for i in range(n):
+            code = '1235'[i % 4]
+            sent.append((code, get_time()))
+            os.write(master, code.encode('ascii'))
+            time.sleep(interval)
+            received.extend(device.drain())
+    finally:
+        device.close()
+        os.close(master)
+        os.close(slave)
+    expected = [device.codes[code] for code, t in sent]
+    got = [name for name, t, queued in received]
+    write_to_input = np.array([r[1] - s[1] for s, r in zip(sent, received)]) * 1000
+    text = 'Sent {0}, received {1}, {2}\n'.format(
+        len(sent), len(received), 'all matched' if got == expected else 'MISMATCH')
+    if len(write_to_input):
+        text += 'Write-to-input latency: mean {0:.3f} ms, max {1:.3f} ms\n'.format(
+            write_to_input.mean(), write_to_input.max())
+    return text + device.summary()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Response device checks')
+    parser.add_argument('--test-serial', action='store_true',
+                        help='run the serial button box against a pseudo-terminal')
+    parser.add_argument('-n', type=int, default=50, help='presses to send')
+    args = parser.parse_args()
+    if args.test_serial:
+        print(test_serial(args.n).strip())
+    else:
+        parser.print_help()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Per-stimulus response counts for the MST, and lure bins recalibrated from
+them.
+
+The lure bins in Set<X> bins.txt are fixed ratings.  This goes through
+every trial in the logs (found and parsed as in mst_aggregate.py, with the
+same <out>.cache, so a re-run only parses logs that are new or changed)
+and counts the responses to each stimulus of each set, by image (the a or
+b of the pair) and by what the trial was (type code: 1st of repeat,
+repeat, 1st of lure, lure, foil):
+
+    <out>_items.csv     set, stim, image, type_code, n and old, similar, new,
+                        nr counts (only combinations that were shown)
+    <out>_stimuli.csv   one row per stimulus of each set seen: its lure
+                        bin, the responses to it as a lure (n_lure,
+                        p_old_lure, p_similar_lure, p_new_lure) and the bin
+                        proposed for it
+    <out>_Set<X> bins.txt   proposed bin file for each set (same format as
+                            the one it replaces)
+    <out>_Set<X> bins.diff  unified diff of that against the current file
+(the tables also as .parquet, or .npz without pyarrow)
+
+A lure's bin says how hard it is to tell from its 1st presentation -- bin 1
+the most similar pair, the one called 'old' most often.  The proposal ranks
+the stimuli with at least --min-n responses as lures by p(Old|Lure) (ties:
+lower p(Similar|Lure) is harder) and hands out their current bins in that
+order, so each bin keeps the number of stimuli it has now; stimuli with
+fewer responses keep their bin.  Only three-choice test and continuous
+sessions are counted -- study responses are indoor/outdoor and two-choice
+ones don't separate similar from new.
+
+Usage:
+    python mst_items.py data/ -o items
+    python mst_items.py data/ -o items --min-n 20 --bins-dir "/path/to/MST"
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import difflib
+import os
+import sys
+import time
+import numpy as np
+
+from mst_aggregate import LogCache, aggregate, find_logs
+from mst_scoring import N_LURE_BINS
+from mst_trials import write_table
+
+N_STIM = 192
+IMAGES = ['a', 'b']
+N_TYPE_CODES = 5
+RESPONSES = ['old', 'similar', 'new', 'nr']
+MIN_N = 10  # Responses as a lure a stimulus needs before its bin is recalibrated
+
+
+def set_name(session):
+    """ '1', 'C', ... for a session (the C++ version logs 'Set C') """
+    name = session['set']
+    return name[4:] if name.startswith('Set ') else name
+
+
+def item_counts(sessions):
+    """
+    Responses to every stimulus in the sessions, in one bincount.  Returns
+    (set names, counts) with counts (n_sets, N_STIM, 2 images, 5 type codes,
+    4 responses: old, similar, new, no response).
+    """
+    scored = [s for s in sessions if s['kind'] != 'study' and not s['two_choice'] and s['rows']]
+    sets = sorted(set(set_name(s) for s in scored))
+    set_index = []
+    stim = []
+    image = []
+    type_code = []
+    response = []
+    for session in scored:
+        index = sets.index(set_name(session))
+        for row in session['rows']:
+            set_index.append(index)
+            stim.append(row['stim'])
+            image.append(os.path.splitext(row['fname'])[0][-1:] == 'b')
+            type_code.append(row['type_code'])
+            response.append(row['response'])
+    stim = np.array(stim, dtype=int)
+    response = np.array(response, dtype=int)
+    resp = np.where(response > 0, response - 1, 3)
+    valid = (stim >= 1) & (stim <= N_STIM)
+    cell = (((np.array(set_index, dtype=int) * N_STIM + stim - 1) * 2 + np.array(image, dtype=int))
+            * N_TYPE_CODES + np.array(type_code, dtype=int)) * 4 + resp
+    counts = np.bincount(cell[valid], minlength=len(sets) * N_STIM * 2 * N_TYPE_CODES * 4)
+    return sets, counts.reshape(len(sets), N_STIM, 2, N_TYPE_CODES, 4)
+
+
+def read_bins(fname):
+    """ A Set<X> bins.txt -> (array of the 192 bins, its line ending) """
+    with open(fname, 'rb') as f:
+        text = f.read().decode('ascii')
+    newline = '\r\n' if '\r\n' in text else '\r' if '\r' in text else '\n'
+    bins = np.zeros(N_STIM, dtype=int)
+    for line in text.splitlines():
+        if line.strip():
+            stim, value = line.split('\t')[:2]
+            bins[int(stim) - 1] = int(value)
+    return bins, newline
+
+
+def format_bins(bins, newline):
+    """ The bin file text (no line ending after the last line, as in the originals) """
+    return newline.join('{0}\t{1}'.format(i + 1, b) for i, b in enumerate(bins))
+
+
+def propose_bins(bins, lure_counts, min_n=MIN_N):
+    """
+    bins: current bins (N_STIM); lure_counts: (N_STIM, 4) responses to each
+    stimulus as a lure.  Returns the proposed bins: the stimuli with at
+    least min_n responses ranked hardest first (p(Old|Lure) down, then
+    p(Similar|Lure) up) get their current bins back in sorted order.
+    """
+    lure_counts = np.asarray(lure_counts, dtype=float)
+    n = lure_counts[:, :3].sum(axis=1)
+    eligible = np.flatnonzero((n >= min_n) & (bins >= 1) & (bins <= N_LURE_BINS))
+    proposed = bins.copy()
+    if len(eligible):
+        p_old = lure_counts[eligible, 0] / n[eligible]
+        p_similar = lure_counts[eligible, 1] / n[eligible]
+        order = np.lexsort((bins[eligible], p_similar, -p_old))  # Last key sorts first
+        proposed[eligible[order]] = np.sort(bins[eligible])
+    return proposed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Per-stimulus MST response counts and recalibrated lure bins')
+    parser.add_argument('paths', nargs='+', help='log files and/or directories to search')
+    parser.add_argument('-o', '--out', default='mst_items',
+                        help='output name (default mst_items -> mst_items_items.csv, ...)')
+    parser.add_argument('--bins-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='where the current Set<X> bins.txt files are (default: here)')
+    parser.add_argument('--min-n', type=int, default=MIN_N,
+                        help='responses as a lure needed to move a stimulus '
+                             '(default {0})'.format(MIN_N))
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU; 1 = no pool)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="parse every log (don't read or update <out>.cache)")
+    args = parser.parse_args()
+
+    fnames = [os.path.normpath(fname) for fname in find_logs(args.paths)]
+    if not fnames:
+        print('No MST_*.txt / MSTlog_*.txt logs found', file=sys.stderr)
+        return 1
+    start = time.time()
+    cache = None if args.no_cache else LogCache(args.out + '.cache')
+    sessions = aggregate(fnames, args.jobs, cache)
+    if cache is not None and cache.changed:
+        cache.save()
+    sets, counts = item_counts(sessions)
+
+    # Counts table: one row per set x stim x image x type code that was shown
+    shown = np.argwhere(counts.sum(axis=-1) > 0)
+    item_arrays = [('set', np.array(sets)[shown[:, 0]]), ('stim', shown[:, 1] + 1),
+                   ('image', np.array(IMAGES)[shown[:, 2]]), ('type_code', shown[:, 3])]
+    shown_counts = counts[tuple(shown.T)]
+    item_arrays.append(('n', shown_counts.sum(axis=1)))
+    item_arrays += [(name, shown_counts[:, r]) for r, name in enumerate(RESPONSES)]
+    names = write_table(args.out + '_items', item_arrays)
+
+    stimulus_rows = {'set': [], 'stim': [], 'bin': [], 'proposed_bin': [], 'n_lure': [],
+                     'p_old_lure': [], 'p_similar_lure': [], 'p_new_lure': []}
+    for s, name in enumerate(sets):
+        lure_counts = counts[s, :, :, 3, :].sum(axis=1)  # Lures, either image
+        bin_file = os.path.join(args.bins_dir, 'Set{0} bins.txt'.format(name))
+        if os.path.exists(bin_file):
+            bins, newline = read_bins(bin_file)
+            proposed = propose_bins(bins, lure_counts, args.min_n)
+            text = format_bins(proposed, newline)
+            out_file = '{0}_Set{1} bins.txt'.format(args.out, name)
+            with open(out_file, 'wb') as f:
+                f.write(text.encode('ascii'))
+            diff = difflib.unified_diff(format_bins(bins, '\n').split('\n'),
+                                        format_bins(proposed, '\n').split('\n'),
+                                        os.path.basename(bin_file), os.path.basename(out_file),
+                                        lineterm='')
+            diff_file = '{0}_Set{1} bins.diff'.format(args.out, name)
+            with open(diff_file, 'w') as f:
+                f.write('\n'.join(diff) + '\n')
+            names += [out_file, diff_file]
+            print('Set {0}: {1} of {2} stimuli move bins'.format(
+                name, int(np.sum(proposed != bins)), N_STIM), file=sys.stderr)
+        else:
+            print('Set {0}: no {1}, nothing to recalibrate'.format(name, bin_file), file=sys.stderr)
+            bins = proposed = np.zeros(N_STIM, dtype=int)
+        n = lure_counts[:, :3].sum(axis=1)
+        seen = np.flatnonzero(counts[s].sum(axis=(1, 2, 3)) > 0)
+        with np.errstate(invalid='ignore'):
+            rates = lure_counts[:, :3] / n[:, np.newaxis]
+        stimulus_rows['set'] += [name] * len(seen)
+        stimulus_rows['stim'] += list(seen + 1)
+        stimulus_rows['bin'] += list(bins[seen])
+        stimulus_rows['proposed_bin'] += list(proposed[seen])
+        stimulus_rows['n_lure'] += list(n[seen])
+        for r, resp in enumerate(RESPONSES[:3]):
+            stimulus_rows['p_{0}_lure'.format(resp)] += list(rates[seen, r])
+    stimulus_arrays = [('set', np.array(stimulus_rows['set'], dtype=str))]
+    stimulus_arrays += [(name, np.array(stimulus_rows[name], dtype=dtype)) for name, dtype in
+                        [('stim', 'int32'), ('bin', 'int8'), ('proposed_bin', 'int8'),
+                         ('n_lure', 'int32'), ('p_old_lure', 'float64'),
+                         ('p_similar_lure', 'float64'), ('p_new_lure', 'float64')]]
+    names[2:2] = write_table(args.out + '_stimuli', stimulus_arrays)
+    n_trials = int(counts.sum())
+    print('{0} three-choice trials from {1} files ({2} parsed) in {3:.2f} s'.format(
+        n_trials, len(fnames), len(fnames) if cache is None else cache.parsed, time.time() - start),
+        file=sys.stderr)
+    for name in names:
+        print(name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
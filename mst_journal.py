@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Session journal for the PsychoPy versions of the MST.
+
+If PsychoPy crashes or escape is hit partway through a run, the trials so
+far are in the log but the session can't be picked up again -- the stimulus
+lists came from the random permutation and order file of that run.  So each
+run also keeps an append-only journal next to its trial table
+(MST_<ID>_<date>_<time>.journal), one JSON record per line:
+
+    {"session": {...}}   script, params, seed, table name and the trial
+                         lists exactly as shown (fnames, type_code, lag or
+                         MST_PsychoPy's lists / conditions)
+    {"trial": {...}}     each completed trial (the trial table's columns)
+    {"resumed": {...}}   each time the session was picked up again
+    {"done": "..."}      the session ran to the end
+
+It's written through mst_log.AsyncLog, so at most LOG_MAX_DELAY s of it can
+be lost (i.e., the last trial gets run again) and a torn last line is just
+skipped when it's read back.
+
+To pick a session up again:
+    python MST_Continuous_PsychoPy_320.py --resume MST_12_20261016_101500.journal
+The lists come straight from the session record (nothing is re-permuted or
+re-read from the order file) and the task carries on from the trial after
+the last one journaled, with the trial table and the summary covering the
+whole session.
+"""
+
+from __future__ import print_function, division
+
+import json
+import os
+from datetime import datetime
+import numpy as np
+
+from mst_log import AsyncLog, DEFAULT_MAX_DELAY
+
+
+class Journal(object):
+    """
+    fname: journal file (appended to, so resuming carries on in the same one)
+    max_delay: durability window (see mst_log.AsyncLog)
+    """
+
+    def __init__(self, fname, max_delay=DEFAULT_MAX_DELAY):
+        self.name = fname
+        torn = False
+        if os.path.exists(fname) and os.path.getsize(fname):
+            with open(fname, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b'\n'
+        self.log = AsyncLog(fname, max_delay)
+        if torn:  # Finish off a line cut short by a crash so it doesn't swallow the next
+            self.log.write('\n')
+
+    def _record(self, kind, value):
+        self.log.write(json.dumps({kind: value}, default=_json_value) + '\n')
+
+    def start(self, script, params, seed, table, **lists):
+        """ The session record; lists are the trial lists as they'll be shown """
+        self._record('session', {'script': script, 'params': params, 'seed': seed,
+                                 'table': table, 'started': str(datetime.now()),
+                                 'lists': dict((name, np.asarray(values).tolist())
+                                               for name, values in lists.items())})
+
+    def trial(self, row):
+        """ row: dict of a completed trial's columns """
+        self._record('trial', dict((name, None if isinstance(value, float) and np.isnan(value) else value)
+                                   for name, value in row.items()))
+
+    def resumed(self, n_done):
+        self._record('resumed', {'at': str(datetime.now()), 'trials_done': n_done})
+
+    def done(self):
+        self._record('done', str(datetime.now()))
+
+    def close(self):
+        self.log.close()
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def read(fname):
+    """
+    Returns (session record, completed trial rows, whether it was done).
+    Unreadable lines (a record cut off by a crash) are skipped.
+    """
+    session = None
+    rows = []
+    done = False
+    with open(fname) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'session' in record:
+                session = record['session']
+            elif 'trial' in record:
+                rows.append(record['trial'])
+            elif 'done' in record:
+                done = True
+    if session is None:
+        raise ValueError('{0} has no session record'.format(fname))
+    return session, rows, done
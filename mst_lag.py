@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Lag-resolved scores for the continuous versions of the MST.
+
+The continuous scripts log each repeat's and lure's lag (items between its
+1st and 2nd presentation) but only score all lags together.  This takes
+the tables mst_aggregate.py writes (<cohort>_trials / _sessions), bins the
+2nd presentations by lag and scores each lag bin of each session, with the
+session's foils (and 1st presentations) as the baseline for every bin:
+
+    <out>_sessions.csv  one row per session and lag bin: n_targets, n_lures,
+                        REC, LDI and the d's for that bin
+    <out>_lures.csv     one row per session, lag bin and lure bin: responses
+                        to those lures (old, similar, new, nr counts)
+    <out>_groups.csv    one row per group and lag bin: n_sessions, the mean
+                        (and SEM) of each score over the sessions with
+                        trials in the bin, and the pooled p(Similar) of each
+                        lure bin (L1_similar ... L5_similar)
+(each also as .parquet, or .npz without pyarrow -- see mst_trials.write_table)
+
+All of it is a few bincounts over the whole cohort: lag_counts() tallies
+every session's responses by lag bin at once, sdt_metrics() scores them
+and group_means() / group_sums() reduce the sessions to each group's
+curve.  The default bins are LAG_BINS; others are given as lo-hi (or a
+single lag), e.g. --bins 0 1-4 5-9 10-29 30-79.  Trials whose lag isn't in
+a bin are left out.  Only continuous-version sessions are used; groups
+come from an id,group CSV as for mst_bootstrap.py.
+
+Usage:
+    python mst_aggregate.py data/ -o cohort
+    python mst_lag.py cohort -o cohort_lag --groups groups.csv
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import sys
+import numpy as np
+
+from mst_aggregate import SESSION_COLUMNS, TRIAL_COLUMNS
+from mst_bootstrap import read_groups
+from mst_scoring import N_LURE_BINS, sdt_metrics, trial_kind
+from mst_trials import read_table, write_table
+
+LAG_BINS = [(0, 0), (1, 9), (20, 80), (120, 180)]
+METRICS = ['REC', 'LDI', 'dpTF', 'dpTL', 'dpLF']
+
+
+def parse_bins(specs):
+    """ ['0', '1-9', ...] -> [(0, 0), (1, 9), ...] (sorted, must not overlap) """
+    bins = []
+    for spec in specs:
+        lo, sep, hi = spec.partition('-')
+        bins.append((int(lo), int(hi) if sep else int(lo)))
+    bins.sort()
+    for (lo, hi), (next_lo, next_hi) in zip(bins, bins[1:]):
+        if next_lo <= hi:
+            raise ValueError('Lag bins {0}-{1} and {2}-{3} overlap'.format(lo, hi, next_lo, next_hi))
+    for lo, hi in bins:
+        if hi < lo:
+            raise ValueError('Lag bin {0}-{1} is empty'.format(lo, hi))
+    return bins
+
+
+def bin_label(lag_bin):
+    lo, hi = lag_bin
+    return str(lo) if lo == hi else '{0}-{1}'.format(lo, hi)
+
+
+def lag_bin_index(lag, bins):
+    """ Each lag's bin (index into bins), -1 if it's in none """
+    edges = np.array([(lo, hi + 1) for lo, hi in bins]).ravel()  # lo0, hi0+1, lo1, hi1+1, ...
+    pos = np.searchsorted(edges, np.asarray(lag), side='right')
+    return np.where(pos % 2 == 1, (pos - 1) // 2, -1)  # Odd: past a bin's lo but not its hi+1
+
+
+def lag_counts(session, type_code, response, lag, lure_bin, bins, n_sessions=None):
+    """
+    Responses by lag bin for many sessions at once (session: each trial's
+    session index).  Returns
+        counts  (n_sessions, n_bins, 4, 3) rows old, similar, new, no
+                response; cols targets and lures in the bin, and the
+                session's foils (the same in every bin) -- ready for
+                mst_scoring.sdt_metrics()
+        lures   (n_sessions, n_bins, 4, N_LURE_BINS) the lures' responses by
+                lure bin
+    """
+    session = np.asarray(session, dtype=int)
+    response = np.asarray(response, dtype=int)
+    lure_bin = np.asarray(lure_bin, dtype=int)
+    if n_sessions is None:
+        n_sessions = session.max() + 1 if len(session) else 0
+    n_bins = len(bins)
+    kind = trial_kind(type_code)
+    which = lag_bin_index(lag, bins)
+    resp = np.where(response > 0, response - 1, 3)
+
+    binned = (kind < 2) & (which >= 0)
+    cell = (session * n_bins + which) * 4 + resp
+    counts = np.bincount((cell * 3 + kind)[binned],
+                         minlength=n_sessions * n_bins * 12).reshape(n_sessions, n_bins, 4, 3)
+    foils = kind == 2
+    counts[..., 2] = np.bincount(session[foils] * 4 + resp[foils],
+                                 minlength=n_sessions * 4).reshape(n_sessions, 1, 4)
+    binned_lures = binned & (kind == 1)
+    lures = np.bincount((cell * N_LURE_BINS + lure_bin - 1)[binned_lures],
+                        minlength=n_sessions * n_bins * 4 * N_LURE_BINS)
+    return counts, lures.reshape(n_sessions, n_bins, 4, N_LURE_BINS)
+
+
+def group_means(values, group, n_groups):
+    """
+    (n_sessions, ...) values -> (n_groups, ...) mean and SEM over each
+    group's sessions, leaving out the nans (bins a session has no trials
+    in) and infs (a d' from a rate of 1)
+    """
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values)
+    shape = (n_groups,) + values.shape[1:]
+    n = group_sums(finite.astype(float), group, n_groups)
+    total = group_sums(np.where(finite, values, 0.0), group, n_groups)
+    squares = group_sums(np.where(finite, values ** 2, 0.0), group, n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        var = (squares - n * mean ** 2) / (n - 1)
+        sem = np.sqrt(np.maximum(var, 0.0) / n)
+    return mean.reshape(shape), np.where(n > 1, sem, np.nan).reshape(shape), n.reshape(shape)
+
+
+def group_sums(values, group, n_groups):
+    """ (n_sessions, ...) -> (n_groups, ...) sums, in one bincount """
+    values = np.asarray(values, dtype=float)
+    per_session = int(np.prod(values.shape[1:]))
+    index = np.asarray(group)[:, np.newaxis] * per_session + np.arange(per_session)
+    return np.bincount(index.ravel(), values.reshape(len(values), per_session).ravel(),
+                       minlength=n_groups * per_session).reshape((n_groups,) + values.shape[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Lag-resolved REC, LDI and lure-bin responses for continuous MST sessions')
+    parser.add_argument('cohort', help='tables from mst_aggregate.py (its -o, e.g. mst_cohort)')
+    parser.add_argument('-o', '--out', default=None, help='output name (default <cohort>_lag)')
+    parser.add_argument('--bins', nargs='+', default=None,
+                        help='lag bins as lo-hi or a single lag (default {0})'.format(
+                            ' '.join(bin_label(b) for b in LAG_BINS)))
+    parser.add_argument('--groups', default=None, help="CSV with 'id' and 'group' columns")
+    args = parser.parse_args()
+    out = args.out or args.cohort + '_lag'
+    bins = parse_bins(args.bins) if args.bins else LAG_BINS
+    labels = np.array([bin_label(b) for b in bins])
+
+    sessions = read_table(args.cohort + '_sessions', SESSION_COLUMNS)
+    trials = read_table(args.cohort + '_trials', TRIAL_COLUMNS)
+    continuous = np.flatnonzero(sessions['kind'] == 'continuous')
+    index = dict(((sessions['log'][i], sessions['session'][i]), n) for n, i in enumerate(continuous))
+    trial_session = np.array([index.get(key, -1) for key in
+                              zip(trials['log'].tolist(), trials['session'].tolist())], dtype=int)
+    keep = trial_session >= 0
+    counts, lures = lag_counts(trial_session[keep], trials['type_code'][keep],
+                               trials['response'][keep], trials['lag'][keep],
+                               trials['lure_bin'][keep], bins, len(continuous))
+    n_sessions, n_bins = counts.shape[:2]
+
+    ids = sessions['id'][continuous].astype(str)
+    groups = read_groups(args.groups) if args.groups else {}
+    group_names = sorted(set(groups.get(i, 'all') for i in ids))
+    group = np.array([group_names.index(groups.get(i, 'all')) for i in ids], dtype=int)
+
+    n_targets = counts[..., 0].sum(axis=-1)
+    n_lures = counts[..., 1].sum(axis=-1)
+    with np.errstate(invalid='ignore'):
+        metrics = sdt_metrics(counts)
+    needs = {'REC': [n_targets], 'LDI': [n_lures], 'dpTF': [n_targets],
+             'dpTL': [n_targets, n_lures], 'dpLF': [n_lures]}
+    for name in METRICS:  # No trials of a kind it's scored from in the bin, no score
+        empty = np.any([n == 0 for n in needs[name]], axis=0)
+        metrics[name] = np.where(empty, np.nan, metrics[name])
+
+    # One row per session x lag bin
+    session_index = np.repeat(np.arange(n_sessions), n_bins)
+    session_arrays = [('log', sessions['log'][continuous][session_index]),
+                      ('session', sessions['session'][continuous][session_index]),
+                      ('id', ids[session_index]),
+                      ('group', np.array(group_names)[group][session_index]),
+                      ('lag_bin', np.tile(labels, n_sessions)),
+                      ('n_targets', n_targets.ravel()), ('n_lures', n_lures.ravel())]
+    session_arrays += [(name, metrics[name].ravel()) for name in METRICS]
+
+    # One row per session x lag bin x lure bin
+    lure_index = np.repeat(np.arange(n_sessions), n_bins * N_LURE_BINS)
+    by_lure = lures.transpose(0, 1, 3, 2).reshape(-1, 4)
+    lure_arrays = [('log', sessions['log'][continuous][lure_index]),
+                   ('session', sessions['session'][continuous][lure_index]),
+                   ('id', ids[lure_index]),
+                   ('lag_bin', np.tile(np.repeat(labels, N_LURE_BINS), n_sessions)),
+                   ('lure_bin', np.tile(np.arange(1, N_LURE_BINS + 1), n_sessions * n_bins))]
+    lure_arrays += [(name, by_lure[:, r]) for r, name in enumerate(['old', 'similar', 'new', 'nr'])]
+
+    # One row per group x lag bin
+    n_groups = len(group_names)
+    group_arrays = [('group', np.repeat(group_names, n_bins)), ('lag_bin', np.tile(labels, n_groups))]
+    for name in METRICS:
+        mean, sem, n = group_means(metrics[name], group, n_groups)
+        if name == METRICS[0]:
+            group_arrays.append(('n_sessions', n.ravel().astype(int)))
+        group_arrays += [(name, mean.ravel()), (name + '_sem', sem.ravel())]
+    pooled = group_sums(lures, group, n_groups)  # groups x lag bins x responses x lure bins
+    with np.errstate(invalid='ignore'):
+        similar = pooled[:, :, 1, :] / pooled.sum(axis=2)
+    group_arrays += [('L{0}_similar'.format(b + 1), similar[..., b].ravel())
+                     for b in range(N_LURE_BINS)]
+
+    names = write_table(out + '_sessions', session_arrays)
+    names += write_table(out + '_lures', lure_arrays)
+    names += write_table(out + '_groups', group_arrays)
+    print('{0} continuous sessions in {1} groups, lag bins {2}'.format(
+        n_sessions, n_groups, ' '.join(labels)), file=sys.stderr)
+    for name in names:
+        print(name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Log file writer for the PsychoPy versions of the MST.
+
+The task scripts write and flush the log file from the trial loop, so
+every trial paid for a trip to the disk right before its image went up.
+AsyncLog takes the same write() / flush() / close() calls, but write() just
+queues the text and a background thread does the actual writing in
+batches, every max_delay seconds.  flush() doesn't need to do anything.
+
+Nothing sits in memory longer than max_delay seconds (the durability
+window -- that's the most a crash could lose), and close() writes
+everything that's left and fsyncs the file.  What ends up in the file is
+exactly what was written, in order, so MST_<ID>.txt is unchanged.
+"""
+
+from __future__ import print_function, division
+
+import atexit
+import os
+import threading
+from collections import deque
+
+DEFAULT_MAX_DELAY = 0.5  # Seconds a write can wait before it's on its way to the disk
+
+
+class AsyncLog(object):
+    """
+    fname: log file, opened for appending (like open(fname, 'a+'))
+    max_delay: durability window in seconds
+    """
+
+    def __init__(self, fname, max_delay=DEFAULT_MAX_DELAY):
+        self.name = fname
+        self.max_delay = max_delay
+        self.file = open(fname, 'a')
+        self.pending = deque()
+        self.error = None
+        self.batches = 0
+        self.writes = 0
+        self._wake = threading.Event()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='log writer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)  # So a crash in the task still gets the log out
+
+    def _run(self):
+        while not self._closing:
+            self._wake.wait(self.max_delay)
+            self._wake.clear()
+            self._write_pending()
+
+    def _write_pending(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.pending.popleft())
+            except IndexError:
+                break
+        if batch:
+            try:
+                self.file.write(''.join(batch))
+                self.file.flush()
+            except (IOError, OSError) as err:
+                self.error = err
+            self.batches += 1
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError('Writing {0} failed: {1}'.format(self.name, self.error))
+
+    def write(self, text):
+        self._check()
+        self.pending.append(text)
+        self.writes += 1
+
+    def flush(self):
+        """
+        Nothing to do -- the writer thread gets everything out within
+        max_delay anyway, and waking it every trial would undo the batching
+        """
+        self._check()
+
+    def close(self):
+        """ Writes everything left, fsyncs and closes the file """
+        if self.file.closed:
+            return
+        self._closing = True
+        self._wake.set()
+        self._thread.join()
+        self._write_pending()  # Anything written while the thread was finishing up
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if hasattr(atexit, 'unregister'):  # Python 3
+            atexit.unregister(self.close)
+        self._check()
+
+    @property
+    def closed(self):
+        return self.file.closed
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Scoring for the MST -- one place for what show_test / show_task used to
+work out trial by trial in each script.
+
+score() takes a session's trials as arrays and gets every count and metric
+in one vectorized pass:
+    type_code  0=1st of repeat, 1=2nd of repeat (target), 2=1st of lure,
+               3=2nd of lure (lure), 4=foil -- 1st presentations count as
+               foils, as in the scripts (MST_PsychoPy's TR/TL/TF map onto
+               1/3/4, see mst_trials.COND_CODES)
+    response   1=old 2=similar 3=new, 0=no response (two-choice: 1=old 2=new)
+    lure_bin   lure bin of each trial's stimulus (only used for lures)
+summary_text() writes the summary block for the log exactly as the scripts
+always have, and correct() scores a single trial for the log row.
+
+The same functions work offline on the trial tables (mst_trials.load()).
+For a whole cohort at once, response_counts() tallies every session's
+trials in one go and sdt_metrics() gets REC, LDI, the endorsement rates
+and the d's from the counts for all of them (or for bootstrap resamples --
+see mst_bootstrap.py) as arrays.
+"""
+
+from __future__ import print_function, division
+
+import numpy as np
+from scipy.stats import norm
+
+N_LURE_BINS = 5
+MIN_TRIALS = 0.00001  # Stands in for a trial type with no responses (no divide by zero)
+
+
+def trial_kind(type_code):
+    """ 0=target, 1=lure, 2=foil (incl. 1st presentations) for each type code """
+    type_code = np.asarray(type_code)
+    return np.where(type_code == 1, 0, np.where(type_code == 3, 1, 2))
+
+
+def correct(type_code, response, two_choice):
+    """
+    1 where the response is right for the trial type: old for targets and
+    similar (two-choice: new) for lures and new for foils, else 0
+    """
+    kind = trial_kind(type_code)
+    if two_choice:
+        right = np.minimum(kind, 1) + 1
+    else:
+        right = kind + 1
+    return (np.asarray(response) == right).astype(int)
+
+
+def response_counts(session, type_code, response, n_sessions=None):
+    """
+    Response x trial-kind counts for many sessions at once.  session is
+    each trial's session index (0 .. n_sessions-1); returns an
+    (n_sessions, 4, 3) array: rows old, similar, new, no response; cols
+    targets, lures, foils.
+    """
+    session = np.asarray(session, dtype=int)
+    response = np.asarray(response, dtype=int)
+    if n_sessions is None:
+        n_sessions = session.max() + 1 if len(session) else 0
+    cell = np.where(response > 0, response - 1, 3) * 3 + trial_kind(type_code)
+    return np.bincount(session * 12 + cell, minlength=n_sessions * 12).reshape(n_sessions, 4, 3)
+
+
+def sdt_metrics(counts):
+    """
+    REC, LDI, endorsement rates and d's from response x kind counts (rows
+    old, similar, new[, no response]; cols targets, lures, foils), for any
+    number of leading dimensions -- (3, 3) for one session, (n_sessions, 4,
+    3) from response_counts(), (n_sessions, n_resamples, 4, 3), ...  Returns
+    a dict of arrays of the leading shape; the rates are of the responses
+    made, with a rate of 0 taken as half a response (as in score()).
+    """
+    counts = np.asarray(counts, dtype=float)[..., :3, :]
+    trials = counts.sum(axis=-2)
+    trials = np.where(trials == 0.0, MIN_TRIALS, trials)
+    rates = counts / trials[..., np.newaxis, :]
+    metrics = {'REC': rates[..., 0, 0] - rates[..., 0, 2],
+               'LDI': rates[..., 1, 1] - rates[..., 1, 2]}
+    endorse = np.where(rates[..., 0, :] == 0.0, 0.5 / trials, rates[..., 0, :])
+    metrics['hit_rate'], metrics['lure_rate'], metrics['false_rate'] = np.moveaxis(endorse, -1, 0)
+    z = norm.ppf(endorse)
+    metrics['dpTF'] = z[..., 0] - z[..., 2]
+    metrics['dpTL'] = z[..., 0] - z[..., 1]
+    metrics['dpLF'] = z[..., 1] - z[..., 2]
+    return metrics
+
+
+def score(type_code, response, lure_bin, two_choice, n_trials=None):
+    """
+    Counts and metrics for one session.  n_trials is what the raw percent
+    correct is out of (default: all the trials given).
+
+    Returns a dict:
+        TLF_trials            responses to targets, lures, foils
+        TLF_response_matrix   rows old, similar, new; cols targets, lures, foils
+        lure_bin_matrix       rows old, similar, new, no response; cols lure bins
+        ncorrect              correct responses
+        rate_matrix           TLF_response_matrix / TLF_trials
+        lure_bin_rates        lure_bin_matrix / lures in each bin
+        pc_corrected, pc_raw  percent correct of responses / of n_trials
+        REC                   p(Old|Target) - p(Old|Foil)
+        LDI                   p(Similar|Lure) - p(Similar|Foil)
+        hit_rate, lure_rate, false_rate   endorsement rates (0 -> 0.5 / N)
+        dpTF, dpTL, dpLF      d' target:foil, target:lure, lure:foil
+    """
+    type_code = np.asarray(type_code)
+    response = np.asarray(response, dtype=int)
+    lure_bin = np.asarray(lure_bin, dtype=int)
+    if n_trials is None:
+        n_trials = len(type_code)
+    kind = trial_kind(type_code)
+    responded = response > 0
+
+    # Response x kind and (for lures) response-or-NR x bin, each in one bincount
+    TLF_response_matrix = np.bincount(
+        (response[responded] - 1) * 3 + kind[responded], minlength=9)[:9].reshape(3, 3).astype(float)
+    TLF_trials = TLF_response_matrix.sum(axis=0)
+    lures = kind == 1
+    resp_index = np.where(responded, response - 1, 3)[lures]
+    lure_bin_matrix = np.bincount(resp_index * N_LURE_BINS + lure_bin[lures] - 1,
+                                  minlength=4 * N_LURE_BINS).reshape(4, N_LURE_BINS).astype(float)
+    ncorrect = int(np.sum(correct(type_code, response, two_choice) * responded))
+
+    scores = {'TLF_trials': TLF_trials.copy(),
+              'TLF_response_matrix': TLF_response_matrix,
+              'lure_bin_matrix': lure_bin_matrix,
+              'ncorrect': ncorrect,
+              'n_trials': n_trials}
+    trials = np.where(TLF_trials == 0.0, MIN_TRIALS, TLF_trials)
+    rates = TLF_response_matrix / trials
+    scores['rate_matrix'] = rates
+    bin_totals = lure_bin_matrix.sum(axis=0)
+    scores['lure_bin_rates'] = lure_bin_matrix / np.where(bin_totals == 0, MIN_TRIALS, bin_totals)
+    scores['pc_corrected'] = ncorrect / trials.sum()
+    scores['pc_raw'] = ncorrect / n_trials if n_trials else np.nan
+    for name, value in sdt_metrics(TLF_response_matrix).items():
+        scores[name] = float(value)
+    return scores
+
+
+def summary_text(scores, two_choice, rec_label='Corrected recognition (REC) (p(Old|Target)-p(Old|Foil))'):
+    """ The summary block for the log (same text the scripts always wrote) """
+    TLF_trials = scores['TLF_trials']
+    rates = scores['rate_matrix']
+    counts = scores['TLF_response_matrix']
+    lure_bins = scores['lure_bin_matrix']
+    text = '\nValid responses:\nTargets, {0:.0f}\nlures, {1:.0f}\nfoils, {2:.0f}'.format(*TLF_trials)
+    text += '\nCorrected rates\n'
+    text += '\nRateMatrix,Targ,Lure,Foil\n'
+    for name, row in zip(['Old', 'Similar', 'New'], rates):
+        text += '{0},{1:.2f},{2:.2f},{3:.2f}\n'.format(name, *row)
+    text += '\nRaw counts'
+    text += '\nRawRespMatrix,Targ,Lure,Foil\n'
+    for name, row in zip(['Old', 'Similar', 'New'], counts):
+        text += '{0},{1:.0f},{2:.0f},{3:.0f}\n'.format(name, *row)
+    text += '\n\nLureRawRespMatrix,Bin1,Bin2,Bin3,Bin4,Bin5\n'
+    for name, row in zip(['Old', 'Similar', 'New', 'NR'], lure_bins):
+        text += '{0},{1:.0f},{2:.0f},{3:.0f},{4:.0f},{5:.0f}\n'.format(name, *row)
+    text += '\nPercent-correct (corrected),{0:.2}\n'.format(scores['pc_corrected'])
+    text += 'Percent-correct (raw),{0:.2}\n'.format(scores['pc_raw'])
+    text += '\n{0}, {1:.2f}'.format(rec_label, scores['REC'])
+    if two_choice:
+        text += '\nTwo-choice test metrics\n'
+        text += 'Endorsement rates'
+        text += 'Targets: {0:.2f}'.format(scores['hit_rate'])
+        text += 'Lures: {0:.2f}'.format(scores['lure_rate'])
+        text += 'Foils and Firsts: {0:.2f}'.format(scores['false_rate'])
+        text += "d' Target:Foil, {0:.2f}".format(scores['dpTF'])
+        text += "d' Target:Lure, {0:.2f}".format(scores['dpTL'])
+        text += "d' Lure:Foil, {0:.2f}".format(scores['dpLF'])
+    else:
+        text += '\nThree-choice test metrics\n'
+        text += 'LDI,{0:.2f}'.format(scores['LDI'])
+    return text
@@ -0,0 +1,770 @@
+#!/usr/bin/env python
+"""
+Stimulus loading helpers shared by the PsychoPy versions of the MST
+(MST_PsychoPy.py and the MST_Continuous_PsychoPy*.py scripts).
+
+Building a visual.ImageStim from a filename means a JPEG decode and a texture
+upload.  Doing that inside the trial loop puts both between the time a trial
+should start and the win.flip() that actually shows it, so here we do that
+work before the "Press the spacebar to begin" screen instead.
+
+Two strategies are available (pick with load_images()):
+    'preload': decode and upload every image before the task starts
+    'prefetch': a worker thread keeps the next few images decoded while the
+        current trial and ISI run, and textures live in a fixed-budget LRU
+        pool -- for machines without the RAM to hold a whole 320-trial run
+
+All loaders share the same small interface:
+    get(index): ImageStim for fnames[index], ready to draw.  Call in order.
+    banner: what to draw over it for the instructions (set by load_images())
+    summary(): text block for the log file (may be empty)
+    close(): release the textures (and stop any worker thread)
+
+Either way, the pixels come from load_image(), which uses a "Set N.atlas"
+file or the resized cache in "Set N_rs/" when one has been built for the
+display geometry we're using (the scripts pass theirs: the window, and
+STIM_SIZE in its units).  To build them (from the directory with the Set N
+folders):
+    python mst_stimuli.py --build-cache 1 C ScC
+    python mst_stimuli.py --build-cache 1 --win 1024 768 --units height --size 0.5 0.5
+    python mst_stimuli.py --pack-atlas 1 C ScC
+An atlas is one uncompressed file per set that gets memory-mapped, which
+saves hundreds of small-file reads when the sets live on a network share.
+The cache holds a raw RGB(A) .npy array (what the PsychoPy code loads) and a
+resized .jpg (what the jsPsych orders from CreateJSOrders.py point at) for
+each of the 384 images, plus cache.json recording the geometry and the
+size / mtime (and optionally MD5) of every source file.
+"""
+
+from __future__ import print_function, division
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import numpy as np
+from PIL import Image
+try:
+    from psychopy import visual, core
+except ImportError:  # Building the cache doesn't need PsychoPy
+    visual = core = None
+
+N_IMAGE_PAIRS = 192  # 001a/b ... 192a/b in every set
+CACHE_SUFFIX = '_rs'  # "Set 1" -> "Set 1_rs"
+CACHE_MANIFEST = 'cache.json'
+
+
+def decode_image(fname):
+    """ Reads and fully decodes an image file, returning an RGB(A) PIL image """
+    im = Image.open(fname)
+    im.load()  # PIL is lazy -- make sure the decode happens here
+    if im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+    return im
+
+
+def image_names():
+    """ The 384 image filenames in every set: 001a.jpg, 001b.jpg ... 192b.jpg """
+    return ['{0:03}{1}.jpg'.format(i, ab)
+            for i in range(1, N_IMAGE_PAIRS + 1) for ab in 'ab']
+
+
+# ------------------------------------------------------------------------
+# Pre-resized stimulus cache
+
+def display_geometry(win_size=(800, 800), units='norm', size=None):
+    """
+    Describes how big the stimuli end up on screen.  The images are fit
+    (keeping their aspect ratio) inside a size-sized box given in the
+    window's units.  size=None is what the task scripts do: draw each image
+    at its own pixel size, in which case the window doesn't matter.
+
+    Returns a dict that is stored in / compared against cache.json
+    """
+    if size is None:
+        return {'box': None}
+    if units == 'pix':
+        box = (size[0], size[1])
+    elif units == 'norm':
+        box = (size[0] * win_size[0] / 2.0, size[1] * win_size[1] / 2.0)
+    elif units == 'height':
+        box = (size[0] * win_size[1], size[1] * win_size[1])
+    else:
+        raise ValueError('Cannot size a stimulus cache in {0} units'.format(units))
+    return {'box': [int(round(box[0])), int(round(box[1]))],
+            'win_size': [int(win_size[0]), int(win_size[1])],
+            'units': units, 'size': [float(size[0]), float(size[1])]}
+
+
+def fit_image(im, geometry):
+    """ Resizes a decoded image to the display geometry """
+    if geometry['box'] is None:
+        return im
+    scale = min(geometry['box'][0] / im.size[0], geometry['box'][1] / im.size[1])
+    new_size = (max(1, int(round(im.size[0] * scale))),
+                max(1, int(round(im.size[1] * scale))))
+    if new_size == im.size:
+        return im
+    return im.resize(new_size, Image.LANCZOS)
+
+
+def source_stamp(fname, with_hash=False):
+    """ What we record about a source image to tell if a cached copy is stale """
+    st = os.stat(fname)
+    stamp = {'bytes': st.st_size, 'mtime': st.st_mtime}
+    if with_hash:
+        with open(fname, 'rb') as fp:
+            stamp['md5'] = hashlib.md5(fp.read()).hexdigest()
+    return stamp
+
+
+def same_source(old, new):
+    """
+    Whether two stamps are of the same file contents: size and mtime match,
+    or else the MD5s do -- only when both stamps have one, so a cache built
+    with or without --hash is still good the other way
+    """
+    if old['bytes'] == new['bytes'] and abs(old['mtime'] - new['mtime']) < 0.001:
+        return True
+    return 'md5' in old and 'md5' in new and old['md5'] == new['md5']
+
+
+def stamp_matches(fname, stamp):
+    """ Quick check (size and mtime only) of a source file against its stamp """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return False
+    return st.st_size == stamp['bytes'] and abs(st.st_mtime - stamp['mtime']) < 0.001
+
+
+def read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, CACHE_MANIFEST), 'r') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def build_resized_cache(stim_set, win_size=(800, 800), units='norm', size=None,
+                        base_dir='.', with_hash=False, verbose=True):
+    """
+    Writes display-ready copies of all the images in "Set {stim_set}" to
+    "Set {stim_set}_rs".  Images whose source hasn't changed (and whose
+    geometry matches) are left alone, so re-running this is cheap.
+
+    stim_set: Set we're using (e.g., '1', or 'C')
+    win_size, units, size: display geometry (see display_geometry())
+    with_hash: also record / compare an MD5 of every source file, so a file
+        that was just touched (new mtime, same bits) isn't redone
+
+    Returns the number of images (re)written
+    """
+    src_dir = os.path.join(base_dir, 'Set {0}'.format(stim_set))
+    cache_dir = src_dir + CACHE_SUFFIX
+    geometry = display_geometry(win_size, units, size)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    manifest = read_manifest(cache_dir)
+    if manifest is None or manifest.get('geometry') != geometry:
+        manifest = {'geometry': geometry, 'files': {}}
+    n_written = 0
+    for name in image_names():
+        fname = os.path.join(src_dir, name)
+        stamp = source_stamp(fname, with_hash)
+        old = manifest['files'].get(name)
+        if old is not None and same_source(old['source'], stamp):
+            old['source'].update(stamp)  # New mtime / MD5, same pixels
+            continue
+        im = fit_image(decode_image(fname), geometry)
+        pixels = np.asarray(im)
+        stem = os.path.join(cache_dir, name[:-4])
+        np.save(stem + '.npy', pixels)
+        im.convert('RGB').save(stem + '.jpg', quality=90)
+        manifest['files'][name] = {'source': stamp, 'shape': list(pixels.shape)}
+        n_written += 1
+    with open(os.path.join(cache_dir, CACHE_MANIFEST), 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    if verbose:
+        print('{0}: {1} of {2} images written'.format(cache_dir, n_written,
+                                                      len(manifest['files'])))
+    return n_written
+
+
+# ------------------------------------------------------------------------
+# Memory-mapped per-set atlas
+
+ATLAS_SUFFIX = '.atlas'  # "Set 1" -> "Set 1.atlas"
+ATLAS_MAGIC = b'MSTATL01'
+ATLAS_ALIGN = 4096
+
+
+def pack_atlas(stim_set, geometry=None, base_dir='.', verbose=True):
+    """
+    Packs all 384 images of "Set {stim_set}" into one uncompressed file,
+    "Set {stim_set}.atlas", so a run needs one file open instead of 384.
+
+    Layout: 8-byte magic, 8-byte little-endian header length, a JSON header
+    ({'geometry': ..., 'images': {name: {'offset', 'shape', 'source'}}}), then
+    the RGBA pixel data starting on a 4096-byte boundary.  Pixels are stored
+    as RGBA so PIL can wrap the mapped memory without copying.
+
+    geometry: from display_geometry(); None = native size.  Pixels come from
+        load_image() (skipping the atlas being replaced), so a matching
+        resized cache is used if there is one.
+
+    Returns the atlas filename
+    """
+    if geometry is None:
+        geometry = display_geometry()
+    src_dir = os.path.join(base_dir, 'Set {0}'.format(stim_set))
+    atlas_name = src_dir + ATLAS_SUFFIX
+    images = {}
+    offset = 0
+    data_name = atlas_name + '.data'  # Pixels go here until we know the header
+    with open(data_name, 'wb') as fp:
+        for name in image_names():
+            fname = os.path.join(src_dir, name)
+            pixels = np.ascontiguousarray(np.asarray(
+                load_image(fname, geometry, use_atlas=False).convert('RGBA')))
+            images[name] = {'offset': offset, 'shape': list(pixels.shape),
+                            'source': source_stamp(fname)}
+            fp.write(pixels.tobytes())
+            offset += pixels.nbytes
+    header = json.dumps({'geometry': geometry, 'images': images},
+                        sort_keys=True).encode('utf-8')
+    data_start = len(ATLAS_MAGIC) + 8 + len(header)
+    padding = (-data_start) % ATLAS_ALIGN
+    tmp_name = atlas_name + '.tmp'
+    with open(tmp_name, 'wb') as fp:
+        fp.write(ATLAS_MAGIC)
+        fp.write(np.array([len(header)], dtype='<u8').tobytes())
+        fp.write(header)
+        fp.write(b'\0' * padding)
+        with open(data_name, 'rb') as data_fp:
+            shutil.copyfileobj(data_fp, fp, 1 << 20)
+    os.remove(data_name)
+    atlas = _atlases.pop(os.path.normpath(atlas_name), None)
+    if atlas is not None:
+        atlas.close()  # A mapped file can't be removed on Windows
+    if os.path.exists(atlas_name):
+        os.remove(atlas_name)  # os.rename won't replace a file on Windows
+    os.rename(tmp_name, atlas_name)
+    if verbose:
+        print('{0}: {1} images, {2:.1f} MB'.format(atlas_name, len(images),
+                                                   offset / 1e6))
+    return atlas_name
+
+
+class StimulusAtlas(object):
+    """
+    Read side of pack_atlas().  The whole file is mapped with np.memmap and
+    each image is handed out as a view into it, so nothing is read from disk
+    until the pixels are actually touched.
+
+    The source files aren't stat'ed one by one (that's the network traffic the
+    atlas is there to save) unless the set's directory has changed since the
+    atlas was packed, or check_sources is set.  Then entries whose source
+    has changed (size / mtime) are left out, so load_image() falls back to
+    the original.  Re-pack after editing a set.
+    """
+
+    def __init__(self, atlas_name, src_dir=None, check_sources=False):
+        with open(atlas_name, 'rb') as fp:
+            if fp.read(len(ATLAS_MAGIC)) != ATLAS_MAGIC:
+                raise ValueError('Not a stimulus atlas: {0}'.format(atlas_name))
+            header_len = int(np.frombuffer(fp.read(8), dtype='<u8')[0])
+            header = json.loads(fp.read(header_len).decode('utf-8'))
+        data_start = len(ATLAS_MAGIC) + 8 + header_len
+        data_start += (-data_start) % ATLAS_ALIGN
+        self.geometry = header['geometry']
+        self.data = np.memmap(atlas_name, dtype=np.uint8, mode='r',
+                              offset=data_start)
+        if src_dir is None:
+            src_dir = atlas_name[:-len(ATLAS_SUFFIX)]
+        if not check_sources:
+            check_sources = os.stat(src_dir).st_mtime > os.stat(atlas_name).st_mtime
+        self.index = {}
+        for name, entry in header['images'].items():
+            if not check_sources or stamp_matches(os.path.join(src_dir, name),
+                                                  entry['source']):
+                self.index[name] = (entry['offset'], tuple(entry['shape']))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def pixels(self, name):
+        """ Zero-copy (h, w, 4) uint8 view of one image """
+        offset, shape = self.index[name]
+        n_bytes = shape[0] * shape[1] * shape[2]
+        return self.data[offset:offset + n_bytes].reshape(shape)
+
+    def image(self, name):
+        """ RGBA PIL image sharing the mapped memory """
+        view = self.pixels(name)
+        return Image.frombuffer('RGBA', (view.shape[1], view.shape[0]), view,
+                                'raw', 'RGBA', 0, 1)
+
+    def close(self):
+        """
+        Drops the mapping (it goes once no image handed out still uses it)
+        and empties the index
+        """
+        self.data = None
+        self.index = {}
+
+
+_atlases = {}  # atlas filename -> StimulusAtlas (or None), opened once per run
+
+
+def open_atlas(src_dir):
+    """ The atlas packed from src_dir, or None if there isn't a usable one """
+    atlas_name = os.path.normpath(src_dir + ATLAS_SUFFIX)  # './Set 1' is 'Set 1'
+    if atlas_name not in _atlases:
+        atlas = None
+        if os.path.isfile(atlas_name):
+            try:
+                atlas = StimulusAtlas(atlas_name, src_dir)
+            except (IOError, OSError, ValueError) as err:
+                print('Ignoring stimulus atlas {0}: {1}'.format(atlas_name, err))
+        _atlases[atlas_name] = atlas
+    return _atlases[atlas_name]
+
+
+def atlas_complete(src_dir):
+    """
+    Whether src_dir's atlas holds every image of the set, so the scripts'
+    check_files() can take it instead of looking for each file
+    """
+    atlas = open_atlas(src_dir)
+    return atlas is not None and all(name in atlas for name in image_names())
+
+
+_manifests = {}  # cache_dir -> manifest (or None), read once per run
+
+
+def load_image(fname, geometry=None, use_atlas=True):
+    """
+    Decoded image for fname.  In order, we try:
+        the set's memory-mapped atlas ("Set N.atlas"), unless use_atlas is False
+        the resized cache ("Set N_rs/")
+        decoding (and fitting) the original
+    The first two are only used if they were built for this geometry and the
+    source file hasn't changed since.
+
+    geometry: from display_geometry(); None = the scripts' native size
+    """
+    if geometry is None:
+        geometry = display_geometry()
+    src_dir, name = os.path.split(fname)
+    atlas = open_atlas(src_dir) if use_atlas else None
+    if atlas is not None and atlas.geometry == geometry and name in atlas:
+        return atlas.image(name)
+    cache_dir = src_dir + CACHE_SUFFIX
+    if cache_dir not in _manifests:
+        _manifests[cache_dir] = read_manifest(cache_dir)
+    manifest = _manifests[cache_dir]
+    if manifest is not None and manifest['geometry'] == geometry:
+        entry = manifest['files'].get(name)
+        if entry is not None and stamp_matches(fname, entry['source']):
+            return Image.fromarray(np.load(os.path.join(cache_dir, name[:-4] + '.npy')))
+    return fit_image(decode_image(fname), geometry)
+
+
+# ------------------------------------------------------------------------
+# Instruction banner ("Old, Similar, or New?") rendered ahead of time
+#
+# These grab what was drawn from the back buffer, so they assume the window
+# is otherwise blank (win.color) and the banner TextStim is in norm units, as
+# it is in all the task scripts.
+
+def grab_rows(win, top, bottom):
+    """
+    Draws nothing itself -- returns the back buffer between norm y positions
+    top and bottom (full window width) as a PIL image, and clears the buffer.
+    """
+    frame = win.getMovieFrame(buffer='back')
+    win.movieFrames.pop()  # getMovieFrame() also queues it for saveMovieFrames()
+    win.clearBuffer()
+    height = frame.size[1]
+    row_top = int(round((1.0 - top) / 2.0 * height))
+    row_bottom = int(round((1.0 - bottom) / 2.0 * height))
+    return frame.crop((0, max(0, row_top), frame.size[0], min(height, row_bottom)))
+
+
+def banner_rows(text_stim):
+    """ Norm y range (top, bottom) the banner occupies """
+    height = text_stim.height if text_stim.height else 0.1
+    return (1.0, max(-1.0, text_stim.pos[1] - height))
+
+
+def rgb255(color):
+    """ PsychoPy -1:1 rgb to 0:255 """
+    return (np.asarray(color, dtype=float)[:3] + 1.0) * 127.5
+
+
+def prerender_banner(win, text_stim):
+    """
+    Renders a single-color TextStim once into an RGBA ImageStim.  The grabbed
+    pixels are text blended over the window color, so we undo that blend
+    (alpha from how far each pixel is from the background towards the text
+    color) to get a transparent texture that draws exactly like the text.
+    """
+    top, bottom = banner_rows(text_stim)
+    win.clearBuffer()
+    text_stim.draw()
+    rows = np.asarray(grab_rows(win, top, bottom).convert('RGB'), dtype=float)
+    background = rgb255(win.color)
+    ink = rgb255(text_stim.color)
+    channel = int(np.argmax(np.abs(ink - background)))
+    alpha = (rows[:, :, channel] - background[channel]) / (ink[channel] - background[channel])
+    rgba = np.empty(rows.shape[:2] + (4,), dtype=np.uint8)
+    rgba[:, :, :3] = ink.round().astype(np.uint8)
+    rgba[:, :, 3] = np.clip(alpha * 255.0, 0, 255).round().astype(np.uint8)
+    return visual.ImageStim(win, image=Image.fromarray(rgba, 'RGBA'), units='norm',
+                            pos=(0, (top + bottom) / 2.0), size=(2, top - bottom))
+
+
+def composite_stim(win, image_stim, image_height, text_stim):
+    """
+    Bakes the banner and the image into one opaque ImageStim covering the
+    rows from the top of the window down to whichever of the two ends lower.
+
+    image_height: height of image_stim on screen, in norm units
+    """
+    top, bottom = banner_rows(text_stim)
+    bottom = max(-1.0, min(bottom, -image_height / 2.0))
+    win.clearBuffer()
+    image_stim.draw()
+    text_stim.draw()
+    rows = grab_rows(win, top, bottom)
+    return visual.ImageStim(win, image=rows, units='norm',
+                            pos=(0, (top + bottom) / 2.0), size=(2, top - bottom))
+
+
+# ------------------------------------------------------------------------
+# Loaders used by the task scripts
+
+def unique_fnames(fnames):
+    """ Filenames in fnames with duplicates removed, first-seen order kept """
+    seen = set()
+    unique = []
+    for fname in fnames:
+        if fname not in seen:
+            seen.add(fname)
+            unique.append(fname)
+    return unique
+
+
+class LoadProgress(object):
+    """
+    Simple "Loading images: N of M" screen.  Redraws are limited to every
+    update_interval seconds so the flips don't dominate the load time.
+    """
+
+    def __init__(self, win, total, update_interval=0.1):
+        self.win = win
+        self.total = total
+        self.update_interval = update_interval
+        self.last_update = -update_interval
+        self.text = visual.TextStim(win, text='', pos=(0, -0.25),
+                                    color=(-0.5, -0.5, -0.5), wrapWidth=1.75)
+
+    def update(self, n_done, force=False):
+        now = core.getTime()
+        if not force and (now - self.last_update) < self.update_interval:
+            return
+        self.last_update = now
+        self.win.clearBuffer()  # Drop anything drawn while uploading
+        self.text.text = 'Loading images: {0} of {1}'.format(n_done, self.total)
+        self.text.draw()
+        self.win.flip()
+
+
+class PreloadedImages(object):
+    """
+    Decodes and uploads every unique image in fnames up front so the trial
+    loop only swaps in an already-built ImageStim.
+
+    win: PsychoPy window the stimuli will be drawn in
+    fnames: image filenames in trial order (repeats are only loaded once)
+    progress: show a loading counter while we work through the list
+    composite_with: banner TextStim to bake into every image (see
+        composite_stim()), or None to leave the images alone
+    geometry: display geometry the images are fit to (see load_image())
+    start: first trial that will be shown (a resumed run skips the rest)
+    """
+
+    def __init__(self, win, fnames, progress=True, composite_with=None,
+                 geometry=None, start=0):
+        self.win = win
+        self.fnames = list(fnames)
+        self.stims = {}
+        to_load = unique_fnames(self.fnames[start:])
+        meter = LoadProgress(win, len(to_load)) if progress else None
+        for i, fname in enumerate(to_load):
+            pixels = load_image(fname, geometry)
+            stim = visual.ImageStim(win, image=pixels)
+            if composite_with is not None:
+                image_height = 2.0 * pixels.size[1] / win.size[1]  # Drawn 1:1
+                plain = stim
+                stim = composite_stim(win, plain, image_height, composite_with)
+                plain.clearTextures()
+            stim.draw()  # Some drivers defer the upload until first use
+            self.stims[fname] = stim
+            if meter:
+                meter.update(i + 1, force=(i + 1 == len(to_load)))
+        win.clearBuffer()
+
+    def get(self, index):
+        return self.stims[self.fnames[index]]
+
+    def summary(self):
+        return ''
+
+    def close(self):
+        for stim in self.stims.values():
+            stim.clearTextures()
+        self.stims = {}
+
+
+class StimulusPool(object):
+    """
+    Fixed-budget set of ImageStims, one per image, kept in least-recently-used
+    order.  Once the budget is used up, the least recently used stimulus is
+    evicted and the object is recycled for the new image: setting .image
+    reloads the pixels into the texture it already owns rather than making a
+    new one and leaving the old one for the garbage collector.
+
+    win: PsychoPy window the stimuli will be drawn in
+    max_mb: texture budget in MB (estimated as width * height * 4 bytes)
+    max_count: budget as a number of textures
+    Either (or both) can be given; None means no limit of that kind.
+    geometry: display geometry for images it has to load itself
+    """
+
+    def __init__(self, win, max_mb=64, max_count=None, geometry=None):
+        self.win = win
+        self.geometry = geometry
+        self.max_bytes = None if max_mb is None else max_mb * 1e6
+        self.max_count = max_count
+        self.stims = OrderedDict()  # fname -> (ImageStim, n_bytes), LRU first
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, fname):
+        return fname in self.stims
+
+    def _over_budget(self, extra_bytes):
+        if self.max_count is not None and len(self.stims) + 1 > self.max_count:
+            return True
+        if self.max_bytes is not None and self.n_bytes + extra_bytes > self.max_bytes:
+            return True
+        return False
+
+    def get(self, fname, pixels=None):
+        """
+        ImageStim showing fname.  pixels (a decoded image) saves a load on a
+        miss; it's ignored on a hit.
+        """
+        if fname in self.stims:
+            self.hits += 1
+            self.stims[fname] = self.stims.pop(fname)  # Now most recently used
+            return self.stims[fname][0]
+        self.misses += 1
+        if pixels is None:
+            pixels = load_image(fname, self.geometry)
+        n_bytes = pixels.size[0] * pixels.size[1] * 4
+        stim = None
+        while self.stims and self._over_budget(n_bytes):
+            old_fname, (old_stim, old_bytes) = self.stims.popitem(last=False)
+            self.n_bytes -= old_bytes
+            self.evictions += 1
+            if stim is None:
+                stim = old_stim  # Recycle this one's texture
+            else:
+                old_stim.clearTextures()
+        if stim is None:
+            stim = visual.ImageStim(self.win, image=pixels)
+        else:
+            stim.image = pixels
+        self.stims[fname] = (stim, n_bytes)
+        self.n_bytes += n_bytes
+        return stim
+
+    def summary(self):
+        return ('\nTexture pool: {0} hits, {1} misses, {2} evictions, '
+                '{3} textures ({4:.1f} MB) at the end\n'.format(
+                    self.hits, self.misses, self.evictions, len(self.stims),
+                    self.n_bytes / 1e6))
+
+    def close(self):
+        for stim, n_bytes in self.stims.values():
+            stim.clearTextures()
+        self.stims = OrderedDict()
+        self.n_bytes = 0
+
+
+class PrefetchedImages(object):
+    """
+    Bounded look-ahead loader.  A worker thread decodes the next depth images
+    into PIL images (ready-to-upload pixel buffers) while the current trial is
+    up.  get() takes the decoded buffer if it is there, or falls back to
+    decoding it right away if the worker hasn't got to it yet (a miss).
+    Textures come from a StimulusPool, so an image that comes back (the 2nd
+    of a repeat pair) is often still uploaded and nothing needs decoding.
+
+    win: PsychoPy window the stimuli will be drawn in
+    fnames: image filenames in trial order
+    depth: how many trials ahead of the current one to keep decoded
+    texture_mb: texture budget for the pool
+    geometry: display geometry the images are fit to (see load_image())
+    start: first trial that will be shown (a resumed run starts part way in)
+    """
+
+    def __init__(self, win, fnames, depth=8, texture_mb=64, geometry=None,
+                 start=0):
+        self.win = win
+        self.geometry = geometry
+        self.fnames = list(fnames)
+        self.depth = max(1, int(depth))
+        self.ready = {}  # trial index -> decoded image
+        self.was_ready = []  # 1/0 per get() call, in trial order
+        self.next_index = start  # Anything below this has already been shown
+        self.lock = threading.Lock()  # Guards ready, next_index and the pool
+        self.requests = queue.Queue()
+        self.pool = StimulusPool(win, max_mb=texture_mb, geometry=geometry)
+        for index in range(start, min(start + self.depth, len(self.fnames))):
+            self.requests.put(index)
+        self.worker = threading.Thread(target=self._decode_loop)
+        self.worker.daemon = True  # Never hold up an escape / core.quit()
+        self.worker.start()
+
+    def _decode_loop(self):
+        while True:
+            index = self.requests.get()
+            if index is None:
+                return
+            with self.lock:
+                if index < self.next_index:  # Already loaded synchronously
+                    continue
+                if self.fnames[index] in self.pool:  # Likely a hit - skip the decode
+                    continue
+            pixels = load_image(self.fnames[index], self.geometry)
+            with self.lock:
+                if index >= self.next_index:
+                    self.ready[index] = pixels
+
+    def get(self, index):
+        with self.lock:
+            pixels = self.ready.pop(index, None)
+            self.next_index = index + 1
+            for stale in [i for i in self.ready if i < index]:
+                del self.ready[stale]
+        ahead = index + self.depth
+        if ahead < len(self.fnames):
+            self.requests.put(ahead)
+        fname = self.fnames[index]
+        if pixels is None and fname not in self.pool:  # Miss - load it ourselves
+            self.was_ready.append(0)
+            pixels = load_image(fname, self.geometry)
+        else:
+            self.was_ready.append(1)
+        with self.lock:  # The worker checks what's in the pool
+            return self.pool.get(fname, pixels)
+
+    def summary(self):
+        n_ready = sum(self.was_ready)
+        text = '\n\nPrefetch depth {0}: {1} of {2} images ready in time\n'.format(
+            self.depth, n_ready, len(self.was_ready))
+        text += 'PrefetchReady,' + ','.join(str(r) for r in self.was_ready) + '\n'
+        text += self.pool.summary()
+        return text
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join(1.0)
+        self.pool.close()
+        self.ready = {}
+
+
+def load_images(win, fnames, mode='preload', depth=8, texture_mb=64,
+                banner_mode='text', banner=None, geometry=None, start=0):
+    """
+    Sets up the image loader for a run.
+
+    mode: 'preload' (everything up front) or 'prefetch' (depth trials ahead)
+    depth: look-ahead for 'prefetch'
+    texture_mb: texture budget for 'prefetch' (see StimulusPool)
+    banner_mode: how the instruction banner gets drawn on each trial
+        'text': draw the TextStim as usual
+        'texture': draw a copy rendered once with prerender_banner()
+        'composite': bake it into each image ('preload' only -- 'prefetch'
+            falls back to 'texture')
+    banner: the instruction TextStim
+    geometry: from display_geometry() for the window and stimulus size the
+        script draws at (None = each image at its own pixel size), so the
+        matching resized cache / atlas gets used
+    start: first trial the run will show (trials.n when resuming), so that
+        is where loading starts
+
+    The loader's .banner is what the trial loop should draw after the image
+    (None when it has been composited in).
+    """
+    if banner_mode not in ('text', 'texture', 'composite'):
+        raise ValueError('Unknown banner mode: {0}'.format(banner_mode))
+    if mode == 'prefetch':
+        images = PrefetchedImages(win, fnames, depth=depth, texture_mb=texture_mb,
+                                  geometry=geometry, start=start)
+    elif mode == 'preload':
+        composite_with = banner if banner_mode == 'composite' else None
+        images = PreloadedImages(win, fnames, composite_with=composite_with,
+                                 geometry=geometry, start=start)
+    else:
+        raise ValueError('Unknown image loading mode: {0}'.format(mode))
+    if banner is None or banner_mode == 'text':
+        images.banner = banner
+    elif banner_mode == 'composite' and mode == 'preload':
+        images.banner = None
+    else:
+        images.banner = prerender_banner(win, banner)
+    return images
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build the resized stimulus cache and / or stimulus atlases')
+    parser.add_argument('--build-cache', nargs='+', metavar='SET', default=[],
+                        help='stimulus sets to cache (e.g., 1 C ScC)')
+    parser.add_argument('--pack-atlas', nargs='+', metavar='SET', default=[],
+                        help='stimulus sets to pack into "Set N.atlas" files')
+    parser.add_argument('--win', nargs=2, type=int, default=[800, 800],
+                        help="window size in pixels (the task's window)")
+    parser.add_argument('--units', default='norm', help='pix, norm or height')
+    parser.add_argument('--size', nargs=2, type=float, default=None,
+                        help="box the images are fit into (window units, the "
+                             "task's STIM_SIZE); leave out to keep their own "
+                             "pixel size")
+    parser.add_argument('--hash', action='store_true',
+                        help='also check sources by MD5, not just size/mtime')
+    args = parser.parse_args()
+    if not args.build_cache and not args.pack_atlas:
+        parser.error('nothing to do: give --build-cache and/or --pack-atlas')
+    for stim_set in args.build_cache:
+        build_resized_cache(stim_set, args.win, args.units, args.size,
+                            with_hash=args.hash)
+    for stim_set in args.pack_atlas:
+        pack_atlas(stim_set, display_geometry(args.win, args.units, args.size))
+    sys.exit(0)
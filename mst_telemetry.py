@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Live telemetry from the PsychoPy versions of the MST.
+
+With TELEMETRY_ADDRESS set in a task script, each run sends a UDP datagram
+(one JSON object) to that address when it starts, after every trial and
+when it ends:
+
+    {"kind": "start" / "trial" / "end", "station": <host name>, "id": ...,
+     "script": ..., "table": <trial table name, unique per run>, "seq": n,
+     "n_done": trials so far, "n_trials": trials in the run,
+     "trial": {"trial", "response", "rt", "correct", "onset_error"} (trial only),
+     "old", "similar", "new", "no_response": response counts since the
+         last "start" (the run, a resume or a phase; study phase: indoor as
+         old, outdoor as similar),
+     "accuracy": correct of responses, "rt_mean": s,
+     "jitter_mean", "jitter_max": |onset error| so far in s,
+     "dropped": datagrams that couldn't be sent}
+
+Sending can never hold up the task: the socket is non-blocking, the
+address is looked up once up front, there's no thread or lock, and a
+datagram that can't go out right away (full buffer, no network, nobody
+listening) is dropped and counted, not queued.  The trial message goes out
+in the ISI, after the log row.  With TELEMETRY_ADDRESS None (the default)
+nothing is sent.
+
+Running this file is the monitor: it listens on a port and keeps a table of
+every station sending to it, redrawn every --refresh s:
+    python mst_telemetry.py                  (all interfaces, port DEFAULT_PORT)
+    python mst_telemetry.py --port 47000 --raw   (print each message as JSON)
+and in the task script, e.g.
+    TELEMETRY_ADDRESS = ('192.168.1.20', 47470)
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import json
+import select
+import socket
+import sys
+import time
+
+DEFAULT_PORT = 47470
+STALE_AFTER = 10.0  # s without a message before the monitor marks a station stale
+
+
+class Telemetry(object):
+    """
+    address: (host, port) to send to, or None for no telemetry
+    script, params, table: what's running (sent with every message)
+    """
+
+    def __init__(self, address, script, params, table):
+        self.sock = None
+        self.sent = 0
+        self.dropped = 0
+        self.two_choice = bool(params.get('TwoChoice'))
+        self.base = {'station': socket.gethostname(), 'id': str(params.get('ID', '')),
+                     'script': script, 'table': table, 'seq': 0}
+        self._reset(0, 0)
+        if address is None:
+            return
+        try:  # Look the host up now, not in the middle of the trials
+            family, kind, proto, name, self.address = socket.getaddrinfo(
+                address[0], address[1], 0, socket.SOCK_DGRAM)[0]
+            self.sock = socket.socket(family, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        except (socket.error, OSError) as err:
+            print('Telemetry to {0} is off: {1}'.format(address, err))
+            self.sock = None
+
+    def _reset(self, n_trials, n_done):
+        self.n_trials = n_trials
+        self.n_done = n_done  # Including any done before a resume
+        self.n_seen = 0  # Sent since start()
+        self.counts = [0, 0, 0, 0]  # Old, similar, new, no response (since start())
+        self.n_correct = 0
+        self.n_scored = 0  # Responses with a correct / incorrect (not study trials)
+        self.rt_total = 0.0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+    def _send(self, kind, **fields):
+        if self.sock is None:
+            return
+        self.base['seq'] += 1
+        n_resp = sum(self.counts[:3])
+        message = dict(self.base, kind=kind, t=time.time(), n_done=self.n_done,
+                       n_trials=self.n_trials, old=self.counts[0], similar=self.counts[1],
+                       new=self.counts[2], no_response=self.counts[3],
+                       accuracy=self.n_correct / self.n_scored if self.n_scored else None,
+                       rt_mean=self.rt_total / n_resp if n_resp else None,
+                       jitter_mean=self.jitter_total / self.n_seen if self.n_seen else None,
+                       jitter_max=self.jitter_max, dropped=self.dropped, **fields)
+        try:
+            self.sock.sendto(json.dumps(message).encode('utf-8'), self.address)
+            self.sent += 1
+        except (socket.error, OSError):  # Would block, no route, refused, ... -- drop it
+            self.dropped += 1
+
+    def start(self, n_trials, n_done=0):
+        """
+        n_trials: trials in this run (or phase); n_done: of those, already
+        done (resuming).  Starts the tallies over; seq carries on, so the
+        monitor's loss count holds across phases.
+        """
+        self._reset(n_trials, n_done)
+        self._send('start')
+
+    def trial(self, trial, response, correct, rt, onset_error):
+        """
+        One completed trial: response 0 (rt None) for no response, correct
+        -1 for study trials; onset_error: actual - intended onset (s)
+        """
+        self.n_done += 1
+        self.n_seen += 1
+        if not response:
+            self.counts[3] += 1
+        elif self.two_choice and response == 2:  # Two-choice: 1=old 2=new
+            self.counts[2] += 1
+        else:
+            self.counts[response - 1] += 1
+        if response:
+            self.rt_total += rt
+            if correct >= 0:
+                self.n_scored += 1
+                self.n_correct += correct
+        self.jitter_total += abs(onset_error)
+        self.jitter_max = max(self.jitter_max, abs(onset_error))
+        self._send('trial', trial={'trial': int(trial), 'response': int(response), 'rt': rt,
+                                   'correct': int(correct) if response and correct >= 0 else None,
+                                   'onset_error': onset_error})
+
+    def close(self, done=True):
+        """ done: ran to the end (else escaped) """
+        self._send('end', done=done)
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def format_table(stations, now):
+    """ The monitor's table: one line per run, most recent first """
+    row = '{0:<16.16} {1:<8.8} {2:>9} {3:>6} {4:>6} {5:>6} {6:>4} {7:>5} {8:>6} {9:>13} {10}'
+    lines = [row.format('Station', 'ID', 'Trial', 'Old', 'Sim', 'New', 'NR', 'Acc', 'RT',
+                        'Jitter ms', 'Status')]
+    for key, message in sorted(stations.items(), key=lambda item: -item[1]['t']):
+        done = max(message['old'] + message['similar'] + message['new'] + message['no_response'], 1)
+        if message['kind'] == 'end':
+            status = 'done' if message.get('done') else 'escaped'
+        elif now - message['received'] > STALE_AFTER:
+            status = 'no data {0:.0f} s'.format(now - message['received'])
+        else:
+            status = 'running'
+        if message.get('lost'):
+            status += ' ({0} lost)'.format(message['lost'])
+        jitter = '{0:.1f} / {1:.1f}'.format(1000 * (message['jitter_mean'] or 0.0),
+                                          1000 * message['jitter_max'])
+        lines.append(row.format(
+            message['station'], message['id'],
+            '{0}/{1}'.format(message['n_done'], message['n_trials']),
+            '{0:.0%}'.format(message['old'] / done), '{0:.0%}'.format(message['similar'] / done),
+            '{0:.0%}'.format(message['new'] / done), message['no_response'],
+            '-' if message['accuracy'] is None else '{0:.0%}'.format(message['accuracy']),
+            '-' if message['rt_mean'] is None else '{0:.2f}'.format(message['rt_mean']),
+            jitter, status))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitor for MST telemetry from the testing stations')
+    parser.add_argument('--host', default='', help='interface to listen on (default: all)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='UDP port (default {0})'.format(DEFAULT_PORT))
+    parser.add_argument('--refresh', type=float, default=1.0, help='s between redraws (default 1)')
+    parser.add_argument('--raw', action='store_true', help='print each message as JSON instead')
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((args.host, args.port))
+    print('Listening on {0}:{1}'.format(args.host or '*', args.port), file=sys.stderr)
+    stations = {}
+    next_draw = time.time()
+    try:
+        while True:
+            ready = select.select([sock], [], [], max(0.0, next_draw - time.time()))[0]
+            if ready:
+                data = sock.recv(65536)
+                try:
+                    message = json.loads(data.decode('utf-8'))
+                    key = (message['station'], message['table'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if args.raw:
+                    print(json.dumps(message, sort_keys=True))
+                    sys.stdout.flush()
+                    continue
+                last = stations.get(key)
+                if last is None:
+                    message['lost'] = message['seq'] - 1
+                elif message['seq'] > last['seq']:  # (Including a new phase's start)
+                    message['lost'] = last['lost'] + message['seq'] - last['seq'] - 1
+                elif message['kind'] == 'start':  # A resumed run starts over at seq 1
+                    message['lost'] = last['lost'] + message['seq'] - 1
+                else:
+                    continue  # Out of order
+                message['received'] = time.time()
+                stations[key] = message
+            if not args.raw and time.time() >= next_draw:
+                sys.stdout.write('\033[2J\033[H' + format_table(stations, time.time()) + '\n')
+                sys.stdout.flush()
+                next_draw = time.time() + args.refresh
+    except KeyboardInterrupt:
+        pass
+    sock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
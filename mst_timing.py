@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""
+Frame-locked trial timing shared by the PsychoPy versions of the MST.
+
+The task scripts used to start trial N at trial * (duration + isi) seconds
+on a MonotonicClock and then just flip whenever the image was ready, so
+onsets drifted with load times and never lined up with screen refreshes.
+Here Duration and ISI are converted to whole frames for the measured refresh
+rate, and every flip is placed on a precomputed deadline:
+
+    onset(N) = N * (stim_frames + isi_frames) * frame_period
+
+A late flip doesn't push the rest of the run back -- the next deadline is
+still where it was -- so drift can't accumulate.
+
+Usage in a trial loop:
+    sched = FrameScheduler(win, duration, isi)
+    ...start screen...
+    local_timer = sched.start()
+    for trial in ...:
+        t1 = sched.onset(trial)   (or sched.next_frame() when self-paced)
+        ...draw...
+        sched.flip_at(t1, trial)                   # image on
+        key = sched.waiter.until(sched.flip_due(t1 + sched.duration),
+                                 keyboard.poll, 'response')  # see mst_input
+        sched.flip_at(t1 + sched.duration, trial)  # image off
+        ...ISI: sched.waiter.until(t1 + sched.trial_period - sched.frame_period)
+    log.write(sched.summary())
+
+All the waiting goes through HybridWait, which sleeps most of the way to a
+deadline and spins only for the last few ms, so the task doesn't keep a core
+at 100% for the whole session.  Run this file directly to see how late the
+waits wake up and how much CPU they use on a given machine.
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import time
+import numpy as np
+
+try:
+    from psychopy import core
+except ImportError:
+    core = None
+
+DEFAULT_FRAME_RATE = 60.0  # If the refresh rate can't be measured
+DEFAULT_SPIN_MARGIN = 0.003  # Sleep until this long before a deadline, then spin
+DEFAULT_POLL_HZ = 500  # How often input is checked while waiting
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def use_clock(now=None, sleep=None):
+    """
+    Sets where get_time() and sleep() get their time from.  With no
+    arguments, core.getTime() (or the system clock without PsychoPy) and
+    time.sleep().  mst_headless.py swaps in a virtual clock.
+    """
+    global _now, _sleep
+    if now is None:
+        # The fallback lets the wait measurements below run without PsychoPy
+        now = core.getTime if core is not None else getattr(time, 'perf_counter', time.time)
+    _now = now
+    _sleep = sleep or time.sleep
+
+
+def get_time():
+    return _now()
+
+
+def sleep(secs):
+    _sleep(secs)
+
+
+use_clock()
+
+
+class SessionClock(object):
+    """
+    Seconds since t0 (a core.getTime() timestamp).  Stands in for the
+    MonotonicClock the scripts used, but lets us put zero exactly on a flip.
+    """
+
+    def __init__(self, t0=None):
+        self.t0 = get_time() if t0 is None else t0
+
+    def getTime(self):
+        return get_time() - self.t0
+
+    def getLastResetTime(self):
+        """ So psychopy.event can timestamp keys on this clock """
+        return self.t0
+
+    def local(self, timestamp):
+        """ A core.getTime()-based timestamp (e.g., from win.flip()) on this clock """
+        return timestamp - self.t0
+
+
+class HybridWait(object):
+    """
+    Waits on a clock without burning a core the whole time.  It sleeps in
+    steps of 1/poll_hz (calling poll() between them) until spin_margin
+    before the deadline, then spins for the rest so it wakes on time.
+    core.wait() spins for its last 0.2 s and the old getKeys() loops spun
+    the whole ISI.
+
+    clock: anything with getTime() (e.g., SessionClock)
+    spin_margin: seconds before the deadline to stop sleeping.  It needs to
+        be longer than the OS's sleep granularity (~1 ms on Linux / macOS,
+        up to 15 ms on some Windows machines) -- check with measure=True
+    poll_hz: how often poll() is called while sleeping
+    measure: keep CPU time and wake-up lateness for every wait (summary())
+    """
+
+    def __init__(self, clock, spin_margin=DEFAULT_SPIN_MARGIN,
+                 poll_hz=DEFAULT_POLL_HZ, measure=False):
+        self.clock = clock
+        self.spin_margin = spin_margin
+        self.poll_period = 1.0 / poll_hz
+        self.measure = measure
+        self.stats = {}  # label -> list of [wall s, cpu s, lateness s or nan if ended by poll]
+
+    def until(self, t, poll=None, label='wait'):
+        """
+        Waits until clock time t.  If poll is given, it's called about
+        poll_hz times a second and the first thing it returns that's not
+        empty / None ends the wait early and is returned.  Returns None if
+        the deadline was reached.
+
+        label: what to file this wait under in summary()
+        """
+        if self.measure:
+            wall0 = self.clock.getTime()
+            cpu0 = cpu_time()
+        result = None
+        next_poll = self.clock.getTime()
+        while True:
+            now = self.clock.getTime()
+            if poll is not None and now >= next_poll:
+                result = poll()
+                if result:
+                    break
+                next_poll = now + self.poll_period
+            remaining = t - now
+            if remaining <= 0:
+                break
+            if remaining > self.spin_margin:
+                if poll is None:  # Nothing to check -- sleep the whole way
+                    sleep(remaining - self.spin_margin)
+                else:
+                    sleep(min(self.poll_period, remaining - self.spin_margin))
+        if self.measure:
+            now = self.clock.getTime()
+            lateness = float('nan') if result else now - t
+            self.stats.setdefault(label, []).append(
+                [now - wall0, cpu_time() - cpu0, lateness])
+        return result
+
+    def summary(self):
+        """ Text block for the log (empty unless measuring) """
+        if not self.measure:
+            return ''
+        text = '\n\nWait stats: spin margin {0:.1f} ms, input polled at {1:.0f} Hz\n'.format(
+            self.spin_margin * 1000, 1.0 / self.poll_period)
+        text += 'Wait,N,Seconds,CPU%,EndedEarly,LateMean_ms,LateP95_ms,LateMax_ms\n'
+        for label in sorted(self.stats):
+            stats = np.array(self.stats[label])
+            wall = stats[:, 0].sum()
+            cpu_pct = 100.0 * stats[:, 1].sum() / wall if wall > 0 else 0.0
+            late = stats[~np.isnan(stats[:, 2]), 2] * 1000
+            if len(late):
+                late_text = '{0:.3f},{1:.3f},{2:.3f}'.format(
+                    late.mean(), np.percentile(late, 95), late.max())
+            else:
+                late_text = 'NA,NA,NA'
+            text += '{0},{1},{2:.2f},{3:.1f},{4},{5}\n'.format(
+                label, len(stats), wall, cpu_pct, len(stats) - len(late), late_text)
+        return text
+
+
+class TriggerTimeline(object):
+    """
+    Scanner time from counted trigger pulses (fMRI).  Each trigger's index
+    is its gap from the last good one in TRs, so a missed pulse shows up as a
+    gap of 2+ TRs (and the count still comes out right) and an extra one --
+    a double pulse / key bounce -- as a gap under half a TR, which is logged
+    and ignored.  The TR and the time of pulse 0 are refit to the good pulses
+    as they come in, so onsets follow the scanner's clock rather than ours
+    however far the two drift apart over a run.
+
+    tr: nominal TR in seconds
+    dummy_trs: pulses to let go by before the run starts; scanner time 0 is
+        the pulse after that many.  Use at least 1 so the first image can be
+        ready on time.
+
+    Times in and out are core.getTime() (get_time()) timestamps.
+    """
+
+    def __init__(self, tr, dummy_trs=1):
+        self.tr = tr
+        self.dummy_trs = dummy_trs
+        self.reset()
+
+    def reset(self):
+        """ Forgets all triggers so far (counting restarts from the next one) """
+        self.pulses = []  # [time, index or None if extra, status] for every trigger
+        self.fit = None  # (time of pulse 0, TR) on our clock
+        self.missed = 0
+        self.extra = 0
+
+    def add(self, t):
+        """ Counts a trigger seen at time t """
+        good = [p for p in self.pulses if p[1] is not None]
+        if not good:
+            index = 0
+            status = 'first'
+        else:
+            tr = self.fit[1]
+            n = int(round((t - good[-1][0]) / tr))
+            if n < 1:
+                index = None
+                status = 'extra'
+                self.extra += 1
+            else:
+                index = good[-1][1] + n
+                status = 'ok' if n == 1 else 'missed {0}'.format(n - 1)
+                self.missed += n - 1
+        self.pulses.append([t, index, status])
+        if index is not None:
+            good.append([t, index, status])
+            if len(good) == 1:
+                self.fit = (t, self.tr)
+            else:
+                indexes = np.array([p[1] for p in good], dtype=float)
+                times = np.array([p[0] for p in good])
+                tr, t0 = np.polyfit(indexes, times, 1)
+                self.fit = (t0, tr)
+
+    def started(self):
+        return self.fit is not None
+
+    def time_of(self, scanner_time):
+        """ When scanner_time (seconds from the start of the run) happens on our clock """
+        t0, tr = self.fit
+        return t0 + tr * (self.dummy_trs + scanner_time / self.tr)
+
+    def summary(self, clock):
+        """ Text block for the log; trigger times are on clock (SessionClock) """
+        t0, tr = self.fit if self.fit is not None else (0, self.tr)
+        text = '\n\nScanner triggers: nominal TR {0:.4f} s, measured {1:.6f} s ({2:+.1f} ppm), {3} triggers, {4} missed, {5} extra\n'.format(
+            self.tr, tr, (tr / self.tr - 1) * 1e6, len(self.pulses), self.missed, self.extra)
+        text += 'Trigger,N,Pulse,Time,Status\n'
+        for i, (t, index, status) in enumerate(self.pulses):
+            text += 'Trigger,{0},{1},{2:.4f},{3}\n'.format(
+                i + 1, 'NA' if index is None else index, clock.local(t), status)
+        return text
+
+
+class FrameScheduler(object):
+    """
+    win: PsychoPy window
+    duration, isi: requested times in seconds (params['Duration'], ['ISI'])
+    frame_rate: refresh rate in Hz; measured from the window if None
+    spin_margin, poll_hz, measure: settings for .waiter (see HybridWait),
+        which does all the waiting until flips
+    scanner_tr, dummy_trs: lock onsets to scanner triggers with this TR
+        (.timeline, see TriggerTimeline) rather than to the computer's clock.
+        Something has to feed it triggers (mst_input.ResponseInput does).
+
+    After construction, .duration and .isi hold the frame-quantized times
+    that will actually be used (at least one frame each).
+    """
+
+    def __init__(self, win, duration, isi, frame_rate=None,
+                 spin_margin=DEFAULT_SPIN_MARGIN, poll_hz=DEFAULT_POLL_HZ,
+                 measure=False, scanner_tr=None, dummy_trs=1):
+        self.win = win
+        if frame_rate is None:
+            frame_rate = win.getActualFrameRate()
+            if frame_rate is None:
+                print('Could not measure the refresh rate - assuming {0} Hz'.format(
+                    DEFAULT_FRAME_RATE))
+                frame_rate = DEFAULT_FRAME_RATE
+        self.frame_rate = frame_rate
+        self.frame_period = 1.0 / frame_rate
+        self.stim_frames = max(1, int(round(duration / self.frame_period)))
+        self.isi_frames = max(1, int(round(isi / self.frame_period)))
+        self.duration = self.stim_frames * self.frame_period
+        self.isi = self.isi_frames * self.frame_period
+        self.trial_period = self.duration + self.isi
+        self.clock = SessionClock()  # Re-zeroed by start()
+        self.waiter = HybridWait(self.clock, spin_margin, poll_hz, measure)
+        self.timeline = None if not scanner_tr else TriggerTimeline(scanner_tr, dummy_trs)
+        self.records = {}  # trial -> [intended on, actual on, intended off, actual off]
+
+    def start(self, poll=None):
+        """
+        Anchors the schedule.  Flips once (whatever is in the back buffer --
+        normally a blank screen) and puts time zero on the following refresh,
+        which is when trial 0 is due.  Returns the session clock.
+
+        With a scanner timeline, time zero is instead the first pulse after
+        the dummy TRs, and this waits for the first trigger (any that came in
+        earlier, e.g. during the start screen, are dropped).  poll() has to
+        drain the input devices while it does; if it returns something (e.g.,
+        an escape) the wait is abandoned and this returns None.
+        """
+        flip_time = self.win.flip()
+        if self.timeline is None:
+            self.clock.t0 = flip_time + self.frame_period
+        else:
+            if poll():
+                return None
+            self.timeline.reset()
+            self.waiter.until(float('inf'), lambda: poll() or self.timeline.started(), 'trigger')
+            if not self.timeline.started():
+                return None
+            self.clock.t0 = self.timeline.time_of(0)
+        return self.clock
+
+    def onset(self, trial):
+        """
+        Scheduled onset (session seconds) of a trial.  With a scanner
+        timeline this follows the latest fit to the triggers.
+        """
+        if self.timeline is None:
+            return trial * self.trial_period
+        return self.clock.local(self.timeline.time_of(trial * self.trial_period))
+
+    def next_frame(self):
+        """ The first refresh we can still make from now (for self-paced runs) """
+        now = self.clock.getTime()
+        n_frames = np.ceil(now / self.frame_period + 0.5)
+        return n_frames * self.frame_period
+
+    def flip_due(self, t):
+        """
+        When a flip_at(t) has to start -- i.e., how long other waits (e.g.,
+        for keys) can run before it
+        """
+        return t - self.frame_period / 2.0
+
+    def flip_at(self, t, trial=None):
+        """
+        Flips so the new frame appears at session time t.  We wait until half a
+        frame before t and then flip, so win.flip() syncs to the refresh at t.
+        If we're already past that point, it flips right away (late).
+
+        trial: record this as the onset (first call) / offset (second call)
+            of that trial for summary()
+
+        Returns the actual flip time (session seconds)
+        """
+        self.waiter.until(self.flip_due(t), label='flip')
+        actual = self.clock.local(self.win.flip())
+        if trial is not None:
+            record = self.records.setdefault(trial, [])
+            record.extend([t, actual])
+        return actual
+
+    def onset_errors(self):
+        """ Actual - intended onset for each recorded trial, in trial order """
+        return np.array([self.records[t][1] - self.records[t][0]
+                         for t in sorted(self.records)])
+
+    def summary(self):
+        """ Text block for the log: settings plus intended vs actual flip times """
+        text = '\n\nFrame timing: {0:.2f} Hz, {1} stim frames ({2:.4f} s), {3} ISI frames ({4:.4f} s)\n'.format(
+            self.frame_rate, self.stim_frames, self.duration, self.isi_frames, self.isi)
+        errors = self.onset_errors()
+        if len(errors):
+            late = np.sum(errors > self.frame_period / 2.0)
+            text += 'Onset error: mean {0:.4f} s, max {1:.4f} s, {2} flips late by over half a frame\n'.format(
+                errors.mean(), np.abs(errors).max(), late)
+        text += 'FlipTimes,Trial,IntendedOn,ActualOn,IntendedOff,ActualOff\n'
+        for trial in sorted(self.records):
+            record = self.records[trial] + [float('nan')] * (4 - len(self.records[trial]))
+            text += 'FlipTimes,{0},{1:.4f},{2:.4f},{3:.4f},{4:.4f}\n'.format(
+                trial + 1, *record[:4])
+        if self.timeline is not None:
+            text += self.timeline.summary(self.clock)
+        return text + self.waiter.summary()
+
+
+class TrialTiming(object):
+    """
+    Per-trial instrumentation for the log (for certifying a testing station).
+    In the trial loop:
+        timing.start()
+        ...write / flush the start of the log row...
+        timing.lap('log')
+        image = images.get(trial)
+        timing.lap('load')
+        ...draw...
+        timing.lap('draw')
+        ...flips (through sched, which keeps their times)...
+        log.write(... + timing.row(trial))
+
+    Each row adds COLUMNS: image-load, draw and log-write times (ms), the
+    actual onset flip (session s), its error vs the schedule (ms) and the
+    number of frames the onset and offset flips missed.
+    """
+    COLUMNS = 'LoadT,DrawT,FlipT,OnsetErr,Dropped,LogT'
+
+    def __init__(self, sched):
+        self.sched = sched
+        self.t = None
+        self.laps = {}
+        self.rows = []  # [load, draw, onset error, dropped, log] per trial (ms / frames)
+
+    def start(self):
+        self.t = get_time()
+        self.laps = {}
+
+    def lap(self, name):
+        """ Time since the last start() / lap() goes under name """
+        now = get_time()
+        self.laps[name] = now - self.t
+        self.t = now
+
+    def row(self, trial):
+        """ This trial's columns, comma-separated (no leading comma) """
+        record = self.sched.records[trial]
+        errors = np.array(record[1::2]) - np.array(record[0::2])
+        dropped = int(np.sum(np.maximum(np.round(errors / self.sched.frame_period), 0)))
+        values = [self.laps.get('load', np.nan) * 1000, self.laps.get('draw', np.nan) * 1000,
+                  record[1], errors[0] * 1000, dropped, self.laps.get('log', np.nan) * 1000]
+        self.rows.append(values[:2] + values[3:])
+        return '{0:.2f},{1:.2f},{2:.4f},{3:.2f},{4},{5:.2f}'.format(*values)
+
+    def summary(self):
+        """ Text block for the log: percentiles of each measure and an onset-error histogram """
+        text = '\n\nStation timing: {0} trials at {1:.2f} Hz\n'.format(len(self.rows), self.sched.frame_rate)
+        if not self.rows:
+            return text
+        rows = np.array(self.rows)
+        text += 'Timing,Mean,P50,P95,P99,Max\n'
+        for name, col in [('LoadT', 0), ('DrawT', 1), ('OnsetErr', 2), ('LogT', 4)]:
+            values = rows[:, col]
+            values = values[~np.isnan(values)]
+            if len(values):
+                text += '{0},{1:.2f},{2:.2f},{3:.2f},{4:.2f},{5:.2f}\n'.format(
+                    name, values.mean(), *np.percentile(values, [50, 95, 99, 100]))
+        dropped = rows[:, 3]
+        text += 'Dropped frames,{0:.0f},on {1} trials\n'.format(dropped.sum(), int(np.sum(dropped > 0)))
+        # 1 ms bins from half a frame early to two frames late, plus anything outside that
+        fp = self.sched.frame_period * 1000
+        edges = np.arange(np.floor(-fp / 2), np.ceil(2 * fp) + 1)
+        edges = np.concatenate([[-np.inf], edges, [np.inf]])
+        counts = np.histogram(rows[:, 2], edges)[0]
+        text += 'OnsetErrHist,From_ms,To_ms,Count\n'
+        for lo, hi, count in zip(edges[:-1], edges[1:], counts):
+            text += 'OnsetErrHist,{0:.0f},{1:.0f},{2}\n'.format(lo, hi, count)
+        return text
+
+
+def measure_waits(duration, margins, poll_hz=DEFAULT_POLL_HZ, n=200):
+    """
+    Times n waits of the given duration for each spin margin (no window
+    needed) so a machine's sleep granularity and the CPU cost of each margin
+    can be checked before picking WAIT_SPIN_MARGIN.  Returns the summaries.
+    """
+    text = ''
+    for margin in margins:
+        waiter = HybridWait(SessionClock(), margin, poll_hz, measure=True)
+        for i in range(n):
+            waiter.until(waiter.clock.getTime() + duration, poll=lambda: None,
+                         label='{0:.1f}ms'.format(margin * 1000))
+        text += waiter.summary()
+    return text
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure CPU use and wake-up lateness of the hybrid wait')
+    parser.add_argument('--measure', type=float, default=0.5, metavar='SECONDS',
+                        help='length of each wait (default 0.5, the standard ISI)')
+    parser.add_argument('--margins', type=float, nargs='+', metavar='MS',
+                        default=[0, 1, 2, 3, 5, 10],
+                        help='spin margins to try, in ms')
+    parser.add_argument('--poll-hz', type=float, default=DEFAULT_POLL_HZ)
+    parser.add_argument('-n', type=int, default=20, help='waits per margin')
+    args = parser.parse_args()
+    print(measure_waits(args.measure, [m / 1000.0 for m in args.margins],
+                        args.poll_hz, args.n).strip())
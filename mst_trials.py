@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Machine-readable trial tables for the PsychoPy versions of the MST.
+
+MST_<ID>.txt mixes the header, the CSV trial rows and the summary blocks,
+and every session is appended to the same file, so getting the trials back
+out means parsing text.  Each run now also writes its trials as a table
+with fixed, typed columns next to the log:
+
+    MST_<ID>_<date>_<time>.csv           trial rows, header first
+    MST_<ID>_<date>_<time>.parquet       same, if pyarrow is installed
+    MST_<ID>_<date>_<time>.npz           ... otherwise one array per column
+    MST_<ID>_<date>_<time>.params.json   params, seed, script, column types
+
+Columns (COLUMNS):
+    trial      trial number as logged (1-based)
+    stim       stimulus number (the 123 in 123a.jpg)
+    fname      image file shown
+    set        stimulus set
+    type_code  0=1st of repeat, 1=2nd of repeat, 2=1st of lure, 3=2nd of
+               lure, 4=foil (MST_PsychoPy's SR/SL/TR/TL/TF map onto these)
+    lag        items between 1st and 2nd (-1 = 1st / foil / not continuous)
+    lure_bin   lure bin of the stimulus pair (the log's LBin)
+    onset      when the image actually went up (s on the session clock)
+    response   1=old 2=similar 3=new (study: 1=indoor 2=outdoor), 0=none
+    rt         seconds from onset, NaN if no response
+    correct    1 / 0, -1 if no response (or study trials)
+
+The table is written when the task closes it, so a run that's escaped out
+of still gets the trials it finished.  With a journal attached (see
+mst_journal.py) each trial is also journaled as it's added, and a resumed
+session restore()s the journaled trials first so the table (and the
+summary scored from it) covers the whole session.
+"""
+
+from __future__ import print_function, division
+
+import csv
+import json
+import os
+from datetime import datetime
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Falls back to .npz
+    pyarrow = None
+
+COLUMNS = [('trial', 'int32'),
+           ('stim', 'int32'),
+           ('fname', 'str'),
+           ('set', 'str'),
+           ('type_code', 'int8'),
+           ('lag', 'int32'),
+           ('lure_bin', 'int8'),
+           ('onset', 'float64'),
+           ('response', 'int8'),
+           ('rt', 'float64'),
+           ('correct', 'int8')]
+
+# MST_PsychoPy's condition labels as continuous-version type codes
+COND_CODES = {'SR': 0, 'TR': 1, 'SL': 2, 'TL': 3, 'TF': 4}
+
+
+class TrialTable(object):
+    """
+    log_name: the session's log file; the table goes next to it
+    params: the session's parameters (written to the JSON sidecar)
+    base: file name without the extension (default: from log_name and the
+        time; a resumed session passes its original one)
+    extra: anything else for the sidecar (e.g., seed, script)
+    """
+
+    def __init__(self, log_name, params, base=None, **extra):
+        if base is None:
+            stem = '{0}_{1}'.format(os.path.splitext(log_name)[0],
+                                    datetime.now().strftime('%Y%m%d_%H%M%S'))
+            base = stem
+            n = 1
+            while os.path.exists(base + '.csv') or os.path.exists(base + '.journal'):  # Two runs in the same second
+                n += 1
+                base = '{0}_{1}'.format(stem, n)
+        self.base = base
+        self.journal = None
+        self.log_name = os.path.basename(log_name)
+        self.params = params
+        self.extra = extra
+        self.columns = dict((name, []) for name, dtype in COLUMNS)
+        self.closed = False
+
+    def add(self, trial, fname, set_name, type_code, lure_bin, onset,
+            response=0, rt=None, correct=-1, lag=-1):
+        """ One trial; response 0 (with rt None) for no response """
+        if not isinstance(type_code, (int, np.integer)):
+            type_code = COND_CODES[type_code]
+        values = {'trial': trial, 'stim': int(fname[-8:-5]), 'fname': fname,
+                  'set': set_name, 'type_code': type_code, 'lag': lag,
+                  'lure_bin': lure_bin, 'onset': onset, 'response': response,
+                  'rt': np.nan if rt is None else rt,
+                  'correct': correct if response else -1}
+        self._append(values)
+        if self.journal is not None:
+            self.journal.trial(values)
+
+    def restore(self, rows):
+        """ Puts back trials read from a journal (not journaled again) """
+        for row in rows:
+            self._append(dict(row, rt=np.nan if row['rt'] is None else row['rt']))
+
+    def _append(self, values):
+        for name, dtype in COLUMNS:
+            self.columns[name].append(values[name])
+
+    @property
+    def n(self):
+        """ Trials so far """
+        return len(self.columns['trial'])
+
+    def arrays(self):
+        """ The columns as typed numpy arrays """
+        return [(name, np.array(self.columns[name], dtype=dtype))
+                for name, dtype in COLUMNS]
+
+    def close(self):
+        """ Writes the table and sidecar; returns the file names """
+        if self.closed:
+            return []
+        self.closed = True
+        arrays = self.arrays()
+        names = write_table(self.base, arrays)
+        sidecar = {'params': self.params,
+                   'log': self.log_name,
+                   'n_trials': len(arrays[0][1]),
+                   'columns': ['{0}:{1}'.format(name, dtype) for name, dtype in COLUMNS],
+                   'table': os.path.basename(names[1])}
+        sidecar.update(self.extra)
+        names.append(self.base + '.params.json')
+        with open(names[-1], 'w') as f:
+            json.dump(sidecar, f, indent=1, sort_keys=True, default=str)
+        return names
+
+
+def write_table(base, arrays):
+    """
+    Writes [(name, array)] columns to base.csv and to base.parquet (or
+    base.npz without pyarrow).  Returns the two file names.
+    """
+    names = [base + '.csv']
+    with open(names[0], 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([name for name, values in arrays])
+        for i in range(len(arrays[0][1]) if arrays else 0):
+            writer.writerow([_csv_value(values[i]) for name, values in arrays])
+    if pyarrow is not None:
+        names.append(base + '.parquet')
+        pyarrow.parquet.write_table(
+            pyarrow.table(dict((name, values) for name, values in arrays)), names[-1])
+    else:
+        names.append(base + '.npz')
+        np.savez(names[-1], **dict(arrays))
+    return names
+
+
+def _csv_value(value):
+    if isinstance(value, float) and np.isnan(value):
+        return 'NA'
+    if isinstance(value, (float, np.floating)):
+        return '{0:.4f}'.format(value)
+    return value
+
+
+def load(base):
+    """
+    Reads a table back (from the .parquet or .npz, whichever is there) as a
+    dict of column arrays, plus the sidecar as 'meta'
+    """
+    with open(base + '.params.json') as f:
+        meta = json.load(f)
+    data = read_table(base, COLUMNS)
+    data['meta'] = meta
+    return data
+
+
+def read_table(base, columns):
+    """
+    Reads what write_table() wrote as a dict of column arrays -- from the
+    .parquet or .npz if there is one, else the .csv typed by columns
+    ([(name, dtype)])
+    """
+    if os.path.exists(base + '.parquet') and pyarrow is not None:
+        table = pyarrow.parquet.read_table(base + '.parquet')
+        return dict((name, table.column(name).to_numpy()) for name in table.column_names)
+    if os.path.exists(base + '.npz'):
+        with np.load(base + '.npz') as npz:
+            return dict((name, npz[name]) for name in npz.files)
+    data = {}
+    with open(base + '.csv') as f:
+        rows = list(csv.reader(f))
+    for i, (name, dtype) in enumerate(columns):
+        values = [row[i] for row in rows[1:]]
+        if dtype.startswith('float'):
+            values = [np.nan if v == 'NA' else float(v) for v in values]
+        elif dtype == 'bool':
+            values = [v == 'True' for v in values]
+        data[name] = np.array(values, dtype=dtype)
+    return data
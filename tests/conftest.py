@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The mst_*.py modules and the task scripts live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
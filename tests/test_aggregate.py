@@ -0,0 +1,133 @@
+"""
+mst_aggregate's log parser (resumed and escaped sessions, two-choice) and
+its LogCache, on logs from headless runs (mst_headless.py)
+"""
+
+from __future__ import division
+
+import glob
+import os
+import time
+
+import numpy as np
+import pytest
+
+import mst_aggregate
+import mst_headless
+import mst_trials
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = 'MST_Continuous_PsychoPy.py'
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    """ session(log, escape_after=None, resume=None, **params) runs one headless session """
+    monkeypatch.chdir(REPO)  # The scripts read the bins, sets and lag files from here
+    on_flip = mst_headless.SimulatedParticipant.on_flip
+
+    def run(log, escape_after=None, resume=None, **params):
+        shown = [0]
+
+        def escaping_on_flip(self, images, t):
+            on_flip(self, images, t)
+            if images:
+                shown[0] += 1
+                if shown[0] == escape_after:
+                    self.pending = [('escape', t + 0.2)]
+
+        monkeypatch.setattr(mst_headless.SimulatedParticipant, 'on_flip', escaping_on_flip)
+        params.setdefault('ID', 4242)
+        mst_headless.run(SCRIPT, params, log_file=str(tmp_path / log), resume=resume)
+        return str(tmp_path / log)
+    return run
+
+
+def table_trials(tmp_path):
+    """ The trial table a session left next to its log """
+    base = glob.glob(str(tmp_path / '*.params.json'))[0][:-len('.params.json')]
+    return mst_trials.load(base)
+
+
+def test_resume_joins_the_escaped_session(tmp_path, session):
+    log = session('MST_4242.txt', escape_after=30)
+    journal = glob.glob(str(tmp_path / '*.journal'))[0]
+    session('MST_4242.txt', resume=journal)
+
+    sessions = mst_aggregate.parse_file(log)
+    assert len(sessions) == 1  # The escaped one is replaced by the resumed one
+    resumed = sessions[0]
+    assert resumed['session'] == 2
+    assert not resumed['aborted']
+    table = table_trials(tmp_path)
+    assert len(resumed['rows']) == len(table['type_code']) == resumed['n_run']
+    np.testing.assert_array_equal([row['type_code'] for row in resumed['rows']], table['type_code'])
+    np.testing.assert_array_equal([row['response'] for row in resumed['rows']], table['response'])
+    scores = resumed['scores']
+    assert scores['pc_raw'] == pytest.approx(np.sum(table['correct'] == 1) / resumed['n_run'])  # -1 = no response
+
+
+def test_escaped_session(session):
+    log = session('MST_4242.txt', escape_after=40)
+    sessions = mst_aggregate.parse_file(log)
+    assert len(sessions) == 1
+    escaped = sessions[0]
+    assert escaped['aborted']
+    assert len(escaped['rows']) < escaped['n_run']
+    # Out of the run's trial count, as the script's own summary is
+    scores = escaped['scores']
+    assert scores['pc_raw'] == pytest.approx(scores['ncorrect'] / escaped['n_run'])
+
+
+def test_two_choice_has_no_ldi(session):
+    log = session('MST_4242.txt', TwoChoice=True)
+    session('MST_4242.txt')
+    two, three = mst_aggregate.parse_file(log)
+    assert two['two_choice'] and not three['two_choice']
+    for name in mst_aggregate.TWO_CHOICE_NAN:
+        assert np.isnan(two['scores'][name])
+        assert not np.isnan(three['scores'][name])
+    assert not np.isnan(two['scores']['dpTF'])
+
+
+def test_cache(tmp_path, session, monkeypatch):
+    logs = [session('MST_1.txt', ID=1), session('MST_2.txt', ID=2)]
+    cache_name = str(tmp_path / 'cohort.cache')
+
+    def run_cached(fnames):
+        cache = mst_aggregate.LogCache(cache_name)
+        sessions = mst_aggregate.aggregate(fnames, jobs=1, cache=cache)
+        cache.save()
+        return cache, sessions
+
+    cache, sessions = run_cached(logs)
+    assert (cache.parsed, cache.updated) == (2, True)
+    fresh = mst_aggregate.aggregate(logs, jobs=1)
+
+    # Nothing changed: nothing parsed, and the same sessions back
+    cache, sessions = run_cached(logs)
+    assert (cache.parsed, cache.updated) == (0, False)
+    assert [s['scores']['pc_raw'] for s in sessions] == [s['scores']['pc_raw'] for s in fresh]
+    assert [len(s['rows']) for s in sessions] == [len(s['rows']) for s in fresh]
+
+    # Touched but not changed: hashed, not parsed
+    later = time.time() + 10
+    os.utime(logs[0], (later, later))
+    cache, sessions = run_cached(logs)
+    assert (cache.parsed, cache.updated, cache.changed) == (0, False, True)
+
+    # Another session appended: that log is parsed again
+    session('MST_2.txt', ID=2)
+    cache, sessions = run_cached(logs)
+    assert (cache.parsed, cache.updated) == (1, True)
+    assert len(sessions) == 3
+
+    # A log gone: dropped from the cache
+    cache, sessions = run_cached(logs[1:])
+    assert (cache.parsed, cache.updated) == (0, True)
+    assert list(cache.entries) == logs[1:]
+
+    # A cache from another version of the parser is ignored
+    assert mst_aggregate.LogCache(cache_name).entries
+    monkeypatch.setattr(mst_aggregate, 'CACHE_VERSION', mst_aggregate.CACHE_VERSION + 1)
+    assert mst_aggregate.LogCache(cache_name).entries == {}
@@ -0,0 +1,96 @@
+"""
+LagGenerator/make_lags.py: seeded output against the original pandas
+version (the order and debug files it wrote for random.seed(0 .. 29), as
+SHA-1 prefixes), and the shape of a trial list
+"""
+
+from __future__ import division
+
+import hashlib
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'LagGenerator'))
+import make_lags  # noqa: E402
+
+# seed -> (order file, debug file)
+ORIGINAL_OUTPUT = {
+    0: ('69c346c0a69777c1', 'e86e8a8c43317583'),
+    1: ('e160d49d64efbfd8', 'b8ce3e4cbd8f3e11'),
+    2: ('9c75d7ca5da45aab', '1d0f84a07902dcb3'),
+    3: ('3a278e73882184b1', '89e16effadafe46c'),
+    4: ('ffa9764e652817b9', 'e988a85906f5d82e'),
+    5: ('e96b69d082e43211', 'ee99d06086b70848'),
+    6: ('c3cc34b591b40a45', 'c14f9eab7a311c73'),
+    7: ('8a051d8fa059312b', '5d8721f7dd91ef0b'),
+    8: ('09989ea0ddd4a4b8', 'a3186f1bceb09544'),
+    9: ('cf08de17f01a23f2', '03fad24f04a496ba'),
+    10: ('c4f9f23f4f697869', '6ac0e88a41bc3324'),
+    11: ('32f9b46172e65e32', '9853bbe39d344c20'),
+    12: ('38fd11f36abbb8a9', 'a0cb8b623901dab1'),
+    13: ('0e9dfe6954558bb9', 'f250a22d54408915'),
+    14: ('12718d8b24a0abc6', 'e8b54dc6c54683d4'),
+    15: ('7ef46b2470406310', '4d4f70aebcdcf495'),
+    16: ('155ccd4ddadd65a5', 'a516d650b6566850'),
+    17: ('6ba350ee10f5a2ab', '5848f2b44e4e343f'),
+    18: ('45c5284526770569', '5f6558a277044d68'),
+    19: ('3f5b15574dd32967', '76bfd820cf2c5b2e'),
+    20: ('e2f2c448858c6af7', '5fe054456278d039'),
+    21: ('02b3dc927e7baaed', 'd3b5430b3bc2f30e'),
+    22: ('9bbf106fce3f0442', '2962a749687a189b'),
+    23: ('2013c6ae0c775959', 'f6acb8ba20162735'),
+    24: ('8be7872874a72919', '614e7ab152ff0fdb'),
+    25: ('97b601623e5b770d', '37679d5f86938d48'),
+    26: ('dae2a46e5da778e1', '662ac48d1ca53576'),
+    27: ('5c2e62303037ea1d', '951dec7db8324e58'),
+    28: ('ac284b9401b1bec5', 'a7a5b495d57dfa2c'),
+    29: ('9e0db72c9a2b2a3a', 'f9fa0a096575d941'),
+}
+
+
+def sha1(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+@pytest.mark.parametrize('seed', sorted(ORIGINAL_OUTPUT))
+def test_same_output_as_the_original(seed, tmp_path):
+    order, debug = str(tmp_path / 'order.csv'), str(tmp_path / 'debug.csv')
+    random.seed(seed)
+    make_lags.main(order, debug)
+    assert (sha1(order), sha1(debug)) == ORIGINAL_OUTPUT[seed]
+
+
+def test_trial_list():
+    random.seed(1234)
+    trial_list = make_lags.make_trial_list()
+    assert trial_list.shape == (make_lags.TOTAL_TRIALS, len(make_lags.COLUMNS))
+    stim = trial_list[:, make_lags.STIM_NUMBER]
+    kind = trial_list[:, make_lags.TRIAL_TYPE]
+    rep = trial_list[:, make_lags.REPETITION]
+    lag = trial_list[:, make_lags.LAG]
+    assert np.all(stim != make_lags.EMPTY)
+
+    foils = kind == make_lags.TRIAL_TYPES.index('foil')
+    assert sorted(stim[foils]) == list(range(1, make_lags.FOIL_TRIALS + 1))
+    assert np.all(rep[foils] == make_lags.REPETITIONS.index('x'))
+
+    n_pairs = sum(make_lags.PAIR_COUNTS)
+    for pair_type in make_lags.PAIR_TYPES:
+        of_type = kind == make_lags.TRIAL_TYPES.index(pair_type)
+        assert sorted(stim[of_type]) == sorted(list(range(1, n_pairs + 1)) * 2)
+        lags = []
+        for number in range(1, n_pairs + 1):
+            first, second = np.flatnonzero(of_type & (stim == number))
+            assert rep[first] == make_lags.REPETITIONS.index('a')
+            assert rep[second] == make_lags.REPETITIONS.index('b')
+            assert lag[first] == lag[second] == second - first - 1
+            lags.append(lag[first])
+        # Each lag range gets its count of pairs
+        for n, lag_range in make_lags.LAG_COUNTS:
+            assert sum(1 for l in lags if l in lag_range) == n
@@ -0,0 +1,165 @@
+"""
+mst_scoring against the trial-by-trial scoring the task scripts used to do
+(show_task() in MST_Continuous_PsychoPy.py before it moved to mst_scoring),
+transcribed below as old_scoring()
+"""
+
+from __future__ import division
+
+import numpy as np
+import pytest
+from scipy.stats import norm
+
+from mst_scoring import score, summary_text, correct
+
+
+def old_scoring(type_code, response, lure_bin, two_choice):
+    """ The old loop: (ncorrect, TLF_trials, TLF_response_matrix, lure_bin_matrix, summary text) """
+    TLF_trials = np.zeros(3)
+    TLF_response_matrix = np.zeros((3, 3))
+    lure_bin_matrix = np.zeros((4, 5))
+    ncorrect = 0
+    for trial in range(len(type_code)):
+        resp = response[trial]
+        corr = 0
+        if resp > 0:
+            if type_code[trial] == 1:
+                TLF_trials[0] += 1
+                trial_type = 1
+            elif type_code[trial] == 3:
+                TLF_trials[1] += 1
+                trial_type = 2
+            else:
+                TLF_trials[2] += 1
+                trial_type = 3
+            TLF_response_matrix[resp - 1, trial_type - 1] += 1
+            if two_choice:
+                if (trial_type == 1 and resp == 1) or (trial_type == 2 and resp == 2) or \
+                        (trial_type == 3 and resp == 2):
+                    corr = 1
+            else:
+                if (trial_type == 1 and resp == 1) or (trial_type == 2 and resp == 2) or \
+                        (trial_type == 3 and resp == 3):
+                    corr = 1
+        if type_code[trial] == 3:
+            resp_index = resp - 1
+            if resp_index == -1:
+                resp_index = 3
+            lure_bin_matrix[resp_index, lure_bin[trial] - 1] += 1
+        ncorrect += corr
+    counts = (TLF_trials.copy(), TLF_response_matrix.copy(), lure_bin_matrix.copy())
+
+    text = '\nValid responses:\nTargets, {0:.0f}\nlures, {1:.0f}\nfoils, {2:.0f}'.format(
+        TLF_trials[0], TLF_trials[1], TLF_trials[2])
+    text += '\nCorrected rates\n'
+    text += '\nRateMatrix,Targ,Lure,Foil\n'
+    TLF_trials[TLF_trials == 0.0] = 0.00001
+    for i, name in enumerate(['Old', 'Similar', 'New']):
+        text += '{0},{1:.2f},{2:.2f},{3:.2f}\n'.format(
+            name, TLF_response_matrix[i, 0] / TLF_trials[0],
+            TLF_response_matrix[i, 1] / TLF_trials[1],
+            TLF_response_matrix[i, 2] / TLF_trials[2])
+    text += '\nRaw counts'
+    text += '\nRawRespMatrix,Targ,Lure,Foil\n'
+    for i, name in enumerate(['Old', 'Similar', 'New']):
+        text += '{0},{1:.0f},{2:.0f},{3:.0f}\n'.format(name, *TLF_response_matrix[i])
+    text += '\n\nLureRawRespMatrix,Bin1,Bin2,Bin3,Bin4,Bin5\n'
+    for i, name in enumerate(['Old', 'Similar', 'New', 'NR']):
+        text += '{0},{1:.0f},{2:.0f},{3:.0f},{4:.0f},{5:.0f}\n'.format(name, *lure_bin_matrix[i])
+    text += '\nPercent-correct (corrected),{0:.2}\n'.format(ncorrect / TLF_trials.sum())
+    text += 'Percent-correct (raw),{0:.2}\n'.format(ncorrect / len(type_code))
+    hit_rate = TLF_response_matrix[0, 0] / TLF_trials[0]
+    false_rate = TLF_response_matrix[0, 2] / TLF_trials[2]
+    text += '\nCorrected recognition (REC) (p(Old|Target)-p(Old|Foil)), {0:.2f}'.format(
+        hit_rate - false_rate)
+    metrics = {'REC': hit_rate - false_rate}
+    if two_choice:
+        text += '\nTwo-choice test metrics\n'
+        lure_rate = TLF_response_matrix[0, 1] / TLF_trials[1]
+        if hit_rate == 0.0:
+            hit_rate = 0.5 / TLF_trials[0]
+        if false_rate == 0.0:
+            false_rate = 0.5 / TLF_trials[2]
+        if lure_rate == 0.0:
+            lure_rate = 0.5 / TLF_trials[1]
+        text += 'Endorsement rates'
+        text += 'Targets: {0:.2f}'.format(hit_rate)
+        text += 'Lures: {0:.2f}'.format(lure_rate)
+        text += 'Foils and Firsts: {0:.2f}'.format(false_rate)
+        metrics['dpTF'] = norm.ppf(hit_rate) - norm.ppf(false_rate)
+        metrics['dpTL'] = norm.ppf(hit_rate) - norm.ppf(lure_rate)
+        metrics['dpLF'] = norm.ppf(lure_rate) - norm.ppf(false_rate)
+        text += "d' Target:Foil, {0:.2f}".format(metrics['dpTF'])
+        text += "d' Target:Lure, {0:.2f}".format(metrics['dpTL'])
+        text += "d' Lure:Foil, {0:.2f}".format(metrics['dpLF'])
+    else:
+        text += '\nThree-choice test metrics\n'
+        metrics['LDI'] = (TLF_response_matrix[1, 1] / TLF_trials[1] -
+                          TLF_response_matrix[1, 2] / TLF_trials[2])
+        text += 'LDI,{0:.2f}'.format(metrics['LDI'])
+    return ncorrect, counts, metrics, text
+
+
+def random_session(rng, n_trials=320, two_choice=False, p_nr=0.1):
+    type_code = rng.randint(0, 5, n_trials)
+    n_choices = 2 if two_choice else 3
+    response = rng.randint(1, n_choices + 1, n_trials)
+    response[rng.rand(n_trials) < p_nr] = 0
+    lure_bin = rng.randint(1, 6, n_trials)
+    return type_code, response, lure_bin
+
+
+def check_against_old(type_code, response, lure_bin, two_choice):
+    ncorrect, (TLF_trials, TLF_response_matrix, lure_bin_matrix), metrics, text = \
+        old_scoring(type_code, response, lure_bin, two_choice)
+    scores = score(type_code, response, lure_bin, two_choice)
+    assert scores['ncorrect'] == ncorrect
+    np.testing.assert_array_equal(scores['TLF_trials'], TLF_trials)
+    np.testing.assert_array_equal(scores['TLF_response_matrix'], TLF_response_matrix)
+    np.testing.assert_array_equal(scores['lure_bin_matrix'], lure_bin_matrix)
+    for name, value in metrics.items():
+        assert scores[name] == pytest.approx(value, nan_ok=True), name
+    assert summary_text(scores, two_choice) == text
+
+
+@pytest.mark.parametrize('two_choice', [False, True])
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_old_scoring(seed, two_choice):
+    rng = np.random.RandomState(seed)
+    check_against_old(*random_session(rng, two_choice=two_choice), two_choice=two_choice)
+
+
+@pytest.mark.parametrize('two_choice', [False, True])
+def test_empty_trial_types(two_choice):
+    # No responses to lures, no responses at all to targets: the 0.00001 and
+    # 0.5 / N stand-ins
+    type_code = np.array([0, 4, 1, 3, 2, 4, 0, 4])
+    response = np.array([2, 2, 0, 0, 1, 2, 2, 1])
+    lure_bin = np.array([1, 2, 3, 4, 5, 1, 2, 3])
+    check_against_old(type_code, response, lure_bin, two_choice)
+
+
+def test_two_choice_zero_rates():
+    # Nothing endorsed as old: every rate takes the 0.5 / N correction
+    type_code = np.array([1, 1, 1, 1, 3, 3, 4, 4, 4, 0])
+    response = np.full(len(type_code), 2)
+    scores = score(type_code, response, np.ones(len(type_code), dtype=int), True)
+    assert scores['hit_rate'] == pytest.approx(0.5 / 4)
+    assert scores['lure_rate'] == pytest.approx(0.5 / 2)
+    assert scores['false_rate'] == pytest.approx(0.5 / 4)
+    assert scores['dpTL'] == pytest.approx(norm.ppf(0.5 / 4) - norm.ppf(0.5 / 2))
+    check_against_old(type_code, response, np.ones(len(type_code), dtype=int), True)
+
+
+def test_pc_raw_out_of_the_run():
+    # An escaped run: percent correct (raw) is out of the whole run's trials
+    rng = np.random.RandomState(1)
+    type_code, response, lure_bin = random_session(rng, n_trials=100)
+    scores = score(type_code, response, lure_bin, False, n_trials=320)
+    assert scores['pc_raw'] == scores['ncorrect'] / 320.0
+
+
+def test_correct():
+    type_code = np.array([1, 3, 4, 0, 2, 1, 3, 4])
+    assert list(correct(type_code, [1, 2, 3, 3, 3, 2, 3, 1], False)) == [1, 1, 1, 1, 1, 0, 0, 0]
+    assert list(correct(type_code, [1, 2, 2, 2, 2, 2, 1, 1], True)) == [1, 1, 1, 1, 1, 0, 0, 0]